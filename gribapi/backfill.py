@@ -0,0 +1,156 @@
+import argparse
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from utils import set_download_limit_per_host
+from publisher import get_run_name, load_tiles_manifest, is_run_published, hold_runs
+from start import FORECAST_STEP, run_process, get_tile_pool, close_tile_pool
+from config import *
+
+"""
+    Догрузка исторических прогонов: все пары (дата, цикл) из диапазона для каждой модели обрабатываются
+    тем же run_process, что и в сервисе, но без планировщика и без ожидания публикации сроков.
+    Прогоны идут параллельно, не больше backfill.max_concurrent_runs (--concurrency) одновременно, от старых к новым.
+    Процессор ограничен общим пулом тайлов (backfill.tile_workers) и бюджетом общей памяти,
+    сеть - семафорами загрузок на сервер (backfill.max_downloads_per_host).
+    Прогоны модели, уже записанные в манифест тайлов, пропускаются; --force обрабатывает их заново,
+    отбрасывая и манифест работы прогона (иначе завершенный прогон ничего бы не делал).
+    Все прогоны диапазона защищаются от очистки retention на backfill.keep_days (--keep-days) дней,
+    без защиты (0) прогоны старше retention.days не догружаются: очистка сервиса сразу сняла бы их с публикации.
+    После каждого прогона в лог пишется прогресс: готово/всего, ошибки, прогонов в час, тайлы и байты в секунду, ETA.
+    Код возврата 1, если хотя бы один прогон завершился ошибкой.
+
+    Серверы хранят данные ограниченное время (NOMADS около 10 дней, открытые данные ECMWF несколько дней),
+    прогоны старше этого завершатся ошибкой скачивания и будут перечислены в итоге.
+
+    Запуск: python backfill.py --from 20240101 --to 20240105 [--cycles 0 12] [--models GFS] [--concurrency 2]
+                               [--keep-days 14] [--force]
+"""
+
+
+def parse_date(value):
+    try:
+        return datetime.strptime(value, '%Y%m%d')
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'Некорректный формат даты: {value}')
+
+
+def create_backfill_runs(date_from, date_to, cycles, models, force=False):
+    manifest = load_tiles_manifest()
+    now = datetime.utcnow()
+    runs = []
+    skipped = []
+    day = date_from
+    while day <= date_to:
+        for cycle in sorted(cycles):
+            date = day.replace(hour=cycle)
+            if date > now:
+                continue
+            for model in models:
+                if not force and is_run_published(model, get_run_name(day, cycle), manifest):
+                    skipped.append((model, date))
+                else:
+                    runs.append((model, date))
+        day += timedelta(days=1)
+    return runs, skipped
+
+
+def format_duration(seconds):
+    minutes = int(seconds // 60)
+    return f'{minutes // 60}:{minutes % 60:02d}'
+
+
+class BackfillProgress:
+    def __init__(self, total):
+        self.total = total
+        self.done = 0
+        self.failed = []
+        self.tiles = 0
+        self.download_bytes = 0
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    def add(self, model, date, report=None, error=None):
+        with self.lock:
+            self.done += 1
+            if error is not None:
+                self.failed.append(f'{model}.{date.strftime("%Y%m%d%H")}')
+            elif report is not None:
+                self.tiles += report['tiles']
+                self.download_bytes += report['download_bytes']
+            elapsed = max(time.time() - self.started, 1e-6)
+            eta = elapsed / self.done * (self.total - self.done)
+            logger.warning(f'Догрузка: {self.done}/{self.total} прогонов, ошибок {len(self.failed)}, '
+                           f'{self.done * 3600 / elapsed:.1f} прогонов в час, {self.tiles / elapsed:.0f} тайлов/с, '
+                           f'скачано {self.download_bytes / elapsed / 1024 / 1024:.1f} МБ/с, '
+                           f'прошло {format_duration(elapsed)}, осталось ~{format_duration(eta)}')
+
+
+def backfill_run(model, date, force=False):
+    logger.warning(f'Догрузка прогона модели {model} {date.strftime("%Y-%m-%d %H")}:00')
+    return run_process(date.hour, FORECAST_STEP, date, model, force=force)
+
+
+def run_backfill(date_from, date_to, cycles, models, concurrency, force=False, keep_days=backfill_keep_days):
+    runs, skipped = create_backfill_runs(date_from, date_to, cycles, models, force)
+    if skipped:
+        logger.warning(f'Пропущено уже опубликованных прогонов: {len(skipped)}')
+    if not runs:
+        logger.warning('Догружать нечего')
+        return 0
+    if keep_days > 0:
+        until = datetime.utcnow() + timedelta(days=keep_days)
+        hold_runs(sorted({get_run_name(date, date.hour) for _, date in runs + skipped}), until)
+        logger.warning(f'Прогоны диапазона защищены от очистки до {until.strftime("%Y-%m-%d %H:%M")} UTC')
+    elif runs[0][1] < datetime.utcnow() - timedelta(days=retention_days):
+        logger.error(f'Прогоны старше {retention_days} дн. очистка сервиса сразу снимет с публикации, '
+                     f'задайте --keep-days или увеличьте retention.days')
+        return 1
+
+    if backfill_max_downloads_per_host:
+        set_download_limit_per_host(backfill_max_downloads_per_host)
+    get_tile_pool(backfill_tile_workers)
+    logger.warning(f'Начата догрузка {len(runs)} прогонов, одновременно {concurrency}')
+    progress = BackfillProgress(len(runs))
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    try:
+        futures = {executor.submit(backfill_run, model, date, force): (model, date) for model, date in runs}
+        for future in as_completed(futures):
+            model, date = futures[future]
+            try:
+                progress.add(model, date, report=future.result())
+            except Exception as e:
+                logger.error(f'Ошибка догрузки прогона модели {model} {date.strftime("%Y-%m-%d %H")}:00: {e}',
+                             exc_info=True)
+                progress.add(model, date, error=e)
+    except KeyboardInterrupt:
+        logger.warning('Догрузка прервана, незапущенные прогоны отменены')
+        executor.shutdown(wait=True, cancel_futures=True)
+        raise
+    finally:
+        executor.shutdown(wait=True)
+        close_tile_pool()
+
+    if progress.failed:
+        logger.error(f'Догрузка завершена с ошибками, не обработаны прогоны: {progress.failed}')
+        return 1
+    logger.warning(f'Догрузка завершена: {progress.total} прогонов за {format_duration(time.time() - progress.started)}')
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Параллельная догрузка исторических прогонов за диапазон дат')
+    parser.add_argument('--from', dest='date_from', type=parse_date, required=True, help='YYYYMMDD')
+    parser.add_argument('--to', dest='date_to', type=parse_date, required=True, help='YYYYMMDD')
+    parser.add_argument('--cycles', nargs='+', type=int, choices=[0, 6, 12, 18], default=backfill_cycles)
+    parser.add_argument('--models', nargs='+', choices=['ECMWF', 'GFS'], default=scheduler_models)
+    parser.add_argument('--concurrency', type=int, default=backfill_max_concurrent_runs)
+    parser.add_argument('--keep-days', type=int, default=backfill_keep_days,
+                        help='сколько дней догруженные прогоны защищены от очистки retention')
+    parser.add_argument('--force', action='store_true', help='обработать заново уже опубликованные прогоны')
+    args = parser.parse_args()
+
+    if args.date_from > args.date_to:
+        parser.error('Дата --from позже даты --to')
+    sys.exit(run_backfill(args.date_from, args.date_to, args.cycles, args.models, max(1, args.concurrency), args.force,
+                          args.keep_days))
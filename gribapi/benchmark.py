@@ -0,0 +1,481 @@
+import argparse
+import re
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+import eccodes
+import numpy as np
+import yaml
+from config import *
+
+"""
+    Офлайн бенчмарк этапов конвейера без доступа к NOMADS и ECMWF.
+    В рабочей папке создаются синтетические GRIB2 файлы с сеткой GFS (0..359.75) и ECMWF (-180..179.75),
+    локальный HTTP сервер отдает их так же, как filter_gfs_0p25.pl, .idx инвентари GFS и .index файлы ECMWF.
+    Каждый этап запускается в отдельном процессе со своим config.yml, чтобы пиковая память считалась по этапу.
+    Результаты сравниваются с сохраненными базовыми, при превышении порогов код возврата 1.
+
+    Запуск: python benchmark.py [--stages read_grib encode] [--models GFS] [--repeat 3] [--save-baseline]
+"""
+
+BENCHMARK_STAGES = ['read_grib', 'encode', 'rgb_to_tif', 'create_tiles', 'create_tiles_from_rgb', 'run_process']
+BENCHMARK_GRIDS = {'GFS': (1440, 721), 'ECMWF': (1440, 721)}
+BENCHMARK_DATE = datetime(2024, 1, 1, 0)
+BENCHMARK_PARAMETERS = {'GFS': ['TMP', 'WIND', 'RH', 'PRES', 'TCDC', 'APCP'], 'ECMWF': ['TMP', 'WIND', 'PRES']}
+# Этапы растра и тайлов меряются на одном параметре
+BENCHMARK_TILE_PARAMETER = 'TMP'
+RESULT_PREFIX = 'BENCHMARK_RESULT '
+
+# Поля фикстур: переменная и уровень в .idx GFS, параметр ECMWF, discipline, category, number, тип и значение уровня
+FIXTURE_FIELDS = [
+    ('UGRD', '10 m above ground', '10u', 0, 2, 2, 103, 10),
+    ('VGRD', '10 m above ground', '10v', 0, 2, 3, 103, 10),
+    ('TMP', '2 m above ground', '2t', 0, 0, 0, 103, 2),
+    ('RH', '2 m above ground', 'r', 0, 1, 1, 103, 2),
+    ('PRMSL', 'mean sea level', 'msl', 0, 3, 1, 101, 0),
+    ('APCP', 'surface', 'tp', 0, 1, 8, 1, 0),
+    ('CPOFP', 'surface', None, 0, 1, 39, 1, 0),
+    ('TCDC', 'entire atmosphere', None, 0, 6, 1, 10, 0),
+]
+ECMWF_PARAMETER_FIELDS = {'WIND': ['10u', '10v'], 'TMP': ['2t'], 'PRES': ['msl'], 'RH': ['r'], 'APCP': ['tp']}
+GFS_PARAMETER_FIELDS = {'WIND': ['UGRD', 'VGRD'], 'TMP': ['TMP'], 'PRES': ['PRMSL'], 'RH': ['RH'],
+                        'TCDC': ['TCDC'], 'APCP': ['APCP'], 'CPOFP': ['CPOFP']}
+
+
+def synthetic_field(variable, ni, nj, rng):
+    lon = np.radians(np.arange(ni) * 360 / ni)[None, :]
+    lat = np.radians(90 - np.arange(nj) * 180 / (nj - 1))[:, None]
+    noise = rng.standard_normal((nj, ni))
+    if variable == 'TMP':
+        values = 250 + 45 * np.cos(lat) + 5 * np.sin(3 * lon) * np.cos(2 * lat) + noise
+    elif variable == 'RH':
+        values = np.clip(60 + 35 * np.sin(3 * lon + lat) * np.cos(2 * lat) + 3 * noise, 0, 100)
+    elif variable == 'PRMSL':
+        values = 101325 + 1500 * np.sin(2 * lon) * np.cos(3 * lat) + 50 * noise
+    elif variable == 'TCDC':
+        values = np.clip(50 + 70 * np.sin(4 * lon + 2 * lat) + 5 * noise, 0, 100)
+    elif variable in ('UGRD', 'VGRD'):
+        phase = 0 if variable == 'UGRD' else np.pi / 2
+        values = 12 * np.sin(2 * lon + phase) * np.cos(lat) + noise
+    elif variable == 'APCP':
+        values = np.maximum(8 * np.sin(5 * lon) * np.cos(4 * lat) + noise, 0)
+    else:
+        values = np.clip(50 + 60 * np.sin(lon - 3 * lat) + 5 * noise, 0, 100)
+    return values.astype(np.float64).ravel()
+
+
+def write_fixture_message(file, model, field, ni, nj, rng):
+    variable, _, _, discipline, category, number, surface, level = field
+    codes = eccodes.codes_grib_new_from_samples('GRIB2')
+    try:
+        eccodes.codes_set(codes, 'centre', 7 if model == 'GFS' else 98)
+        eccodes.codes_set(codes, 'dataDate', int(BENCHMARK_DATE.strftime('%Y%m%d')))
+        eccodes.codes_set(codes, 'dataTime', BENCHMARK_DATE.hour * 100)
+        eccodes.codes_set(codes, 'Ni', ni)
+        eccodes.codes_set(codes, 'Nj', nj)
+        eccodes.codes_set(codes, 'latitudeOfFirstGridPointInDegrees', 90.0)
+        eccodes.codes_set(codes, 'latitudeOfLastGridPointInDegrees', -90.0)
+        eccodes.codes_set(codes, 'longitudeOfFirstGridPointInDegrees', 0.0 if model == 'GFS' else 180.0)
+        eccodes.codes_set(codes, 'longitudeOfLastGridPointInDegrees', 360 - 360 / ni if model == 'GFS' else 180 - 360 / ni)
+        eccodes.codes_set(codes, 'iDirectionIncrementInDegrees', 360 / ni)
+        eccodes.codes_set(codes, 'jDirectionIncrementInDegrees', 180 / (nj - 1))
+        eccodes.codes_set(codes, 'discipline', discipline)
+        eccodes.codes_set(codes, 'parameterCategory', category)
+        eccodes.codes_set(codes, 'parameterNumber', number)
+        eccodes.codes_set(codes, 'typeOfFirstFixedSurface', surface)
+        eccodes.codes_set(codes, 'scaledValueOfFirstFixedSurface', level)
+        eccodes.codes_set(codes, 'bitsPerValue', 16)
+        eccodes.codes_set_values(codes, synthetic_field(variable, ni, nj, rng))
+        offset = file.tell()
+        eccodes.codes_write(codes, file)
+        return offset, file.tell() - offset
+    finally:
+        eccodes.codes_release(codes)
+
+
+# Фикстура модели - один GRIB2 файл со всеми полями и его инвентарь в {model}.json
+def create_fixture(model, fixtures_dir, seed=0):
+    ni, nj = BENCHMARK_GRIDS[model]
+    rng = np.random.default_rng(seed)
+    fields = [field for field in FIXTURE_FIELDS if model == 'GFS' or field[2] is not None]
+    inventory = []
+    with open(os.path.join(fixtures_dir, f'{model}.grib2'), 'wb') as file:
+        for field in fields:
+            offset, length = write_fixture_message(file, model, field, ni, nj, rng)
+            inventory.append({'variable': field[0], 'level': field[1], 'param': field[2],
+                              'offset': offset, 'length': length})
+    with open(os.path.join(fixtures_dir, f'{model}.json'), 'w') as f:
+        json.dump(inventory, f)
+    return inventory
+
+
+def read_fixture_messages(fixtures_dir, model, inventory, names, key):
+    with open(os.path.join(fixtures_dir, f'{model}.grib2'), 'rb') as f:
+        payload = b''
+        for message in inventory:
+            if message[key] in names:
+                f.seek(message['offset'])
+                payload += f.read(message['length'])
+    return payload
+
+
+def format_gfs_idx(inventory, step):
+    date = BENCHMARK_DATE.strftime('%Y%m%d%H')
+    return ''.join(f"{i + 1}:{message['offset']}:d={date}:{message['variable']}:{message['level']}:{step} hour fcst:\n"
+                   for i, message in enumerate(inventory))
+
+
+def format_ecmwf_index(inventory, step):
+    lines = []
+    for message in inventory:
+        lines.append(json.dumps({
+            'domain': 'g', 'date': BENCHMARK_DATE.strftime('%Y%m%d'), 'time': BENCHMARK_DATE.strftime('%H%M'),
+            'expver': '0001', 'class': 'od', 'type': 'fc', 'stream': 'oper', 'step': str(step),
+            'levtype': 'sfc', 'param': message['param'],
+            '_offset': message['offset'], '_length': message['length']
+        }))
+    return '\n'.join(lines) + '\n'
+
+
+def parse_range_header(value, size):
+    ranges = []
+    for part in value.split('=', 1)[1].split(','):
+        start, end = part.strip().split('-')
+        if start == '':
+            start, end = size - int(end), size - 1
+        ranges.append((int(start), min(int(end), size - 1) if end else size - 1))
+    return ranges
+
+
+class FixtureRequestHandler(BaseHTTPRequestHandler):
+    # Задается в start_fixture_server: {'dir': папка фикстур, 'inventories': {модель: инвентарь}}
+    fixtures = None
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        step_match = re.search(r'(?:\.f(\d{3})|-(\d+)h-)', url.path + '?' + url.query)
+        step = int(next(group for group in step_match.groups() if group is not None)) if step_match else 0
+        fixtures_dir = self.fixtures['dir']
+        gfs_inventory = self.fixtures['inventories'].get('GFS', [])
+        ecmwf_inventory = self.fixtures['inventories'].get('ECMWF', [])
+
+        if url.path.startswith('/gfs/filter'):
+            query = parse_qs(url.query)
+            variables = [name[4:] for name in query if name.startswith('var_')]
+            self.send_payload(read_fixture_messages(fixtures_dir, 'GFS', gfs_inventory, variables, 'variable'))
+        elif url.path.startswith('/gfs/data/') and url.path.endswith('.idx'):
+            self.send_payload(format_gfs_idx(gfs_inventory, step).encode())
+        elif url.path.startswith('/gfs/data/'):
+            self.send_file(os.path.join(fixtures_dir, 'GFS.grib2'))
+        elif url.path.startswith('/ecmwf/') and url.path.endswith('.index'):
+            self.send_payload(format_ecmwf_index(ecmwf_inventory, step).encode())
+        elif url.path.startswith('/ecmwf/') and url.path.endswith('.grib2'):
+            self.send_file(os.path.join(fixtures_dir, 'ECMWF.grib2'))
+        else:
+            self.send_error(404)
+
+    def send_payload(self, payload, status=200, content_type='application/octet-stream', headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def send_file(self, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        if 'Range' not in self.headers:
+            self.send_payload(data, headers={'Accept-Ranges': 'bytes'})
+            return
+        ranges = parse_range_header(self.headers['Range'], len(data))
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            self.send_payload(data[start:end + 1], 206, headers={'Content-Range': f'bytes {start}-{end}/{len(data)}'})
+            return
+        boundary = 'benchmark_byteranges'
+        body = b''
+        for start, end in ranges:
+            body += (f'--{boundary}\r\nContent-Type: application/octet-stream\r\n'
+                     f'Content-Range: bytes {start}-{end}/{len(data)}\r\n\r\n').encode()
+            body += data[start:end + 1] + b'\r\n'
+        body += f'--{boundary}--\r\n'.encode()
+        self.send_payload(body, 206, f'multipart/byteranges; boundary={boundary}')
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_fixture_server(fixtures_dir, inventories):
+    FixtureRequestHandler.fixtures = {'dir': fixtures_dir, 'inventories': inventories}
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FixtureRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# config.yml для процессов этапов: все пути внутри рабочей папки, источники данных - локальный сервер
+def write_benchmark_config(work_dir, port):
+    base_url = f'http://127.0.0.1:{port}'
+    benchmark_config_data = dict(config)
+    benchmark_config_data.update({
+        'tiles_path': os.path.join(work_dir, 'tiles'),
+        'temp_dir': os.path.join(work_dir, 'temp'),
+        'work_manifest_dir': os.path.join(work_dir, 'manifests'),
+        'publishing': {'staging_dir': os.path.join(work_dir, 'tiles', '.staging'),
+                       'trash_dir': os.path.join(work_dir, 'tiles', '.trash'),
+                       'manifest_path': os.path.join(work_dir, 'tiles', 'manifest.json')},
+        'log_dir': os.path.join(work_dir, 'logs'),
+        'text_file_to_save_info': os.path.join(work_dir, 'input.txt'),
+        'GFS_URL': f'{base_url}/gfs/filter_gfs_0p25.pl',
+        'GFS_DATA_URL': f'{base_url}/gfs/data',
+        'ECMWF_URL': f'{base_url}/ecmwf',
+        'MAX_FORECAST_STEP': benchmark_max_forecast_step,
+        'download_host_limits': {},
+        'forecast_cube': dict(config.get('forecast_cube') or {}, path=os.path.join(work_dir, 'cube')),
+    })
+    with open(os.path.join(work_dir, 'config.yml'), 'w') as f:
+        yaml.safe_dump(benchmark_config_data, f, allow_unicode=True)
+
+
+def write_parameter_fixture(model, parameter, fixtures_dir, output_dir):
+    with open(os.path.join(fixtures_dir, f'{model}.json')) as f:
+        inventory = json.load(f)
+    if model == 'GFS':
+        names, key = GFS_PARAMETER_FIELDS[parameter], 'variable'
+    else:
+        names, key = ECMWF_PARAMETER_FIELDS[parameter], 'param'
+    path = os.path.join(output_dir, f'{model}.{parameter}.grib2')
+    with open(path, 'wb') as f:
+        f.write(read_fixture_messages(fixtures_dir, model, inventory, names, key))
+    return path
+
+
+def read_benchmark_fields(model, parameter, fixtures_dir, output_dir):
+    from grib_to_rgb import read_parameter_fields
+    path = write_parameter_fixture(model, parameter, fixtures_dir, output_dir)
+    if parameter == 'APCP':
+        additional = write_parameter_fixture(model, 'CPOFP', fixtures_dir, output_dir)
+        return read_parameter_fields(path, parameter, additional, path)
+    return read_parameter_fields(path, parameter)
+
+
+def encode_benchmark_rgb(model, fixtures_dir, output_dir):
+    from grib_to_rgb import encode_parameter_fields
+    fields, ni, nj = read_benchmark_fields(model, BENCHMARK_TILE_PARAMETER, fixtures_dir, output_dir)
+    return encode_parameter_fields(BENCHMARK_TILE_PARAMETER, fields, ni, nj, model)
+
+
+# Этап получает папку фикстур и выходную папку, подготовка не входит в замер:
+# возвращает (функция замера, объем работы за один запуск, единица объема)
+def prepare_stage(stage, model, fixtures_dir, output_dir):
+    # Модули конвейера импортируются внутри этапа, чтобы в пиковую память попадало только нужное этапу
+    if stage == 'read_grib':
+        from grib_to_rgb import read_parameter_fields
+        paths = {parameter: write_parameter_fixture(model, parameter, fixtures_dir, output_dir)
+                 for parameter in BENCHMARK_PARAMETERS[model]}
+        additional = write_parameter_fixture(model, 'CPOFP', fixtures_dir, output_dir) if 'APCP' in paths else None
+
+        def run_stage():
+            for parameter, path in paths.items():
+                if parameter == 'APCP':
+                    read_parameter_fields(path, parameter, additional, path)
+                else:
+                    read_parameter_fields(path, parameter)
+        return run_stage, len(paths), 'files'
+
+    if stage == 'encode':
+        from grib_to_rgb import encode_parameter_fields
+        fields = {parameter: read_benchmark_fields(model, parameter, fixtures_dir, output_dir)
+                  for parameter in BENCHMARK_PARAMETERS[model]}
+        ni, nj = BENCHMARK_GRIDS[model]
+
+        def run_stage():
+            for parameter, (parameter_fields, field_ni, field_nj) in fields.items():
+                encode_parameter_fields(parameter, parameter_fields, field_ni, field_nj, model)
+        return run_stage, len(fields) * ni * nj / 1e6, 'Mpx'
+
+    if stage == 'rgb_to_tif':
+        from gdal_processes import rgb_to_tif
+        rgb_image = encode_benchmark_rgb(model, fixtures_dir, output_dir)
+        return (lambda: rgb_to_tif(rgb_image, os.path.join(output_dir, f'{model}.tif'), model),
+                rgb_image.shape[0] * rgb_image.shape[1] / 1e6, 'Mpx')
+
+    if stage == 'create_tiles':
+        from gdal_processes import rgb_to_tif, create_tiles
+        tiff_path = os.path.join(output_dir, f'{model}.tif')
+        rgb_to_tif(encode_benchmark_rgb(model, fixtures_dir, output_dir), tiff_path, model)
+        tiles_folder = os.path.join(output_dir, 'tiles')
+        return lambda: create_tiles(tiff_path, tiles_folder), 85, 'tiles'
+
+    if stage == 'create_tiles_from_rgb':
+        from tiler import create_tiles_from_rgb
+        rgb_image = encode_benchmark_rgb(model, fixtures_dir, output_dir)
+        tiles_folder = os.path.join(output_dir, 'tiles')
+        return lambda: create_tiles_from_rgb(rgb_image, tiles_folder, model), 85, 'tiles'
+
+    if stage == 'run_process':
+        from start import run_process, create_gfs_requests, create_ecmwf_requests, gfs_parameters
+        weather_date = BENCHMARK_DATE.strftime('%Y%m%d')
+        if model == 'GFS':
+            requests_count = len(create_gfs_requests(BENCHMARK_DATE.hour, 6, weather_date, BENCHMARK_DATE, gfs_parameters))
+        else:
+            requests_count = len(create_ecmwf_requests(BENCHMARK_DATE.hour, 6, weather_date, BENCHMARK_DATE,
+                                                       ecmwf_parameters))
+        return lambda: run_process(BENCHMARK_DATE.hour, 6, BENCHMARK_DATE, model), requests_count, 'requests'
+
+    raise ValueError(f'Неизвестный этап бенчмарка: {stage}')
+
+
+def count_files(*folders):
+    files, size = 0, 0
+    for folder in folders:
+        for root, _, names in os.walk(folder):
+            for name in names:
+                files += 1
+                size += os.path.getsize(os.path.join(root, name))
+    return files, size
+
+
+def get_peak_rss_mb():
+    # ru_maxrss в Linux в килобайтах; RUSAGE_CHILDREN - самый большой из процессов пула генерации тайлов
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024
+
+
+def clear_folder(folder):
+    shutil.rmtree(folder, ignore_errors=True)
+    os.makedirs(folder, exist_ok=True)
+
+
+def run_stage_worker(stage, model, repeat):
+    work_dir = os.getcwd()
+    fixtures_dir = os.path.join(work_dir, 'fixtures')
+    output_dir = os.path.join(work_dir, 'output', f'{stage}.{model}')
+    clear_folder(output_dir)
+    run_stage, work, unit = prepare_stage(stage, model, fixtures_dir, output_dir)
+
+    # Считаются только файлы, записанные самим этапом, а не подготовленные для него
+    written_dirs = [os.path.join(output_dir, 'tiles')]
+    if stage == 'rgb_to_tif':
+        written_dirs = [os.path.join(output_dir, f'{model}.tif')]
+    elif stage == 'run_process':
+        written_dirs = [tiles_path, forecast_cube_path]
+
+    timings = []
+    for _ in range(repeat):
+        for folder in written_dirs:
+            if os.path.isdir(folder):
+                clear_folder(folder)
+        if stage == 'run_process':
+            # Иначе по манифесту повторный прогон будет считаться уже опубликованным
+            clear_folder(work_manifest_dir)
+        start_time = time.perf_counter()
+        run_stage()
+        timings.append(time.perf_counter() - start_time)
+
+    if stage == 'rgb_to_tif':
+        path = written_dirs[0]
+        files, size = (1, os.path.getsize(path)) if os.path.exists(path) else (0, 0)
+    else:
+        files, size = count_files(*written_dirs)
+    seconds = statistics.median(timings)
+    return {
+        'seconds': round(seconds, 4),
+        'min_seconds': round(min(timings), 4),
+        'throughput': round(work / seconds, 3) if seconds > 0 else None,
+        'unit': f'{unit}/s',
+        'peak_rss_mb': round(get_peak_rss_mb(), 1),
+        'files_written': files,
+        'bytes_written': size,
+    }
+
+
+def run_stage_process(stage, model, work_dir, repeat):
+    command = [sys.executable, os.path.abspath(__file__), '--worker', stage, model, '--repeat', str(repeat)]
+    completed = subprocess.run(command, cwd=work_dir, capture_output=True, text=True)
+    for line in reversed(completed.stdout.splitlines()):
+        if line.startswith(RESULT_PREFIX):
+            return json.loads(line[len(RESULT_PREFIX):])
+    error_lines = (completed.stderr or completed.stdout).strip().splitlines()
+    return {'error': error_lines[-1] if error_lines else f'код возврата {completed.returncode}'}
+
+
+def compare_with_baseline(results, baseline):
+    regressions = []
+    for key, result in results.items():
+        expected = baseline.get(key)
+        if expected is None or 'error' in result or 'error' in expected:
+            continue
+        thresholds = dict(benchmark_thresholds, **benchmark_stage_thresholds.get(key.split('.')[0], {}))
+        for metric, threshold in thresholds.items():
+            if expected.get(metric) and result.get(metric) is not None and \
+                    result[metric] > expected[metric] * (1 + threshold):
+                regressions.append(f'{key}: {metric} {result[metric]} против {expected[metric]} '
+                                   f'(порог +{threshold * 100:.0f}%)')
+    return regressions
+
+
+def print_results(results):
+    print(f"{'этап':<32}{'секунд':>10}{'пропускная способность':>28}{'пик RSS, МБ':>14}{'файлов':>10}")
+    for key, result in results.items():
+        if 'error' in result:
+            print(f"{key:<32}  ошибка: {result['error']}")
+            continue
+        print(f"{key:<32}{result['seconds']:>10}{str(result['throughput']) + ' ' + result['unit']:>28}"
+              f"{result['peak_rss_mb']:>14}{result['files_written']:>10}")
+
+
+def run_benchmark(stages, models, repeat, save_baseline=False):
+    work_dir = os.path.abspath(benchmark_dir)
+    fixtures_dir = os.path.join(work_dir, 'fixtures')
+    os.makedirs(fixtures_dir, exist_ok=True)
+    start_time = time.time()
+    inventories = {model: create_fixture(model, fixtures_dir) for model in BENCHMARK_GRIDS}
+    logger.debug(f'Фикстуры бенчмарка созданы за {time.time() - start_time:.1f} секунд')
+
+    server = start_fixture_server(fixtures_dir, inventories)
+    try:
+        write_benchmark_config(work_dir, server.server_address[1])
+        results = {}
+        for stage in stages:
+            for model in models:
+                results[f'{stage}.{model}'] = run_stage_process(stage, model, work_dir, repeat)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    print_results(results)
+    if save_baseline:
+        with open(benchmark_baseline_path, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'Базовые результаты сохранены в {benchmark_baseline_path}')
+        return 0
+    if not os.path.exists(benchmark_baseline_path):
+        print(f'Базовых результатов {benchmark_baseline_path} нет, сравнение пропущено')
+        return 0
+    with open(benchmark_baseline_path) as f:
+        regressions = compare_with_baseline(results, json.load(f))
+    for regression in regressions:
+        print(f'Регрессия: {regression}')
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Офлайн бенчмарк этапов конвейера на синтетических GRIB2')
+    parser.add_argument('--stages', nargs='+', choices=BENCHMARK_STAGES, default=BENCHMARK_STAGES)
+    parser.add_argument('--models', nargs='+', choices=list(BENCHMARK_GRIDS), default=list(BENCHMARK_GRIDS))
+    parser.add_argument('--repeat', type=int, default=benchmark_repeat)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--worker', nargs=2, metavar=('STAGE', 'MODEL'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(RESULT_PREFIX + json.dumps(run_stage_worker(args.worker[0], args.worker[1], args.repeat)))
+    else:
+        sys.exit(run_benchmark(args.stages, args.models, args.repeat, args.save_baseline))
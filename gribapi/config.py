@@ -64,8 +64,145 @@ tiles_path = config['tiles_path']
 temp_dir = config['temp_dir']
 GFS_URL = config['GFS_URL']
 ECMWF_URL = config['ECMWF_URL']
+# filter - запросы через filter_gfs_0p25.pl, idx - диапазоны байт из полного файла по .idx инвентарю
+GFS_FETCH_MODE = config.get('GFS_FETCH_MODE', 'filter')
+# request - отдельный retrieve на каждую пару (параметр, срок), batch - один retrieve на ECMWF_BATCH_STEPS сроков параметра
+ECMWF_FETCH_MODE = config.get('ECMWF_FETCH_MODE', 'batch')
+ECMWF_BATCH_STEPS = config.get('ECMWF_BATCH_STEPS', 6)
+GFS_DATA_URL = config.get('GFS_DATA_URL', 'https://nomads.ncep.noaa.gov/pub/data/nccf/com/gfs/prod')
 MAX_FORECAST_STEP = config['MAX_FORECAST_STEP']
 text_file_to_save_info = config['text_file_to_save_info']
+# native - тайлы строятся в процессе из RGB массива, gdal2tiles - через gdalwarp и gdal2tiles.py
+tiler_mode = config.get('tiler_mode', 'native')
+# одинаковые тайлы прогона хранятся один раз в {run}/.blobs, в дереве тайлов - жесткие ссылки на них
+tile_dedup = config.get('tile_dedup', False)
+# directory - дерево {z}/{x}/{y}.png, mbtiles - один файл {param}.mbtiles на параметр и срок прогноза
+tiles_output = config.get('tiles_output', 'directory')
+tile_archive_batch_size = config.get('tile_archive_batch_size', 500)
+
+# параллельные загрузки: число потоков, глубина очереди предзагрузки и лимиты соединений на хост
+download_workers = config.get('download_workers', 4)
+download_prefetch = config.get('download_prefetch', 8)
+download_max_per_host = config.get('download_max_per_host', 4)
+download_host_limits = config.get('download_host_limits') or {}
+# файлы пишутся на диск потоково, при обрыве соединения докачиваются через HTTP Range
+download_chunk_size = config.get('download_chunk_size', 1024 * 1024)
+download_max_resumes = config.get('download_max_resumes', 3)
+
+# сколько мегабайт RGB массивов может одновременно ждать генерации тайлов в shared memory
+shared_memory_budget_mb = config.get('shared_memory_budget_mb', 1024)
+
+# память на один процесс генерации тайлов в мегабайтах: задает высоту полос растра и число процессов
+max_worker_memory = config.get('max_worker_memory', 512)
+# сколько ждать задачу генерации тайлов в общем пуле: если процесс пула убит, multiprocessing ее никогда не завершит
+tile_task_timeout_minutes = config.get('tile_task_timeout_minutes', 30)
+
+# сервер тайлов (tile_server.py): зумы глубже prerendered_max_zoom рендерятся по запросу из сохраненных RGB растров
+tile_server_config = config.get('tile_server') or {}
+tile_server_host = tile_server_config.get('host', '0.0.0.0')
+tile_server_port = tile_server_config.get('port', 8080)
+tile_server_cache_mb = tile_server_config.get('cache_mb', 256)
+tile_server_max_age = tile_server_config.get('max_age', 3600)
+tile_server_prerendered_max_zoom = tile_server_config.get('prerendered_max_zoom', 3)
+tile_server_max_zoom = tile_server_config.get('max_zoom', 8)
+# enabled - сервер тайлов развернут рядом с импортом; RGB растры для глубоких зумов по умолчанию пишутся только тогда
+tile_server_enabled = tile_server_config.get('enabled', True)
+store_source_rasters = tile_server_config.get('store_source_rasters')
+if store_source_rasters is None:
+    store_source_rasters = tile_server_enabled
+
+# куб прогноза (forecast_cube.py) для быстрых запросов временного ряда в точке
+forecast_cube_config = config.get('forecast_cube') or {}
+forecast_cube_enabled = forecast_cube_config.get('enabled', False)
+forecast_cube_path = forecast_cube_config.get('path', './public/cube')
+
+# шаг промежуточных кадров в часах (1 или 3) между шагами прогноза, 0 - без интерполяции
+interpolation_step_hours = config.get('interpolation_step_hours', 0)
+
+# кодирование тайлов (tile_encoders.py): png, rgba_png, webp или palette_png, формат можно задать по параметру
+tile_encoding_config = config.get('tile_encoding') or {}
+tile_encoding_format = tile_encoding_config.get('format', 'png')
+tile_encoding_parameters = tile_encoding_config.get('parameters') or {}
+tile_encoding_png_zlevel = tile_encoding_config.get('png_zlevel', 9)
+tile_encoding_palette_max_colors = tile_encoding_config.get('palette_max_colors', 256)
+# потоки кодирования внутри одного процесса генерации тайлов
+tile_encoding_workers = tile_encoding_config.get('workers', 2)
+
+# публикация прогонов (publisher.py): тайлы пишутся в staging_dir и переносятся в {tiles_path}/ecmwf/{run}
+# после завершения прогона модели, опубликованные прогоны перечислены в manifest_path
+publishing_config = config.get('publishing') or {}
+publishing_staging_dir = publishing_config.get('staging_dir', os.path.join(tiles_path, '.staging'))
+publishing_trash_dir = publishing_config.get('trash_dir', os.path.join(tiles_path, '.trash'))
+publishing_manifest_path = publishing_config.get('manifest_path', os.path.join(tiles_path, 'manifest.json'))
+
+# хранение: прогоны старше days снимаются с публикации по манифесту, файлы удаляются в фоне с ограничением скорости
+retention_config = config.get('retention') or {}
+retention_days = retention_config.get('days', 1)
+retention_interval_minutes = retention_config.get('interval_minutes', 30)
+retention_max_deletes_per_second = retention_config.get('max_deletes_per_second', 2000)
+
+# кэш GRIB данных цикла (grib_cache.py): каждый срок GFS скачивается один раз, даже если нужен нескольким параметрам
+grib_cache_config = config.get('grib_cache') or {}
+grib_cache_enabled = grib_cache_config.get('enabled', True)
+grib_cache_max_mb = grib_cache_config.get('max_mb', 256)
+# один запрос со всеми переменными прогона на срок GFS, сообщения параметров выделяются локально
+grib_cache_combined_gfs_requests = grib_cache_config.get('combined_gfs_requests', True)
+
+# манифесты прогонов: состояние каждой пары (параметр, срок), чтобы повтор переделывал только незавершенное
+work_manifest_dir = config.get('work_manifest_dir', os.path.join(temp_dir, 'manifests'))
+
+# общая очередь единиц работы для нескольких узлов (worker.py); url: sqlite:///путь или file:///папка
+work_queue_config = config.get('work_queue') or {}
+work_queue_enabled = work_queue_config.get('enabled', False)
+work_queue_url = work_queue_config.get('url', 'sqlite:///./public/work_queue.sqlite')
+work_queue_lease_seconds = work_queue_config.get('lease_seconds', 300)
+work_queue_poll_seconds = work_queue_config.get('poll_seconds', 5)
+work_queue_max_attempts = work_queue_config.get('max_attempts', 5)
+# сколько узел-планировщик ждет обработки прогона воркерами, после этого оставшиеся единицы помечаются failed
+work_queue_run_timeout_minutes = work_queue_config.get('run_timeout_minutes', 360)
+# 0 - по числу процессов генерации тайлов, как в get_worker_count
+work_queue_worker_processes = work_queue_config.get('worker_processes', 0)
+
+# планировщик по готовности данных: опрос последних циклов за lookback_hours, состояние хранится на диске
+scheduler_config = config.get('scheduler') or {}
+scheduler_models = scheduler_config.get('models', ['ECMWF', 'GFS'])
+scheduler_poll_interval_seconds = scheduler_config.get('poll_interval_seconds', 60)
+scheduler_step_poll_seconds = scheduler_config.get('step_poll_seconds', 30)
+scheduler_step_timeout_minutes = scheduler_config.get('step_timeout_minutes', 120)
+scheduler_lookback_hours = scheduler_config.get('lookback_hours', 12)
+scheduler_retry_delay_minutes = scheduler_config.get('retry_delay_minutes', 3)
+scheduler_max_attempts = scheduler_config.get('max_attempts', 16)
+scheduler_max_concurrent_runs = scheduler_config.get('max_concurrent_runs', 2)
+scheduler_max_runs_per_model = scheduler_config.get('max_runs_per_model', 1)
+scheduler_state_path = scheduler_config.get('state_path', './public/scheduler_state.json')
+
+# догрузка исторических прогонов (backfill.py): одновременно идущие прогоны, циклы по умолчанию,
+# процессы пула тайлов (null - как в основном сервисе) и загрузки на один сервер (null - как в сервисе;
+# заданное значение заменяет и download_max_per_host, и лимиты download_host_limits).
+# keep_days - сколько дней догруженные прогоны защищены от очистки retention (0 - не защищать)
+backfill_config = config.get('backfill') or {}
+backfill_max_concurrent_runs = backfill_config.get('max_concurrent_runs', 4)
+backfill_cycles = backfill_config.get('cycles', [0, 6, 12, 18])
+backfill_tile_workers = backfill_config.get('tile_workers')
+backfill_max_downloads_per_host = backfill_config.get('max_downloads_per_host')
+backfill_keep_days = backfill_config.get('keep_days', 7)
+
+# метрики прогонов: textfile для node_exporter и JSON отчеты по каждому прогону
+metrics_config = config.get('metrics') or {}
+metrics_textfile_dir = metrics_config.get('textfile_dir', './public/metrics')
+metrics_reports_dir = metrics_config.get('reports_dir', './public/metrics/reports')
+
+# офлайн бенчмарк (benchmark.py): рабочая папка, базовые результаты и допустимый рост времени и памяти в долях
+benchmark_config = config.get('benchmark') or {}
+benchmark_dir = benchmark_config.get('work_dir', './benchmark')
+benchmark_baseline_path = benchmark_config.get('baseline_path', './benchmark_baseline.json')
+benchmark_repeat = benchmark_config.get('repeat', 3)
+benchmark_max_forecast_step = benchmark_config.get('max_forecast_step', 12)
+benchmark_thresholds = benchmark_config.get('thresholds') or {'seconds': 0.2, 'peak_rss_mb': 0.2}
+benchmark_stage_thresholds = benchmark_config.get('stage_thresholds') or {}
+
+# зерно для случайных значений в каналах TMP и WIND, null - случайное при каждом запуске
+encoding_seed = config.get('encoding_seed')
 
 ecmwf_parameters = [('10v', '10u'), '2t', 'msl']
 gfs_parameters = ['APCP', 'RH', 'TCDC']
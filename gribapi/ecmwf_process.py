@@ -2,12 +2,30 @@
 from config import *
 
 
+# Файл ECMWF для единицы работы: в режиме batch он вырезается по сроку из общего retrieve сроков steps
+def create_ecmwf_source(weather_date, cycle, step, param, steps):
+    return {'date': weather_date, 'time': cycle, 'step': step, 'param': param, 'steps': steps}
+
+
+def create_ecmwf_batch_request(source):
+    return {
+        "time": source['time'],
+        "date": source['date'],
+        "type": "fc",
+        "step": source['steps'],
+        "param": source['param']
+    }
+
+
 def create_ecmwf_requests(cycle, forecast_step, weather_date, date, parameters=None):
     if parameters is None:
         parameters = ['tp', ('10v', '10u'), '2t', 'r', 'msl']
+    steps = list(range(0, MAX_FORECAST_STEP + 1 if cycle in [0, 12] else MAX_FORECAST_STEP - 11, forecast_step))
+    batches = {step: steps[i - i % ECMWF_BATCH_STEPS:i - i % ECMWF_BATCH_STEPS + ECMWF_BATCH_STEPS]
+               for i, step in enumerate(steps)}
     requests = []
     for param in parameters:
-        for i in range(0, MAX_FORECAST_STEP + 1 if cycle in [0, 12] else MAX_FORECAST_STEP - 11, forecast_step):
+        for i in steps:
             request = {
                 "time": cycle,
                 "date": weather_date,
@@ -19,7 +37,8 @@ def create_ecmwf_requests(cycle, forecast_step, weather_date, date, parameters=N
                 'param': convert_params.get(param),
                 'request': request,
                 'second_request': None,
-                'step': i
+                'step': i,
+                'sources': {'main': create_ecmwf_source(weather_date, cycle, i, param, batches[i])}
             })
 
     return requests
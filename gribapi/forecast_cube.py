@@ -0,0 +1,197 @@
+import sys
+import threading
+import numpy as np
+from config import *
+
+"""
+    Куб прогноза: для каждого прогона и переменной - memory-mapped float32 файл {forecast_cube_path}/{model}/{run}/{name}.f32.
+    Порядок осей (lat, lon, step): временной ряд точки лежит в файле подряд, поэтому запрос точки - одно
+    чтение нескольких десятков байт без декодирования GRIB и тайлов. Описание сетки и сроков - в cube.json.
+    Файлы всех переменных прогона создаются один раз в create_forecast_cube (эксклюзивным созданием, поэтому
+    параллельные прогоны и повторы не обнуляют данные друг друга), запись сроков только открывает их на r+.
+
+    Запрос из консоли: python forecast_cube.py GFS 2023120800 55.75 37.62
+"""
+
+# Пороги для иконки погоды из weather_condition_mapping (осадки за 3 часа в мм, облачность и влажность в %)
+PRECIPITATION_THRESHOLD = 0.1
+SHOWER_THRESHOLD = 2.5
+MIST_HUMIDITY = 95
+CLOUD_THRESHOLDS = [(10, 'clear'), (30, 'fewClouds'), (60, 'scatteredClouds')]
+
+# Поля read_parameter_fields по параметрам; остальные параметры дают одно поле 'data'
+CUBE_FIELDS = {'WIND': ['u', 'v'], 'APCP': ['apcp', 'cpofp']}
+
+open_cubes = {}
+open_cubes_lock = threading.Lock()
+
+
+def get_cube_dir(model, run):
+    return os.path.join(forecast_cube_path, model, run)
+
+
+def get_cube_variable_name(param, key):
+    return param if key == 'data' else f'{param}.{key}'
+
+
+def get_cube_variables(params):
+    return [get_cube_variable_name(param, key) for param in params for key in CUBE_FIELDS.get(param, ['data'])]
+
+
+def create_cube_variable(cube_dir, name, shape):
+    try:
+        with open(os.path.join(cube_dir, f'{name}.f32'), 'xb') as f:
+            f.truncate(int(np.prod(shape)) * np.dtype(np.float32).itemsize)
+    except FileExistsError:
+        pass
+
+
+def write_cube_meta(cube_dir, meta):
+    temp_path = os.path.join(cube_dir, f'cube.json.{os.getpid()}.tmp')
+    with open(temp_path, 'w') as f:
+        json.dump(meta, f)
+    os.replace(temp_path, os.path.join(cube_dir, 'cube.json'))
+
+
+def create_forecast_cube(model, run, date, steps, ni, nj, params):
+    cube_dir = get_cube_dir(model, run)
+    os.makedirs(cube_dir, exist_ok=True)
+    meta_path = os.path.join(cube_dir, 'cube.json')
+    shape = (nj, ni, len(steps))
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta['steps'] == list(steps) and meta['ni'] == ni and meta['nj'] == nj:
+            variables = [name for name in get_cube_variables(params) if name not in meta['variables']]
+            for name in variables:
+                create_cube_variable(cube_dir, name, shape)
+            if variables:
+                meta['variables'] += variables
+                write_cube_meta(cube_dir, meta)
+            return {'dir': cube_dir, 'meta': meta, 'arrays': {}}
+        # Сетка или сроки поменялись - старые файлы переменных не подходят по размеру
+        for name in meta['variables']:
+            if os.path.exists(os.path.join(cube_dir, f'{name}.f32')):
+                os.remove(os.path.join(cube_dir, f'{name}.f32'))
+
+    meta = {
+        'model': model,
+        'run': run,
+        'steps': list(steps),
+        'valid_times': [(date + timedelta(hours=step)).strftime('%Y%m%d%H') for step in steps],
+        'ni': ni,
+        'nj': nj,
+        # GFS начинается с 0 градусов долготы, ECMWF с -180; обе сетки идут с севера на юг
+        'lon0': 0.0 if model == 'GFS' else -180.0,
+        'lat0': 90.0,
+        'dlon': 360 / ni,
+        'dlat': 180 / (nj - 1),
+        'variables': get_cube_variables(params)
+    }
+    for name in meta['variables']:
+        create_cube_variable(cube_dir, name, shape)
+    write_cube_meta(cube_dir, meta)
+    return {'dir': cube_dir, 'meta': meta, 'arrays': {}}
+
+
+def write_cube_fields(cube, param, step, fields):
+    meta = cube['meta']
+    step_index = meta['steps'].index(step)
+    for key, data in fields.items():
+        name = get_cube_variable_name(param, key)
+        array = cube['arrays'].get(name)
+        if array is None:
+            array = np.memmap(os.path.join(cube['dir'], f'{name}.f32'), dtype=np.float32, mode='r+',
+                              shape=(meta['nj'], meta['ni'], len(meta['steps'])))
+            cube['arrays'][name] = array
+        array[:, :, step_index] = np.asarray(data, dtype=np.float32).reshape(meta['nj'], meta['ni'])
+
+
+def close_forecast_cube(cube):
+    for array in cube['arrays'].values():
+        array.flush()
+    cube['arrays'] = {}
+
+
+def open_forecast_cube(model, run):
+    key = (model, run)
+    cube_dir = get_cube_dir(model, run)
+    meta_path = os.path.join(cube_dir, 'cube.json')
+    meta_mtime = os.path.getmtime(meta_path)
+    with open_cubes_lock:
+        # Пока прогон импортируется, в cube.json добавляются переменные - переоткрываем куб при его изменении
+        if key not in open_cubes or open_cubes[key]['mtime'] != meta_mtime:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            shape = (meta['nj'], meta['ni'], len(meta['steps']))
+            arrays = {name: np.memmap(os.path.join(cube_dir, f'{name}.f32'), dtype=np.float32, mode='r', shape=shape)
+                      for name in meta['variables']}
+            open_cubes[key] = {'dir': cube_dir, 'meta': meta, 'arrays': arrays, 'mtime': meta_mtime}
+        return open_cubes[key]
+
+
+def get_grid_indices(meta, lats, lons):
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+    j = np.clip(np.rint((meta['lat0'] - lats) / meta['dlat']), 0, meta['nj'] - 1).astype(np.intp)
+    i = np.rint(((lons - meta['lon0']) % 360) / meta['dlon']).astype(np.intp) % meta['ni']
+    return j, i
+
+
+# Иконки для массивов (точка, срок): условия накладываются от низшего приоритета к высшему -
+# облачность, затем туман, затем осадки
+def get_weather_icons(shape, apcp=None, cpofp=None, cloud=None, humidity=None):
+    icon_length = max(len(icon) for icon in weather_condition_mapping.values())
+    icons = np.full(shape, weather_condition_mapping['clear'], dtype=f'<U{icon_length}')
+    if cloud is not None:
+        icons[...] = weather_condition_mapping['brokenClouds']
+        for threshold, name in reversed(CLOUD_THRESHOLDS):
+            icons[cloud < threshold] = weather_condition_mapping[name]
+    if humidity is not None:
+        icons[humidity >= MIST_HUMIDITY] = weather_condition_mapping['mist']
+    if apcp is not None:
+        icons[apcp > PRECIPITATION_THRESHOLD] = weather_condition_mapping['rain']
+        icons[apcp >= SHOWER_THRESHOLD] = weather_condition_mapping['showerRain']
+        if cpofp is not None:
+            icons[(apcp > PRECIPITATION_THRESHOLD) & (cpofp >= FROZEN_PERCENT_THRESHOLD)] = weather_condition_mapping['snow']
+    return icons
+
+
+# Временные ряды для набора точек: {название из parameter_mapping: массив (точка, срок)}
+def query_points(model, run, lats, lons):
+    cube = open_forecast_cube(model, run)
+    meta = cube['meta']
+    j, i = get_grid_indices(meta, lats, lons)
+    values = {name: np.asarray(array[j, i, :]) for name, array in cube['arrays'].items()}
+
+    result = {'valid_times': meta['valid_times']}
+    for name, series in values.items():
+        if name in ('WIND.u', 'WIND.v', 'APCP.cpofp'):
+            continue
+        result[parameter_mapping.get(name.split('.')[0], name)] = series
+    if 'WIND.u' in values and 'WIND.v' in values:
+        speed_name, degree_name = parameter_mapping['WIND'].split(', ')
+        u, v = values['WIND.u'], values['WIND.v']
+        result[speed_name] = np.sqrt(u * u + v * v)
+        # Метеорологическое направление: откуда дует ветер, по часовой от севера
+        result[degree_name] = (np.degrees(np.arctan2(-u, -v)) + 360) % 360
+
+    apcp = values.get('APCP.apcp')
+    cloud = values.get('TCDC')
+    if apcp is not None or cloud is not None:
+        cpofp = values.get('APCP.cpofp')
+        humidity = values.get('RH')
+        result['weather_icon'] = get_weather_icons((len(j), len(meta['steps'])), apcp, cpofp, cloud, humidity)
+    return result
+
+
+def query_point(model, run, lat, lon):
+    points = query_points(model, run, [lat], [lon])
+    return {name: series if name == 'valid_times' else series[0].tolist() for name, series in points.items()}
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 5:
+        print("Использование: python forecast_cube.py MODEL RUN LAT LON")
+    else:
+        print(json.dumps(query_point(sys.argv[1], sys.argv[2], float(sys.argv[3]), float(sys.argv[4])), indent=2))
@@ -2,6 +2,8 @@ from osgeo import gdal, osr
 import numpy as np
 import sys
 import subprocess
+from resample_plan import source_row_index, source_col_index
+from utils import get_strip_rows
 from config import *
 
 
@@ -11,6 +13,13 @@ def copy_georeferencing(grib2_dataset, tif_dataset):
     # tif_dataset.SetProjection(grib2_dataset.GetProjection())
 
 
+def to_byte_image(rgb_image):
+    if rgb_image.dtype == np.uint8:
+        return rgb_image
+    # GDAL при записи float в Byte округляет к ближайшему и обрезает по диапазону
+    return np.clip(np.floor(rgb_image + 0.5), 0, 255).astype(np.uint8)
+
+
 def rgb_to_tif(rgb_image, output_path, model):
     if rgb_image is None:
         logger.warning("Data not available for the specified parameter number.")
@@ -18,12 +27,8 @@ def rgb_to_tif(rgb_image, output_path, model):
 
     if rgb_image.ndim == 2:
         rgb_image = np.expand_dims(rgb_image, axis=-1)
-    if rgb_image.shape[2] == 1:
-        rgb_image = np.repeat(rgb_image, 3, axis=2)
-    enlarged_rgb = np.repeat(rgb_image, 2, axis=1)
-    enlarged_rgb = np.repeat(enlarged_rgb, 2, axis=0)
-
-    rows, cols, _ = enlarged_rgb.shape
+    nj, ni, bands = rgb_image.shape
+    rows, cols = nj * 2, ni * 2
 
     driver = gdal.GetDriverByName('GTiff')
 
@@ -35,23 +40,16 @@ def rgb_to_tif(rgb_image, output_path, model):
 
     geotransform = (-180, 360 / cols, 0, 90, 0, -180 / rows)
     dataset.SetGeoTransform(geotransform)
-    if model == 'GFS':
-        shifted_rgb = np.roll(enlarged_rgb, shift=-1, axis=0)
-
-        for i in range(3):
-            band = dataset.GetRasterBand(i + 1)
-            band.WriteArray(shifted_rgb[:, :cols // 2, i], xoff=cols // 2)
-
-        for i in range(3):
-            band = dataset.GetRasterBand(i + 1)
-            band.WriteArray(shifted_rgb[:, cols // 2:, i])
 
-    else:
+    # Увеличение в 2 раза и сдвиги сетки делаются индексами по полосам строк, без копий всего растра
+    cols_index = source_col_index(np.arange(cols), cols, model)
+    strip_rows = get_strip_rows(cols * bands * rgb_image.itemsize * 2)
+    for row_start in range(0, rows, strip_rows):
+        rows_index = source_row_index(np.arange(row_start, min(row_start + strip_rows, rows)), rows)
+        strip = rgb_image[rows_index][:, cols_index]
         for i in range(3):
             band = dataset.GetRasterBand(i + 1)
-            shifted_rgb = np.roll(enlarged_rgb[:, :, i], shift=-1, axis=1)
-            shifted_rgb = np.roll(shifted_rgb, shift=-1, axis=0)
-            band.WriteArray(shifted_rgb)
+            band.WriteArray(strip[:, :, min(i, bands - 1)], 0, row_start)
 
 
 def create_tiles(input_tif, output_folder, zoom_levels="0-3"):
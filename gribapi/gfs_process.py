@@ -1,3 +1,8 @@
+import functools
+import threading
+from utils import download_file, download_byte_ranges, write_file_atomic
+from grib_cache import grib_cache, get_grib_cache_key
+from grib_to_rgb import extract_grib_messages
 from config import *
 
 gfs_parameters = {
@@ -5,82 +10,223 @@ gfs_parameters = {
         'full_name': 'wind',
         'level': '10m',
         'level_request': 'lev_10_m_above_ground=on',
-        'var_request': 'var_UGRD=on&var_VGRD=on'
+        'var_request': 'var_UGRD=on&var_VGRD=on',
+        'idx_vars': ['UGRD', 'VGRD'],
+        'idx_levels': ['10 m above ground'],
+        'grib_selectors': [{'discipline': 0, 'category': 2, 'number': 2, 'level': 10},
+                           {'discipline': 0, 'category': 2, 'number': 3, 'level': 10}]
     },
     'TMP': {
         'full_name': 'temperature',
         'level': '2m',
         'level_request': 'lev_2_m_above_ground=on',
-        'var_request': 'var_TMP=on'
+        'var_request': 'var_TMP=on',
+        'idx_vars': ['TMP'],
+        'idx_levels': ['2 m above ground'],
+        'grib_selectors': [{'discipline': 0, 'category': 0, 'number': 0, 'level': 2}]
     },
     'APCP': {
         'full_name': 'total precipitation',
         'level': 'surface',
         'level_request': 'lev_surface=on',
-        'var_request': 'var_APCP=on'
+        'var_request': 'var_APCP=on',
+        'idx_vars': ['APCP'],
+        'idx_levels': ['surface'],
+        'grib_selectors': [{'discipline': 0, 'category': 1, 'number': 8, 'level': 0}]
     },
     'TCDC': {
         'full name': 'cloud',
         'level': 'entire atmosphere',
         'level_request': 'lev_entire_atmosphere=on',
-        'var_request': 'var_TCDC=on'
+        'var_request': 'var_TCDC=on',
+        'idx_vars': ['TCDC'],
+        'idx_levels': ['entire atmosphere'],
+        'grib_selectors': [{'discipline': 0, 'category': 6, 'number': 1, 'level': 0}]
     },
     'RH': {
         'full_name': 'relative humidity',
         'level': '2m',
         'level_request': 'lev_2_m_above_ground=on',
-        'var_request': 'var_RH=on'
+        'var_request': 'var_RH=on',
+        'idx_vars': ['RH'],
+        'idx_levels': ['2 m above ground'],
+        'grib_selectors': [{'discipline': 0, 'category': 1, 'number': 1, 'level': 2}]
     },
     'PRES': {
         'full_name': 'pressure',
         'level': 'mean sea level',
         'level_request': 'lev_mean_sea_level=on',
-        'var_request': 'var_PRMSL=on'
+        'var_request': 'var_PRMSL=on',
+        'idx_vars': ['PRMSL'],
+        'idx_levels': ['mean sea level'],
+        'grib_selectors': [{'discipline': 0, 'category': 3, 'number': 1, 'level': 0}]
     },
     'WEATHER_ICON': {
         'full_name': 'additional to total_precipitation',
         'level': 'surface',
         'level_request': 'lev_surface=on&lev_entire_atmosphere=on',
-        'var_request': 'var_CPOFP=on&var_TCDC=on'
+        'var_request': 'var_CPOFP=on&var_TCDC=on',
+        'idx_vars': ['CPOFP', 'TCDC'],
+        'idx_levels': ['surface', 'entire atmosphere'],
+        'grib_selectors': [{'discipline': 0, 'category': 1, 'number': 39, 'level': 0},
+                           {'discipline': 0, 'category': 6, 'number': 1, 'level': 0}]
     }
 }
 
 
+idx_inventory_cache = {}
+idx_inventory_lock = threading.Lock()
+
+
+# Параметр или список параметров для общего запроса: переменные и уровни объединяются
+def get_gfs_parameter(parameter):
+    if isinstance(parameter, str):
+        return gfs_parameters[parameter]
+    parts = [gfs_parameters[name] for name in parameter]
+    return {
+        'var_request': '&'.join(dict.fromkeys(item for part in parts for item in part['var_request'].split('&'))),
+        'level_request': '&'.join(dict.fromkeys(item for part in parts for item in part['level_request'].split('&'))),
+        'idx_vars': list(dict.fromkeys(item for part in parts for item in part['idx_vars'])),
+        'idx_levels': list(dict.fromkeys(item for part in parts for item in part['idx_levels'])),
+        'grib_selectors': [selector for part in parts for selector in part['grib_selectors']]
+    }
+
+
 def create_gfs_request(step, parameter, date, time='00'):
     if isinstance(step, int):
         format_step = "f{:03d}".format(step)
     else:
         format_step = "f{:03d}".format(int(step)) if str(step).isdigit() else step
 
+    if GFS_FETCH_MODE == 'idx':
+        return {
+            'url': f'{GFS_DATA_URL}/gfs.{date}/{time}/atmos/gfs.t{time}z.pgrb2.0p25.{format_step}',
+            'parameter': parameter,
+            'cycle': f'{date}{time}'
+        }
+
     url_dir = f'dir=%2Fgfs.{date}%2F{time}%2Fatmos'
 
     file_url = f'file=gfs.t{time}z.pgrb2.0p25.{format_step}'
-    var_url = gfs_parameters[parameter]['var_request']
-    level_url = gfs_parameters[parameter]['level_request']
+    var_url = get_gfs_parameter(parameter)['var_request']
+    level_url = get_gfs_parameter(parameter)['level_request']
 
     url = f'{GFS_URL}?{url_dir}&{file_url}&{var_url}&{level_url}'
     return url
 
 
+def parse_idx_inventory(text):
+    # Строка .idx: 1:0:d=2023120800:PRMSL:mean sea level:anl:
+    inventory = []
+    for line in text.splitlines():
+        fields = line.split(':')
+        if len(fields) >= 5:
+            inventory.append((int(fields[1]), fields[3], fields[4]))
+    return inventory
+
+
+def get_idx_inventory(url, cycle):
+    with idx_inventory_lock:
+        cycle_cache = idx_inventory_cache.setdefault(cycle, {})
+        # Храним инвентари только текущего и предыдущего циклов
+        for old_cycle in sorted(idx_inventory_cache)[:-2]:
+            del idx_inventory_cache[old_cycle]
+        if url in cycle_cache:
+            return cycle_cache[url]
+    inventory = parse_idx_inventory(download_file(f'{url}.idx').decode())
+    with idx_inventory_lock:
+        idx_inventory_cache.setdefault(cycle, {})[url] = inventory
+    return inventory
+
+
+def get_idx_byte_ranges(inventory, variables, levels):
+    ranges = []
+    for i, (offset, variable, level) in enumerate(inventory):
+        if variable in variables and level in levels:
+            end = inventory[i + 1][0] - 1 if i + 1 < len(inventory) else None
+            if ranges and ranges[-1][1] is not None and ranges[-1][1] + 1 == offset:
+                ranges[-1] = (ranges[-1][0], end)
+            else:
+                ranges.append((offset, end))
+    return ranges
+
+
+def download_gfs_file(request, grib_file_path):
+    if not isinstance(request, dict):
+        return download_file(request, grib_file_path)
+
+    parameter = get_gfs_parameter(request['parameter'])
+    inventory = get_idx_inventory(request['url'], request['cycle'])
+    ranges = get_idx_byte_ranges(inventory, parameter['idx_vars'], parameter['idx_levels'])
+    if len(ranges) == 0:
+        raise Exception(f"В инвентаре {request['url']}.idx нет сообщений для {request['parameter']}")
+    return download_byte_ranges(request['url'], ranges, grib_file_path)
+
+
+# Файл срока GFS: параметр, а в режиме combined_gfs_requests - общий файл со всеми переменными прогона (variables)
+def create_gfs_source(date, time, step, parameter, variables=None):
+    return {'date': date, 'time': time, 'step': step, 'parameter': parameter, 'variables': variables}
+
+
+def fetch_gfs_source(source):
+    request = create_gfs_request(source['step'], source['variables'] or source['parameter'], source['date'],
+                                 source['time'])
+    temp_path = os.path.join(temp_dir, f"gfs.{source['date']}{source['time']}.f{source['step']:03d}."
+                                       f"{source['parameter']}.{os.getpid()}.{threading.get_ident()}.grib2")
+    try:
+        download_gfs_file(request, temp_path)
+        with open(temp_path, 'rb') as f:
+            return f.read()
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def download_gfs_source(source, grib_file_path):
+    key = get_grib_cache_key('GFS', f"{source['date']}{source['time']}", source['step'],
+                             source['variables'] or [source['parameter']])
+    data = grib_cache.get(key, functools.partial(fetch_gfs_source, source))
+    if source['variables'] is not None:
+        data = extract_grib_messages(data, gfs_parameters[source['parameter']]['grib_selectors'])
+        if len(data) == 0:
+            raise Exception(f"В файле срока {source['step']} прогона {source['date']}{source['time']} "
+                            f"нет сообщений для {source['parameter']}")
+    return write_file_atomic(grib_file_path, data)
+
+
 def create_gfs_requests(cycle, forecast_step, weather_date, date, parameters=None):
     if parameters is None:
         parameters = ['APCP', 'TMP', 'WIND', 'RH', 'PRES', 'TCDC']
+    # Общий файл берется только для сроков текущего прогона из сетки forecast_step: их все равно скачивают все параметры
+    variables = None
+    if grib_cache_combined_gfs_requests:
+        variables = sorted(set(parameters) | ({'WEATHER_ICON'} if 'APCP' in parameters else set()))
+    grid_steps = set(range(0, MAX_FORECAST_STEP + 1, forecast_step))
     requests = []
     for param in parameters:
         for i in range(0, MAX_FORECAST_STEP + 1, forecast_step):
             step = i
             format_cycle = "{:02d}".format(cycle)
             url_weather_date = weather_date
+            combined = variables
             if i == 0 and param == 'APCP':
                 format_cycle = "{:02d}".format((cycle - 6) % 24)
                 new_date = date - timedelta(hours=6)
                 url_weather_date = new_date.strftime('%Y%m%d')
                 step = 6
+                combined = None
             requests.append({
                 'param': param,
                 'request': create_gfs_request(step, param, url_weather_date, format_cycle),
                 'second_request': create_gfs_request(step - 3, param, url_weather_date, format_cycle) if param == 'APCP' else None,
-                'step': i
+                'step': i,
+                'sources': {
+                    'main': create_gfs_source(url_weather_date, format_cycle, step, param, combined),
+                    'second': create_gfs_source(url_weather_date, format_cycle, step - 3, param,
+                                                combined if step - 3 in grid_steps else None) if param == 'APCP' else None,
+                    'additional': create_gfs_source(weather_date, "{:02d}".format(cycle), i, 'WEATHER_ICON',
+                                                    variables) if param == 'APCP' else None
+                }
             })
 
     return requests
@@ -0,0 +1,77 @@
+import threading
+from collections import OrderedDict
+from utils import add_run_counter
+from config import *
+
+"""
+    Кэш GRIB данных в пределах цикла. Ключ - (модель, прогон файла, срок файла, набор переменных), значение - байты
+    скачанного файла. Один и тот же файл срока нужен нескольким единицам работы (APCP за step - 3 совпадает с APCP
+    предыдущего срока, TCDC входит в WEATHER_ICON, в режиме combined_gfs_requests все параметры срока берутся из
+    одного файла), поэтому он скачивается один раз, а остальные запросы получают его из памяти.
+    Объем ограничен grib_cache.max_mb, вытесняются давно не использованные файлы. После прогона его файлы удаляются.
+"""
+
+
+class GribCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.loading = {}
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def count(self, name):
+        # Общий счетчик процесса и счетчик прогона, для которого работает поток (utils.counting_run_events)
+        self.stats[name] += 1
+        add_run_counter(f'grib_cache_{name}', 1)
+
+    def get(self, key, fetch):
+        while True:
+            with self.lock:
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                    self.count('hits')
+                    return self.entries[key]
+                event = self.loading.get(key)
+                if event is None:
+                    # Файл скачивает первый запросивший поток, остальные ждут его
+                    event = self.loading[key] = threading.Event()
+                    self.count('misses')
+                    break
+            event.wait()
+
+        try:
+            data = fetch()
+            self.put(key, data)
+            return data
+        finally:
+            # Если скачать не удалось, ожидающий поток повторит попытку сам
+            with self.lock:
+                del self.loading[key]
+            event.set()
+
+    def put(self, key, data):
+        with self.lock:
+            if key in self.entries:
+                self.size -= len(self.entries.pop(key))
+            if len(data) > self.max_bytes:
+                return
+            self.entries[key] = data
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.count('evictions')
+
+    def remove_run(self, model, run):
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == model and key[1] == run]:
+                self.size -= len(self.entries.pop(key))
+
+
+grib_cache = GribCache(grib_cache_max_mb * 1024 * 1024)
+
+
+def get_grib_cache_key(model, run, step, variables):
+    return model, run, int(step), tuple(variables)
@@ -1,95 +1,246 @@
+import mmap
 import random
+import time
+from collections import namedtuple
 from config import *
 import eccodes
 import numpy as np
 
+GribKey = namedtuple('GribKey', ['discipline', 'category', 'number', 'level', 'step'])
 
+# Суммарное время декодирования GRIB в текущем процессе; прогон передает свой словарь из RunMetrics
+decode_stats = {'files': 0, 'fields': 0, 'seconds': 0.0}
 
-def read_grib_data(file_path, parameter_number=None):
-    with open(file_path, 'rb') as file:
-        codes = eccodes.codes_grib_new_from_file(file)
 
-        while codes is not None:
-            if parameter_number is None or eccodes.codes_get(codes, 'parameterNumber') == parameter_number:
+def iter_grib_messages(buffer):
+    offset = buffer.find(b'GRIB')
+    while offset != -1 and offset + 16 <= len(buffer):
+        if buffer[offset + 7] == 2:
+            length = int.from_bytes(buffer[offset + 8:offset + 16], 'big')
+        else:
+            length = int.from_bytes(buffer[offset + 4:offset + 7], 'big')
+        if length <= 0:
+            break
+        yield offset, length
+        offset = buffer.find(b'GRIB', offset + length)
+
+
+def get_grib_key(codes):
+    return GribKey(eccodes.codes_get(codes, 'discipline', int),
+                   eccodes.codes_get(codes, 'parameterCategory', int),
+                   eccodes.codes_get(codes, 'parameterNumber', int),
+                   eccodes.codes_get(codes, 'level', int),
+                   eccodes.codes_get(codes, 'endStep', int))
+
+
+def match_grib_key(key, selector):
+    return all(getattr(key, name) == value for name, value in selector.items())
+
+
+# Сообщения из GRIB данных, подходящие хотя бы под один селектор, в исходном порядке
+def extract_grib_messages(data, selectors):
+    parts = []
+    for offset, length in iter_grib_messages(data):
+        codes = eccodes.codes_new_from_message(data[offset:offset + length])
+        try:
+            key = get_grib_key(codes)
+        finally:
+            eccodes.codes_release(codes)
+        if any(match_grib_key(key, selector) for selector in selectors):
+            parts.append(data[offset:offset + length])
+    return b''.join(parts)
+
+
+def build_grib_index(file_path):
+    index = {}
+    with open(file_path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        for offset, length in iter_grib_messages(buffer):
+            codes = eccodes.codes_new_from_message(buffer[offset:offset + length])
+            try:
+                index.setdefault(get_grib_key(codes), (offset, length))
+            finally:
+                eccodes.codes_release(codes)
+    return index
+
+
+# Один проход по файлу: для каждого селектора декодируется первое подходящее сообщение.
+# selectors - {имя: {'category': 2, 'number': 2, ...}}. buffers - словарь float32 массивов, переиспользуемых
+# между вызовами: поле копируется в buffers[имя] (массив создается или увеличивается при необходимости),
+# поэтому возвращенные поля действительны только до следующего чтения с тем же словарем.
+def read_grib_fields(file_path, selectors, buffers=None, stats=None):
+    stats = decode_stats if stats is None else stats
+    start_time = time.time()
+    fields = {name: None for name in selectors}
+    remaining = dict(selectors)
+    with open(file_path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        for offset, length in iter_grib_messages(buffer):
+            if not remaining:
+                break
+            codes = eccodes.codes_new_from_message(buffer[offset:offset + length])
+            try:
+                key = get_grib_key(codes)
+                matched = [name for name, selector in remaining.items() if match_grib_key(key, selector)]
+                if not matched:
+                    continue
                 ni = eccodes.codes_get(codes, 'Ni')
                 nj = eccodes.codes_get(codes, 'Nj')
-                data = eccodes.codes_get_values(codes)
+                values = eccodes.codes_get_values(codes, np.float32)
+                for name in matched:
+                    data = values
+                    if buffers is not None:
+                        if name not in buffers or buffers[name].size < values.size:
+                            buffers[name] = np.empty(values.size, dtype=np.float32)
+                        data = buffers[name][:values.size]
+                        np.copyto(data, values)
+                    fields[name] = (data, ni, nj)
+                    del remaining[name]
+            finally:
                 eccodes.codes_release(codes)
-                return data, ni, nj
 
-            eccodes.codes_release(codes)
-            codes = eccodes.codes_grib_new_from_file(file)
-        file.close()
-    return None
+    elapsed = time.time() - start_time
+    stats['files'] += 1
+    stats['fields'] += len(selectors) - len(remaining)
+    stats['seconds'] += elapsed
+    logger.debug(f"Декодирование {file_path} ({len(selectors) - len(remaining)} полей) заняло {elapsed:.3f} секунд")
+    return fields
 
 
-def encode_data(data, max_value, min_value):
-    return np.clip((data - min_value) / (max_value - min_value), 0, 1)
+def read_grib_data(file_path, parameter_number=None, buffers=None, stats=None, name='data'):
+    selector = {} if parameter_number is None else {'number': parameter_number}
+    return read_grib_fields(file_path, {name: selector}, buffers, stats)[name]
 
 
-def encode_data_to_rgb(data, ni, nj, data_name, model):
-    if data is None:
-        return None
+def interpolate_fields(previous_fields, fields, weight):
+    blended = {}
+    for key, data in fields.items():
+        values = np.subtract(data, previous_fields[key], dtype=np.float32)
+        values *= weight
+        values += previous_fields[key]
+        blended[key] = values
+    return blended
 
-    if data_name == 'TMP':
-        red_channel = encode_data(data, TEMP_MAX, TEMP_MIN) * 255
-        green_channel = np.where(data < 273, random.randint(50, 60), random.randint(70, 80))
-        blue_channel = np.clip(data / 273, 0, 1) * 255
-
-    elif data_name == 'RH':
-        red_channel = encode_data(data, HUMIDITY_MAX, 0) * 255
-        green_channel = np.clip(data / 6, 0, 1) * 255
-        blue_channel = np.clip(data / 50, 0, 1) * 255
-
-    elif data_name == 'PRES':
-        red_channel = encode_data(data, PRES_MAX, PRES_MIN) * 255
-        green_channel = np.clip(data / PRES_MIN, 0, 1) * 255
-        blue_channel = np.clip(data / PRES_MIN, 0, 1) * 255
-
-    elif data_name == 'TCDC':
-        red_channel = encode_data(data, CLOUD_MAX, 0) * 255
-        green_channel = np.clip(data / 40, 0, 1) * 255
-        blue_channel = np.clip(data / 20, 0, 1) * 255
-    else:
-        return None
 
-    rgb_image = np.stack([red_channel, green_channel, blue_channel], axis=-1)
-    rgb_image = rgb_image.reshape(nj, ni, 3)
-    return rgb_image
+# Правила кодирования каналов R, G, B: (входной массив, способ, параметры)
+#   scale     - clip((x - min) / (max - min), 0, 1) * 255
+#   ratio     - clip(x / divisor, 0, 1) * 255
+#   jitter    - случайное значение 50..60 при x < threshold, иначе 70..80
+#   at_least  - 255 при x >= threshold, иначе 0
+#   above     - 255 при x > threshold, иначе 0
+ENCODING_RULES = {
+    'TMP': [('data', 'scale', TEMP_MIN, TEMP_MAX), ('data', 'jitter', 273), ('data', 'ratio', 273)],
+    'RH': [('data', 'scale', 0, HUMIDITY_MAX), ('data', 'ratio', 6), ('data', 'ratio', 50)],
+    'PRES': [('data', 'scale', PRES_MIN, PRES_MAX), ('data', 'ratio', PRES_MIN), ('data', 'ratio', PRES_MIN)],
+    'TCDC': [('data', 'scale', 0, CLOUD_MAX), ('data', 'ratio', 40), ('data', 'ratio', 20)],
+    'WIND': [('direction', 'jitter', 0), ('abs_direction', 'ratio', np.pi), ('speed', 'ratio', WIND_MAX)],
+    'APCP': [('apcp', 'ratio', RAIN_MAX), ('cpofp', 'at_least', FROZEN_PERCENT_THRESHOLD), ('apcp', 'above', 15)],
+}
 
+jitter_random = random.Random(encoding_seed)
 
-def encode_wind_to_rgb(u_data, v_data, ni, nj):
-    if u_data is None or v_data is None:
-        return None
 
-    wind_speed = np.sqrt(u_data ** 2 + v_data ** 2)
-    wind_direction = np.arctan2(v_data, u_data)
+def encode_data(data, max_value, min_value):
+    return np.clip((data - min_value) / (max_value - min_value), 0, 1)
+
 
-    normalized_direction = np.clip(abs(wind_direction) / np.pi, 0, 1)
-    normalized_speed = np.clip(wind_speed / 40.0, 0, 1)
+# Пишет каналы сразу в uint8 массив (nj, ni, 3) с тем же округлением, что делал GDAL при записи float в Byte
+def encode_channels(rules, inputs, ni, nj, out=None, rng=None):
+    if out is None:
+        out = np.empty((nj, ni, 3), dtype=np.uint8)
+    if rng is None:
+        rng = jitter_random
+    pixels = out.reshape(-1, 3)
+    scratch = np.empty(ni * nj, dtype=np.float64)
+    mask = np.empty(ni * nj, dtype=bool)
+
+    for channel, (source, kind, *args) in enumerate(rules):
+        data = inputs[source]
+        target = pixels[:, channel]
+        if kind == 'jitter':
+            low, high = rng.randint(50, 60), rng.randint(70, 80)
+            np.less(data, args[0], out=mask)
+            target.fill(high)
+            np.copyto(target, low, where=mask)
+            continue
+        if kind in ('at_least', 'above'):
+            compare = np.greater_equal if kind == 'at_least' else np.greater
+            compare(data, args[0], out=mask)
+            np.multiply(mask, np.uint8(255), out=target)
+            continue
+
+        # Поля декодируются во float32, а считать нужно в float64, как исходный кодировщик:
+        # без dtype numpy выбрал бы float32 цикл по типу входа, и часть пикселей округлилась бы иначе
+        if kind == 'scale':
+            min_value, max_value = args
+            np.subtract(data, min_value, out=scratch, dtype=np.float64)
+            np.divide(scratch, max_value - min_value, out=scratch)
+        else:
+            np.divide(data, args[0], out=scratch, dtype=np.float64)
+        np.clip(scratch, 0, 1, out=scratch)
+        np.multiply(scratch, 255, out=scratch)
+        np.add(scratch, 0.5, out=scratch)
+        np.floor(scratch, out=scratch)
+        np.copyto(target, scratch, casting='unsafe')
+    return out
+
+
+def encode_data_to_rgb(data, ni, nj, data_name, model, out=None, rng=None):
+    if data is None or data_name not in ENCODING_RULES:
+        return None
+    return encode_channels(ENCODING_RULES[data_name], {'data': data}, ni, nj, out, rng)
 
-    red_channel = np.where(wind_direction < 0, random.randint(50, 60), random.randint(70, 80))
-    red_channel = np.broadcast_to(red_channel, normalized_direction.shape)
-    green_channel = normalized_direction * 255
-    blue_channel = normalized_speed * 255
 
-    rgb_image = np.stack([red_channel, green_channel, blue_channel], axis=-1)
+def encode_wind_to_rgb(u_data, v_data, ni, nj, out=None, rng=None):
+    if u_data is None or v_data is None:
+        return None
 
-    # Reshape the image
-    rgb_image = rgb_image.reshape(nj, ni, 3)
+    wind_speed = np.empty(ni * nj, dtype=np.float64)
+    wind_direction = np.empty(ni * nj, dtype=np.float64)
+    np.multiply(u_data, u_data, out=wind_speed, dtype=np.float64)
+    np.multiply(v_data, v_data, out=wind_direction, dtype=np.float64)
+    np.add(wind_speed, wind_direction, out=wind_speed)
+    np.sqrt(wind_speed, out=wind_speed)
+    np.arctan2(v_data, u_data, out=wind_direction, dtype=np.float64)
 
-    return rgb_image
+    inputs = {'speed': wind_speed, 'direction': wind_direction, 'abs_direction': np.abs(wind_direction)}
+    return encode_channels(ENCODING_RULES['WIND'], inputs, ni, nj, out, rng)
 
 
-def encode_precipitation_to_rgb(apcp_data, cpofp_data, ni, nj):
+def encode_precipitation_to_rgb(apcp_data, cpofp_data, ni, nj, out=None):
     if apcp_data is None or cpofp_data is None:
         return None
-    red_channel = np.clip(apcp_data / 35, 0, 1) * 255
-    green_channel = np.clip(np.where(cpofp_data >= 35, 1, 0), 0, 1) * 255
-    blue_channel = np.clip(np.where(apcp_data > 15, 1, 0), 0, 1) * 255
+    return encode_channels(ENCODING_RULES['APCP'], {'apcp': apcp_data, 'cpofp': cpofp_data}, ni, nj, out)
+
+
+def read_parameter_fields(grib_file_path, parameter, additional_grib_file=None, second_grib_file_path=None,
+                          buffers=None, stats=None):
+    if parameter == 'WIND':
+        fields = read_grib_fields(grib_file_path, {'u': {'category': 2, 'number': 2},
+                                                   'v': {'category': 2, 'number': 3}}, buffers, stats)
+        (u_data, ni, nj), (v_data, ni, nj) = fields['u'], fields['v']
+        return {'u': u_data, 'v': v_data}, ni, nj
+    elif parameter == 'APCP':
+        if additional_grib_file is None:
+            return None, None, None
+        total_precipitation, ni, nj = read_grib_data(grib_file_path, 8, buffers, stats, 'apcp')
+        total_precipitation_3_acc, ni, nj = read_grib_data(second_grib_file_path, 8, buffers, stats, 'apcp_3')
+        np.subtract(total_precipitation, total_precipitation_3_acc, out=total_precipitation)
+        frozen_precipitation_data, ni, nj = read_grib_data(additional_grib_file, 39, buffers, stats, 'cpofp')
+        return {'apcp': total_precipitation, 'cpofp': frozen_precipitation_data}, ni, nj
+    else:
+        data, ni, nj = read_grib_data(grib_file_path, buffers=buffers, stats=stats)
+        return {'data': data}, ni, nj
+
 
-    rgb_image = np.stack([red_channel, green_channel, blue_channel], axis=-1)
+def encode_parameter_fields(parameter, fields, ni, nj, model, out=None):
+    if fields is None:
+        return None
+    if parameter == 'WIND':
+        return encode_wind_to_rgb(fields['u'], fields['v'], ni, nj, out)
+    elif parameter == 'APCP':
+        return encode_precipitation_to_rgb(fields['apcp'], fields['cpofp'], ni, nj, out)
+    return encode_data_to_rgb(fields['data'], ni, nj, parameter, model, out)
 
-    rgb_image = rgb_image.reshape(nj, ni, 3)
 
-    return rgb_image
+def get_rgb_data(grib_file_path, parameter, model, additional_grib_file=None, second_grib_file_path=None):
+    fields, ni, nj = read_parameter_fields(grib_file_path, parameter, additional_grib_file, second_grib_file_path)
+    return encode_parameter_fields(parameter, fields, ni, nj, model)
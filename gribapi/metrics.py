@@ -0,0 +1,195 @@
+import contextlib
+import threading
+from config import *
+
+"""
+    Метрики прогона: время этапов (download, decode, encode, geotiff, tile), скачанные байты, записанные тайлы,
+    глубина очереди пула генерации тайлов, повторы загрузок и задержка от времени цикла (UTC) до публикации.
+    Задержка публикации фиксируется mark_published после публикации прогона; в отчете неопубликованного прогона ее нет.
+    Значения копятся по модели, параметру и сроку прогноза; в конце прогона пишутся JSON отчет
+    {metrics_reports_dir}/{model}.{run}.json и textfile для node_exporter {metrics_textfile_dir}/gribapi_{model}.prom.
+    В textfile этапы суммируются по срокам прогноза, разбивка по срокам есть только в JSON отчете.
+    Кодирование тайлов учитывается по параметру и фактическому формату (tile_encoders.py): число закодированных
+    уникальных тайлов, их байты и суммарное время кодирования.
+    Декодирование GRIB (grib_to_rgb.read_grib_fields) пишет в decode: число прочитанных файлов, полей и время.
+"""
+
+METRIC_STAGES = ['download', 'decode', 'encode', 'interpolate', 'geotiff', 'tile']
+
+
+class RunMetrics:
+    def __init__(self, model, run, cycle_time):
+        self.model = model
+        self.run = run
+        self.cycle_time = cycle_time
+        self.started = time.time()
+        self.published = None
+        self.lock = threading.Lock()
+        # (param, step) -> {'stages': {этап: секунды}, 'download_bytes': ..., 'tiles': ..., 'publish_latency': ...}
+        self.steps = {}
+        self.counters = {'retries': 0, 'resumes': 0, 'pool_queue_depth': 0, 'pool_queue_depth_max': 0,
+                         'grib_cache_hits': 0, 'grib_cache_misses': 0, 'grib_cache_evictions': 0}
+        # (param, формат) -> {'tiles': ..., 'bytes': ..., 'seconds': ...}
+        self.tile_encoding = {}
+        # передается в read_parameter_fields потоком, который декодирует поля прогона
+        self.decode = {'files': 0, 'fields': 0, 'seconds': 0.0}
+
+    def get_step(self, param, step):
+        key = (param, step)
+        if key not in self.steps:
+            self.steps[key] = {'stages': {}, 'download_bytes': 0, 'tiles': 0, 'publish_latency': None}
+        return self.steps[key]
+
+    def add_stage_time(self, stage, seconds, param, step):
+        with self.lock:
+            stages = self.get_step(param, step)['stages']
+            stages[stage] = stages.get(stage, 0.0) + seconds
+
+    @contextlib.contextmanager
+    def stage_timer(self, stage, param, step):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage_time(stage, time.perf_counter() - start_time, param, step)
+
+    def add(self, name, value, param, step):
+        with self.lock:
+            self.get_step(param, step)[name] += value
+
+    def add_counter(self, name, value):
+        with self.lock:
+            self.counters[name] += value
+
+    def add_tile_encoding(self, param, tile_format, stats):
+        with self.lock:
+            totals = self.tile_encoding.setdefault((param, tile_format), {'tiles': 0, 'bytes': 0, 'seconds': 0.0})
+            for name in totals:
+                totals[name] += stats[name]
+
+    def task_submitted(self):
+        with self.lock:
+            self.counters['pool_queue_depth'] += 1
+            self.counters['pool_queue_depth_max'] = max(self.counters['pool_queue_depth_max'],
+                                                        self.counters['pool_queue_depth'])
+
+    def task_finished(self, param, step, published=True):
+        with self.lock:
+            self.counters['pool_queue_depth'] -= 1
+            if published:
+                self.get_step(param, step)['publish_latency'] = (datetime.utcnow() - self.cycle_time).total_seconds()
+
+    def mark_published(self):
+        self.published = datetime.utcnow()
+
+    def build_report(self, status):
+        with self.lock:
+            steps = [{'param': param, 'step': step, **values} for (param, step), values in sorted(self.steps.items())]
+            counters = dict(self.counters)
+            tile_encoding = [{'param': param, 'format': tile_format, **values}
+                             for (param, tile_format), values in sorted(self.tile_encoding.items())]
+            decode = dict(self.decode)
+        stage_totals = {stage: sum(item['stages'].get(stage, 0.0) for item in steps) for stage in METRIC_STAGES}
+        return {
+            'model': self.model,
+            'run': self.run,
+            'status': status,
+            'started': datetime.fromtimestamp(self.started).isoformat(timespec='seconds'),
+            'duration_seconds': time.time() - self.started,
+            'publish_latency_seconds': (None if self.published is None
+                                        else (self.published - self.cycle_time).total_seconds()),
+            'stage_seconds': stage_totals,
+            'slowest_stage': max(stage_totals, key=stage_totals.get) if steps else None,
+            'download_bytes': sum(item['download_bytes'] for item in steps),
+            'tiles': sum(item['tiles'] for item in steps),
+            'retries': counters['retries'],
+            'resumes': counters['resumes'],
+            'pool_queue_depth_max': counters['pool_queue_depth_max'],
+            'tile_encoding': tile_encoding,
+            'grib_decode': decode,
+            'grib_cache': {name: counters[f'grib_cache_{name}'] for name in ('hits', 'misses', 'evictions')},
+            'steps': steps
+        }
+
+    def write(self, status):
+        report = self.build_report(status)
+        try:
+            write_json_report(report)
+            write_prometheus_textfile(report)
+        except OSError as e:
+            logger.warning(f'Не удалось записать метрики прогона {self.model} {self.run}: {e}')
+        return report
+
+
+def write_text_atomic(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    with open(temp_path, 'w') as f:
+        f.write(text)
+    os.replace(temp_path, path)
+
+
+def write_json_report(report):
+    write_text_atomic(os.path.join(metrics_reports_dir, f"{report['model']}.{report['run']}.json"),
+                      json.dumps(report, indent=2))
+
+
+def format_prometheus_metric(name, help_text, samples):
+    lines = [f'# HELP {name} {help_text}', f'# TYPE {name} gauge']
+    for labels, value in samples:
+        label_text = ','.join(f'{key}="{label}"' for key, label in labels.items())
+        lines.append(f'{name}{{{label_text}}} {value}')
+    return lines
+
+
+def write_prometheus_textfile(report):
+    model = {'model': report['model']}
+    param_stages = {}
+    param_totals = {}
+    for item in report['steps']:
+        for stage, seconds in item['stages'].items():
+            param_stages[(item['param'], stage)] = param_stages.get((item['param'], stage), 0.0) + seconds
+        totals = param_totals.setdefault(item['param'], {'download_bytes': 0, 'tiles': 0})
+        totals['download_bytes'] += item['download_bytes']
+        totals['tiles'] += item['tiles']
+
+    lines = []
+    lines += format_prometheus_metric('gribapi_stage_seconds', 'Stage time of the last run, summed over forecast steps',
+                                      [(dict(model, param=param, stage=stage), seconds)
+                                       for (param, stage), seconds in sorted(param_stages.items())])
+    lines += format_prometheus_metric('gribapi_download_bytes', 'Bytes downloaded in the last run',
+                                      [(dict(model, param=param), totals['download_bytes'])
+                                       for param, totals in sorted(param_totals.items())])
+    lines += format_prometheus_metric('gribapi_tiles_written', 'Tiles written in the last run',
+                                      [(dict(model, param=param), totals['tiles'])
+                                       for param, totals in sorted(param_totals.items())])
+    lines += format_prometheus_metric('gribapi_download_retries', 'HTTP retries and resumed downloads in the last run',
+                                      [(dict(model, kind='retry'), report['retries']),
+                                       (dict(model, kind='resume'), report['resumes'])])
+    lines += format_prometheus_metric('gribapi_tile_encoded_bytes', 'Bytes of unique tiles encoded in the last run',
+                                      [(dict(model, param=item['param'], format=item['format']), item['bytes'])
+                                       for item in report['tile_encoding']])
+    lines += format_prometheus_metric('gribapi_tile_encode_seconds', 'Time spent encoding unique tiles in the last run',
+                                      [(dict(model, param=item['param'], format=item['format']), item['seconds'])
+                                       for item in report['tile_encoding']])
+    lines += format_prometheus_metric('gribapi_tiles_encoded', 'Unique tiles encoded in the last run',
+                                      [(dict(model, param=item['param'], format=item['format']), item['tiles'])
+                                       for item in report['tile_encoding']])
+    lines += format_prometheus_metric('gribapi_grib_decode_seconds', 'Time spent decoding GRIB fields in the last run',
+                                      [(model, report['grib_decode']['seconds'])])
+    lines += format_prometheus_metric('gribapi_grib_decoded_fields', 'GRIB fields decoded in the last run',
+                                      [(model, report['grib_decode']['fields'])])
+    lines += format_prometheus_metric('gribapi_grib_cache_events', 'GRIB cache hits, misses and evictions in the last run',
+                                      [(dict(model, kind=kind), count) for kind, count in report['grib_cache'].items()])
+    lines += format_prometheus_metric('gribapi_pool_queue_depth_max', 'Peak number of tile jobs waiting in the pool',
+                                      [(model, report['pool_queue_depth_max'])])
+    lines += format_prometheus_metric('gribapi_run_duration_seconds', 'Duration of the last run',
+                                      [(model, report['duration_seconds'])])
+    lines += format_prometheus_metric('gribapi_publish_latency_seconds', 'Time from cycle time to publish of the last run',
+                                      [(model, report['publish_latency_seconds'])]
+                                      if report['publish_latency_seconds'] is not None else [])
+    lines += format_prometheus_metric('gribapi_run_success', 'Whether the last run finished without errors',
+                                      [(model, 1 if report['status'] == 'success' else 0)])
+    lines += format_prometheus_metric('gribapi_last_run_timestamp_seconds', 'Unix time the last run finished',
+                                      [(model, round(time.time()))])
+    write_text_atomic(os.path.join(metrics_textfile_dir, f"gribapi_{report['model'].lower()}.prom"), '\n'.join(lines) + '\n')
@@ -0,0 +1,267 @@
+import contextlib
+import fcntl
+import threading
+import uuid
+from tile_archive import read_archive_metadata
+from tile_encoders import get_tile_format, get_tile_extension
+from config import *
+
+"""
+    Публикация прогонов и хранение тайлов.
+    Пока прогон модели идет, тайлы пишутся в {staging_dir}/{model}.{run}/{valid}/{param} - клиенты их не видят.
+    После завершения прогона каждый {valid}/{param} (папка, .mbtiles, .source.npy) переносится в
+    {tiles_path}/ecmwf/{run}/{valid}/ через os.rename, а затем атомарно обновляется манифест manifest_path:
+        {"updated": ..., "runs": {run: {"valid_times": [...], "models": {model: {"published": ...,
+            "valid_times": [...], "params": {param: {"format": "png", "extension": "png", "zooms": [0, 3]}}}}}},
+         "holds": {run: "YYYYMMDDHH"}}
+    Клиенты узнают о прогоне одним запросом манифеста, только после того как все его тайлы на месте.
+    GFS и ECMWF пишут в общее дерево ecmwf/{run}, поэтому публикуется прогон модели, а не папка прогона целиком.
+
+    Хранение: прогоны старше retention.days (по времени прогона из манифеста) сначала убираются из манифеста,
+    затем их папки переносятся в trash_dir, а удаляются в фоновом потоке не быстрее max_deletes_per_second файлов.
+    Пока прогон модели идет (в сервисе или в backfill.py), он держит разделяемую flock блокировку
+    {staging_dir}/.{model}.{run}.lock; staging, чью блокировку взять не удалось, очистка не трогает.
+    holds - прогоны, которые очистка не трогает до указанного времени (UTC) независимо от retention.days:
+    их ставит backfill.py, чтобы догруженные старые прогоны не снимались с публикации при ближайшей очистке.
+"""
+
+manifest_lock = threading.Lock()
+trash_lock = threading.Lock()
+trash_thread = None
+
+
+def get_run_name(date, cycle):
+    return f'{date.strftime("%Y%m%d")}{"{:02d}".format(cycle)}'
+
+
+def get_staging_run_dir(model, run):
+    return os.path.join(publishing_staging_dir, f'{model}.{run}')
+
+
+def get_live_run_dir(run):
+    return os.path.join(tiles_path, 'ecmwf', run)
+
+
+def get_staging_lock_path(name):
+    return os.path.join(publishing_staging_dir, f'.{name}.lock')
+
+
+# flock на файле блокировки; после блокировки проверяется, что файл не удалили и не пересоздали,
+# иначе блокировка держалась бы на уже ненужном inode
+def lock_file(path, operation):
+    while True:
+        f = open(path, 'a')
+        try:
+            fcntl.flock(f, operation)
+            if os.path.exists(path) and os.stat(path).st_ino == os.fstat(f.fileno()).st_ino:
+                return f
+        except BlockingIOError:
+            f.close()
+            return None
+        except BaseException:
+            f.close()
+            raise
+        f.close()
+
+
+@contextlib.contextmanager
+def staging_run_lock(model, run):
+    os.makedirs(publishing_staging_dir, exist_ok=True)
+    f = lock_file(get_staging_lock_path(f'{model}.{run}'), fcntl.LOCK_SH)
+    try:
+        yield
+    finally:
+        f.close()
+
+
+def load_tiles_manifest():
+    try:
+        with open(publishing_manifest_path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'updated': None, 'runs': {}}
+    except ValueError as e:
+        logger.error(f'Манифест тайлов {publishing_manifest_path} поврежден, он будет собран заново: {e}')
+        return {'updated': None, 'runs': {}}
+
+
+def save_tiles_manifest(manifest):
+    manifest['updated'] = datetime.now().isoformat(timespec='seconds')
+    os.makedirs(os.path.dirname(os.path.abspath(publishing_manifest_path)), exist_ok=True)
+    temp_path = f'{publishing_manifest_path}.{os.getpid()}.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(manifest, f, separators=(',', ':'))
+    os.replace(temp_path, publishing_manifest_path)
+
+
+def update_tiles_manifest(update):
+    # Манифест обновляют сервис и backfill.py в разных процессах: чтение-изменение-запись идет под flock
+    # на {manifest_path}.lock, внутри процесса потоки дополнительно упорядочены manifest_lock
+    os.makedirs(os.path.dirname(os.path.abspath(publishing_manifest_path)), exist_ok=True)
+    with manifest_lock, open(f'{publishing_manifest_path}.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        manifest = load_tiles_manifest()
+        update(manifest)
+        save_tiles_manifest(manifest)
+
+
+def is_run_published(model, run, manifest=None):
+    manifest = load_tiles_manifest() if manifest is None else manifest
+    return model in manifest['runs'].get(run, {}).get('models', {})
+
+
+# Защищает прогоны от очистки до until (UTC)
+def hold_runs(runs, until):
+    until = until.strftime('%Y%m%d%H')
+
+    def add_holds(manifest):
+        holds = manifest.setdefault('holds', {})
+        for run in runs:
+            holds[run] = max(holds.get(run, ''), until)
+
+    update_tiles_manifest(add_holds)
+
+
+def move_to_trash(path, name):
+    os.makedirs(publishing_trash_dir, exist_ok=True)
+    os.rename(path, os.path.join(publishing_trash_dir, f'{name}.{uuid.uuid4().hex[:8]}'))
+
+
+def describe_param(param, path):
+    tile_format = get_tile_format(param.upper())
+    if path.endswith('.mbtiles'):
+        metadata = read_archive_metadata(path)
+        zooms = [int(metadata['minzoom']), int(metadata['maxzoom'])]
+    else:
+        levels = sorted(int(name) for name in os.listdir(path) if name.isdigit())
+        zooms = [levels[0], levels[-1]] if levels else []
+    return {'format': tile_format, 'extension': get_tile_extension(tile_format), 'zooms': zooms}
+
+
+def publish_run(model, run):
+    staging_dir = get_staging_run_dir(model, run)
+    live_dir = get_live_run_dir(run)
+    valid_times = []
+    params = {}
+    if os.path.isdir(staging_dir):
+        for valid in sorted(os.listdir(staging_dir)):
+            if valid.startswith('.'):
+                continue
+            os.makedirs(os.path.join(live_dir, valid), exist_ok=True)
+            for name in os.listdir(os.path.join(staging_dir, valid)):
+                source = os.path.join(staging_dir, valid, name)
+                target = os.path.join(live_dir, valid, name)
+                if name.endswith('.mbtiles') or os.path.isdir(source):
+                    param = name[:-len('.mbtiles')] if name.endswith('.mbtiles') else name
+                    params.setdefault(param, describe_param(param, source))
+                if os.path.lexists(target):
+                    # Повторная публикация: старая версия уходит в корзину
+                    move_to_trash(target, f'{run}.{valid}.{name}')
+                os.rename(source, target)
+            valid_times.append(valid)
+        # В staging остались только пустые папки сроков и .blobs: тайлы - жесткие ссылки, данные не теряются
+        move_to_trash(staging_dir, f'{model}.{run}.staging')
+        start_trash_cleaner()
+
+    def add_run(manifest):
+        entry = manifest['runs'].setdefault(run, {'valid_times': [], 'models': {}})
+        published = entry['models'].get(model, {'valid_times': [], 'params': {}})
+        entry['models'][model] = {
+            'published': datetime.now().isoformat(timespec='seconds'),
+            'valid_times': sorted(set(published['valid_times']) | set(valid_times)),
+            'params': dict(published['params'], **params)
+        }
+        entry['valid_times'] = sorted({valid for item in entry['models'].values() for valid in item['valid_times']})
+
+    update_tiles_manifest(add_run)
+    logger.warning(f'Прогон модели {model} {run} опубликован: {len(valid_times)} сроков, параметры {sorted(params)}')
+
+
+def trash_run_folder(path, name, removed):
+    try:
+        move_to_trash(path, name)
+        removed.append(name.rsplit('.', 1)[-1])
+    except OSError as e:
+        logger.error(f'Не удалось перенести в корзину {path}: {e}')
+
+
+def remove_old_runs(days_threshold=None):
+    days_threshold = retention_days if days_threshold is None else days_threshold
+    now = datetime.utcnow()
+    oldest = (now - timedelta(days=days_threshold)).strftime('%Y%m%d%H')
+    removed = []
+    held = set()
+
+    def remove_runs(manifest):
+        holds = manifest.setdefault('holds', {})
+        for run in [run for run, until in holds.items() if until <= now.strftime('%Y%m%d%H')]:
+            del holds[run]
+        held.update(holds)
+        for run in [run for run in manifest['runs'] if run < oldest and run not in held]:
+            del manifest['runs'][run]
+            removed.append(run)
+
+    # Сначала прогон исчезает из манифеста, потом его файлы
+    update_tiles_manifest(remove_runs)
+    # Папки прогонов без записи в манифесте (опубликованные до манифеста, брошенные staging) удаляются
+    # по времени прогона из имени: {run} в дереве тайлов и {model}.{run} в staging
+    live_root = os.path.join(tiles_path, 'ecmwf')
+    if os.path.isdir(live_root):
+        for name in os.listdir(live_root):
+            if len(name) == 10 and name.isdigit() and name < oldest and name not in held:
+                trash_run_folder(os.path.join(live_root, name), name, removed)
+    if os.path.isdir(publishing_staging_dir):
+        # Прогоны staging: папки {model}.{run} и файлы блокировок .{model}.{run}.lock уже опубликованных прогонов
+        names = {name[1:-len('.lock')] if name.startswith('.') and name.endswith('.lock') else name
+                 for name in os.listdir(publishing_staging_dir)}
+        for name in sorted(names):
+            run = name.rsplit('.', 1)[-1]
+            if not (len(run) == 10 and run.isdigit() and run < oldest) or run in held:
+                continue
+            lock_path = get_staging_lock_path(name)
+            lock = lock_file(lock_path, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            if lock is None:
+                logger.debug(f'Прогон {name} еще идет, его staging не удаляется')
+                continue
+            try:
+                path = os.path.join(publishing_staging_dir, name)
+                if os.path.lexists(path):
+                    trash_run_folder(path, name, removed)
+            finally:
+                os.remove(lock_path)
+                lock.close()
+    if removed:
+        logger.warning(f'Сняты с публикации прогоны: {sorted(set(removed))}')
+    start_trash_cleaner()
+
+
+def start_trash_cleaner():
+    global trash_thread
+    with trash_lock:
+        if trash_thread is None or not trash_thread.is_alive():
+            trash_thread = threading.Thread(target=empty_trash, daemon=True)
+            trash_thread.start()
+
+
+def empty_trash():
+    if not os.path.isdir(publishing_trash_dir):
+        return
+    deleted = 0
+    batch_start = time.monotonic()
+    for root, dirs, files in os.walk(publishing_trash_dir, topdown=False):
+        for name in files:
+            try:
+                os.remove(os.path.join(root, name))
+            except OSError as e:
+                logger.debug(f'Не удалось удалить {os.path.join(root, name)}: {e}')
+            deleted += 1
+            # Не больше max_deletes_per_second удалений в секунду, чтобы не забирать весь ввод-вывод диска
+            if deleted % retention_max_deletes_per_second == 0:
+                time.sleep(max(0.0, 1 - (time.monotonic() - batch_start)))
+                batch_start = time.monotonic()
+        if root != publishing_trash_dir:
+            try:
+                os.rmdir(root)
+            except OSError as e:
+                logger.debug(f'Не удалось удалить папку {root}: {e}')
+    logger.debug(f'Корзина тайлов очищена, удалено {deleted} файлов')
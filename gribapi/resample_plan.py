@@ -0,0 +1,95 @@
+import functools
+import numpy as np
+from config import *
+
+TILE_SIZE = 256
+resample_plans_dir = os.path.join(temp_dir, 'resample_plans')
+
+"""
+    План перепроецирования сетки модели (Ni x Nj) в пиксели Web Mercator.
+    Для каждой строки и столбца пикселей максимального зума хранятся индексы соседних узлов
+    исходной сетки и веса билинейной интерполяции. Двукратное увеличение и сдвиги сетки,
+    которые раньше делались через np.repeat и np.roll в rgb_to_tif, учтены прямо в индексах.
+    Проекция сепарабельна, поэтому план - это по три массива на ось, а не на каждый пиксель.
+"""
+
+
+def mercator_pixel_lonlat(zoom):
+    size = TILE_SIZE * 2 ** zoom
+    centers = (np.arange(size, dtype=np.float64) + 0.5) / size
+    lon = centers * 360 - 180
+    lat = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * centers))))
+    return lon, lat
+
+
+def bilinear_axis(coords, length):
+    coords = np.clip(coords, 0, length - 1)
+    lower = np.floor(coords).astype(np.intp)
+    upper = np.minimum(lower + 1, length - 1)
+    weight = (coords - lower).astype(np.float32)
+    return lower, upper, weight
+
+
+# Индекс строки исходной сетки для строки растра, увеличенного в 2 раза и сдвинутого на строку вверх
+def source_row_index(rows_index, rows):
+    return (((rows_index + 1) % rows) // 2).astype(np.int32)
+
+
+# Индекс столбца исходной сетки: сетка GFS начинается с 0 градусов долготы, ECMWF сдвинута на столбец
+def source_col_index(cols_index, cols, model):
+    col_offset = cols // 2 if model == 'GFS' else 1
+    return (((cols_index + col_offset) % cols) // 2).astype(np.int32)
+
+
+def build_resample_plan(ni, nj, model, zoom):
+    # Координаты считаются в увеличенном в 2 раза растре, как его раньше записывал rgb_to_tif
+    rows, cols = nj * 2, ni * 2
+    lon, lat = mercator_pixel_lonlat(zoom)
+    r0, r1, wy = bilinear_axis((90 - lat) / 180 * rows - 0.5, rows)
+    c0, c1, wx = bilinear_axis((lon + 180) / 360 * cols - 0.5, cols)
+    return {
+        'row0': source_row_index(r0, rows),
+        'row1': source_row_index(r1, rows),
+        'row_weight': wy,
+        'col0': source_col_index(c0, cols, model),
+        'col1': source_col_index(c1, cols, model),
+        'col_weight': wx,
+    }
+
+
+@functools.lru_cache(maxsize=16)
+def get_resample_plan(ni, nj, model, min_zoom, max_zoom):
+    plan_path = os.path.join(resample_plans_dir, f'{model}.{ni}x{nj}.z{min_zoom}-{max_zoom}.npz')
+    try:
+        with np.load(plan_path) as cached:
+            return {key: cached[key] for key in cached.files}
+    except (OSError, ValueError):
+        pass
+
+    plan = build_resample_plan(ni, nj, model, max_zoom)
+    try:
+        os.makedirs(resample_plans_dir, exist_ok=True)
+        temp_plan_path = f'{plan_path}.{os.getpid()}.npz'
+        np.savez(temp_plan_path, **plan)
+        os.replace(temp_plan_path, plan_path)
+    except OSError as e:
+        logger.warning(f'Не удалось сохранить план перепроецирования {plan_path}: {e}')
+    return plan
+
+
+def apply_resample_plan(rgb_image, plan, row_start=0, row_stop=None, col_start=0, col_stop=None):
+    rows = slice(row_start, row_stop)
+    cols = slice(col_start, col_stop)
+    top = np.take(rgb_image, plan['row0'][rows], axis=0).astype(np.float32)
+    bottom = np.take(rgb_image, plan['row1'][rows], axis=0).astype(np.float32)
+    bottom -= top
+    bottom *= plan['row_weight'][rows, None, None]
+    top += bottom
+    del bottom
+
+    left = np.take(top, plan['col0'][cols], axis=1)
+    right = np.take(top, plan['col1'][cols], axis=1)
+    right -= left
+    right *= plan['col_weight'][None, cols, None]
+    left += right
+    return left
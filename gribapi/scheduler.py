@@ -0,0 +1,169 @@
+import functools
+import threading
+from utils import get_session, host_download_slot
+from config import *
+
+"""
+    Планировщик прогонов по готовности данных вместо фиксированного расписания.
+    Каждые poll_interval_seconds для последних циклов каждой модели проверяется HEAD запросом,
+    опубликован ли нулевой срок (.idx GFS, .index ECMWF); как только он есть, цикл запускается.
+    Внутри прогона каждый срок начинает скачиваться сразу после появления своего .idx/.index (wait_for_step).
+    Циклы, запрошенные вручную (request_cycle с manual=True) и старше окна опроса lookback_hours, считаются
+    опубликованными целиком: сроки не ждут, а сразу скачиваются.
+    Один цикл одной модели не запускается дважды, повторы после ошибок идут через этот же цикл опроса,
+    а состояние хранится в scheduler_state_path, поэтому после перезапуска прерванные циклы продолжаются.
+"""
+
+
+def get_step_probe_url(model, date, step):
+    weather_date = date.strftime('%Y%m%d')
+    weather_time = date.strftime('%H')
+    if model == 'GFS':
+        return f'{GFS_DATA_URL}/gfs.{weather_date}/{weather_time}/atmos/gfs.t{weather_time}z.pgrb2.0p25.f{step:03d}.idx'
+    # Циклы 06 и 18 ECMWF публикуются в потоке scda
+    stream = 'oper' if date.hour in (0, 12) else 'scda'
+    return f'{ECMWF_URL}/{weather_date}/{weather_time}z/ifs/0p25/{stream}/{weather_date}{weather_time}0000-{step}h-{stream}-fc.index'
+
+
+def is_step_available(model, date, step):
+    url = get_step_probe_url(model, date, step)
+    try:
+        with host_download_slot(url):
+            response = get_session().head(url, timeout=10, allow_redirects=True)
+        return response.status_code == 200
+    except Exception as e:
+        logger.debug(f'Не удалось проверить готовность данных {url}: {e}')
+        return False
+
+
+def get_run_key(model, date):
+    return f"{model}.{date.strftime('%Y%m%d%H')}"
+
+
+class CycleScheduler:
+    def __init__(self, run_cycle, state_path=scheduler_state_path):
+        # run_cycle(cycle, date, model, wait_for_step) -> True, если прогон завершился без ошибок
+        self.run_cycle = run_cycle
+        self.state_path = state_path
+        self.lock = threading.Lock()
+        self.active = {}
+        self.state = self.load_state()
+        for entry in self.state.values():
+            if entry['status'] == 'running':
+                # Прогон прерван перезапуском - продолжаем его при ближайшем опросе
+                entry['status'] = 'pending'
+                entry['next_attempt'] = 0
+        self.save_state()
+
+    def load_state(self):
+        try:
+            with open(self.state_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError as e:
+            logger.error(f'Состояние планировщика {self.state_path} повреждено, начинаем с пустого: {e}')
+            return {}
+
+    def save_state(self):
+        with self.lock:
+            # Старые завершенные циклы из состояния не нужны
+            oldest = (datetime.utcnow() - timedelta(hours=scheduler_lookback_hours * 2)).strftime('%Y%m%d%H')
+            for key in [key for key, entry in self.state.items()
+                        if entry['date'] < oldest and entry['status'] in ('done', 'failed')]:
+                del self.state[key]
+            os.makedirs(os.path.dirname(os.path.abspath(self.state_path)), exist_ok=True)
+            temp_path = f'{self.state_path}.{os.getpid()}.tmp'
+            with open(temp_path, 'w') as f:
+                json.dump(self.state, f, indent=2)
+            os.replace(temp_path, self.state_path)
+
+    def update_entry(self, key, **values):
+        with self.lock:
+            self.state[key].update(values, updated=datetime.now().isoformat(timespec='seconds'))
+        self.save_state()
+
+    def request_cycle(self, model, date, manual=False):
+        key = get_run_key(model, date)
+        wait_steps = not manual or date >= datetime.utcnow() - timedelta(hours=scheduler_lookback_hours)
+        with self.lock:
+            entry = self.state.get(key)
+            if (entry is not None and entry['status'] in ('running', 'pending')) or key in self.active:
+                return
+            self.state[key] = {'model': model, 'date': date.strftime('%Y%m%d%H'), 'status': 'pending',
+                               'attempts': 0, 'next_attempt': 0, 'available_steps': [], 'wait_steps': wait_steps}
+        self.update_entry(key)
+
+    def get_recent_cycles(self):
+        now = datetime.utcnow()
+        latest = now.replace(hour=now.hour - now.hour % 6, minute=0, second=0, microsecond=0)
+        return [latest - timedelta(hours=hours) for hours in range(0, scheduler_lookback_hours + 1, 6)]
+
+    def poll(self):
+        for model in scheduler_models:
+            for date in self.get_recent_cycles():
+                key = get_run_key(model, date)
+                with self.lock:
+                    entry = self.state.get(key)
+                if entry is None and is_step_available(model, date, 0):
+                    logger.warning(f'Данные модели {model} для цикла {date.strftime("%Y-%m-%d %H")}:00 опубликованы')
+                    self.request_cycle(model, date)
+
+        with self.lock:
+            # Разные модели идут параллельно (свои серверы, общий пул тайлов), циклы одной модели - по очереди
+            model_runs = {}
+            for key in self.active:
+                model_runs[self.state[key]['model']] = model_runs.get(self.state[key]['model'], 0) + 1
+            ready = []
+            for key, entry in sorted(self.state.items(), key=lambda item: item[1]['date']):
+                if entry['status'] != 'pending' or entry['next_attempt'] > time.time() or key in self.active:
+                    continue
+                if len(self.active) + len(ready) >= scheduler_max_concurrent_runs or \
+                        model_runs.get(entry['model'], 0) >= scheduler_max_runs_per_model:
+                    continue
+                model_runs[entry['model']] = model_runs.get(entry['model'], 0) + 1
+                ready.append(key)
+            for key in ready:
+                thread = threading.Thread(target=self.run_entry, args=(key,), daemon=True)
+                self.active[key] = thread
+        for key in ready:
+            self.active[key].start()
+
+    def wait_for_step(self, key, model, date, step, stop):
+        deadline = time.time() + scheduler_step_timeout_minutes * 60
+        while step not in self.state[key]['available_steps']:
+            if is_step_available(model, date, step):
+                with self.lock:
+                    self.state[key]['available_steps'] = sorted(set(self.state[key]['available_steps']) | {step})
+                self.save_state()
+                break
+            if time.time() > deadline:
+                raise Exception(f'Срок {step} модели {model} не опубликован за {scheduler_step_timeout_minutes} минут')
+            if stop.wait(scheduler_step_poll_seconds):
+                raise Exception(f'Прогон {key} остановлен до публикации срока {step}')
+
+    def run_entry(self, key):
+        with self.lock:
+            entry = self.state[key]
+        model = entry['model']
+        date = datetime.strptime(entry['date'], '%Y%m%d%H')
+        self.update_entry(key, status='running', attempts=entry['attempts'] + 1)
+        wait_for_step = None
+        if entry.get('wait_steps', True):
+            wait_for_step = functools.partial(self.wait_for_step, key, model, date)
+        try:
+            success = self.run_cycle(date.hour, date, model, wait_for_step)
+        except Exception as e:
+            logger.error(f'Ошибка прогона {key}: {e}', exc_info=True)
+            success = False
+        finally:
+            with self.lock:
+                del self.active[key]
+
+        if success:
+            self.update_entry(key, status='done')
+        elif self.state[key]['attempts'] >= scheduler_max_attempts:
+            logger.error(f'Превышен лимит попыток для прогона {key}')
+            self.update_entry(key, status='failed')
+        else:
+            self.update_entry(key, status='pending', next_attempt=time.time() + scheduler_retry_delay_minutes * 60)
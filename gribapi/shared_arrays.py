@@ -0,0 +1,84 @@
+import atexit
+import threading
+from multiprocessing import resource_tracker, shared_memory
+import numpy as np
+from config import *
+
+"""
+    Передача RGB массивов из главного процесса в процессы генерации тайлов через shared memory.
+    Сегмент создается и удаляется только в главном процессе, воркер лишь подключается к нему по имени.
+    Суммарный объем сегментов в работе ограничен shared_memory_budget_mb из config.yml.
+"""
+
+
+class SharedMemoryBudget:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, size):
+        with self.condition:
+            # Массив больше всего бюджета пропускаем, когда других сегментов нет
+            self.condition.wait_for(lambda: self.used == 0 or self.used + size <= self.max_bytes)
+            self.used += size
+
+    def release(self, size):
+        with self.condition:
+            self.used -= size
+            self.condition.notify_all()
+
+
+shared_memory_budget = SharedMemoryBudget(shared_memory_budget_mb * 1024 * 1024)
+active_segments = {}
+active_segments_lock = threading.Lock()
+
+
+def start_shared_memory_tracker():
+    # Трекер запускается до создания пула, чтобы воркеры использовали его же, а не заводили свои
+    resource_tracker.ensure_running()
+
+
+def create_shared_array(shape, dtype, budget=shared_memory_budget):
+    size = max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1)
+    budget.acquire(size)
+    try:
+        shm = shared_memory.SharedMemory(create=True, size=size)
+    except Exception:
+        budget.release(size)
+        raise
+    with active_segments_lock:
+        active_segments[shm.name] = (shm, size, budget)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def attach_shared_array(name, shape, dtype):
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+# True, если сегмент освободил этот вызов: завершение задачи и таймаут ее ожидания не засчитываются дважды
+def release_shared_array(name, *_):
+    with active_segments_lock:
+        segment = active_segments.pop(name, None)
+    if segment is None:
+        return False
+    shm, size, budget = segment
+    try:
+        shm.close()
+        shm.unlink()
+    except FileNotFoundError:
+        pass
+    finally:
+        budget.release(size)
+    return True
+
+
+def release_all_shared_arrays():
+    with active_segments_lock:
+        names = list(active_segments)
+    for name in names:
+        release_shared_array(name)
+
+
+atexit.register(release_all_shared_arrays)
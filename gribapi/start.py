@@ -1,6 +1,5 @@
-import shutil
 import sys
-import tempfile
+import functools
 import threading
 import time
 from multiprocessing import Pool
@@ -12,6 +11,16 @@ from gdal_processes import *
 from gfs_process import *
 from ecmwf_process import *
 from grib_to_rgb import *
+from tiler import create_tiles_from_rgb
+from tile_encoders import get_tile_format
+from shared_arrays import *
+from grib_cache import grib_cache, get_grib_cache_key
+from forecast_cube import create_forecast_cube, write_cube_fields, close_forecast_cube
+from metrics import RunMetrics
+from scheduler import CycleScheduler
+from work_manifest import WorkManifest, remove_old_manifests
+from work_queue import create_work_queue, create_work_item
+from publisher import get_run_name, get_staging_run_dir, publish_run, remove_old_runs, staging_run_lock
 import math
 import traceback
 from ecmwf.opendata import Client
@@ -32,95 +41,379 @@ import contextlib
 """
 
 
-def remove_old_tiles(folder_path, days_threshold):
-    current_time = datetime.now().timestamp()
-    root_dirs = [d for d in os.listdir(folder_path) if os.path.isdir(os.path.join(folder_path, d))]
-    deleted_folders = []
-    for folder in root_dirs:
-        folder_full_path = os.path.join(folder_path, folder)
-        try:
-            folder_mtime = os.path.getmtime(folder_full_path)
-            days_difference = (current_time - folder_mtime) / (60 * 60 * 24)
-            if days_difference > days_threshold:
-                deleted_folders.append(folder_full_path)
-                shutil.rmtree(folder_full_path)
-
-        except Exception as e:
-            logger.error(f'Ошибка при удаление файлов: {e}')
-            pass
-    logger.warning(f'Удалены папки и их содержимое: {deleted_folders}')
-
+num_processors = get_worker_count()
+# шаг прогноза в часах, с которым формируются запросы прогона
+FORECAST_STEP = 6
+tile_pool = None
+tile_pool_lock = threading.Lock()
 
-num_processors = os.cpu_count()
 
+# Один пул генерации тайлов на все прогоны: модели обрабатываются одновременно, не превышая число процессов
+def get_tile_pool(processes=None):
+    global tile_pool
+    with tile_pool_lock:
+        if tile_pool is None:
+            start_shared_memory_tracker()
+            tile_pool = Pool(processes=processes or num_processors)
+        return tile_pool
 
-def run_generate_tiles_process(temp_rgb_file, temp_tiff_path, tiles_folder, temp_tiff_name, model):
-    tiff_file = f'{temp_tiff_path}/{temp_tiff_name}'
-    with open(temp_rgb_file, 'rb') as file:
-        rgb_image = np.load(file)
 
-    rgb_to_tif(rgb_image, tiff_file, model)
-    create_tiles(tiff_file, tiles_folder)
+def close_tile_pool():
+    global tile_pool
+    with tile_pool_lock:
+        if tile_pool is not None:
+            tile_pool.close()
+            tile_pool.join()
+            tile_pool = None
 
-    os.remove(temp_rgb_file)
 
-
-def download_additional_apcp_data_file(cycle, weather_date, i):
+def run_generate_tiles_process(shm_name, shape, dtype, temp_tiff_path, tiles_folder, temp_tiff_name, model,
+                               dedup_dir=None, archive_path=None, tile_format=None):
+    shm, rgb_image = attach_shared_array(shm_name, shape, dtype)
+    try:
+        return generate_tiles(rgb_image, temp_tiff_path, tiles_folder, temp_tiff_name, model, dedup_dir, archive_path,
+                              tile_format)
+    finally:
+        del rgb_image
+        shm.close()
+
+
+def generate_tiles(rgb_image, temp_tiff_path, tiles_folder, temp_tiff_name, model, dedup_dir=None, archive_path=None,
+                   tile_format=None):
+    if store_source_rasters:
+        save_source_raster(rgb_image, tiles_folder, model)
+    if tiler_mode == 'gdal2tiles':
+        tiff_file = f'{temp_tiff_path}/{temp_tiff_name}'
+        start_time = time.perf_counter()
+        rgb_to_tif(rgb_image, tiff_file, model)
+        geotiff_seconds = time.perf_counter() - start_time
+        create_tiles(tiff_file, tiles_folder)
+        tiles = sum(len(files) for _, _, files in os.walk(tiles_folder))
+        return {'tiles': tiles, 'seconds': {'geotiff': geotiff_seconds,
+                                            'tile': time.perf_counter() - start_time - geotiff_seconds}}
+    start_time = time.perf_counter()
+    stats = create_tiles_from_rgb(rgb_image, tiles_folder, model, dedup_dir=dedup_dir, archive_path=archive_path,
+                                  tile_format=tile_format)
+    stats['seconds'] = {'tile': time.perf_counter() - start_time}
+    return stats
+
+
+# RGB растр сохраняется рядом с тайлами, из него tile_server рендерит зумы глубже предрасчитанных
+def save_source_raster(rgb_image, tiles_folder, model):
+    source_path = f'{tiles_folder}.source.{model}.npy'
+    temp_path = f'{source_path}.{os.getpid()}.tmp'
+    with open(temp_path, 'wb') as f:
+        np.save(f, rgb_image)
+    os.replace(temp_path, source_path)
+
+
+# step - срок кадра, item_step - срок единицы манифеста, к которой относится кадр
+def collect_tiles_stats(shm_name, context, param, step, item_step, stats):
+    if not release_shared_array(shm_name):
+        # Задача уже признана зависшей по таймауту, единица отмечена неуспешной
+        return
+    metrics = context['metrics']
+    for stage, seconds in stats.pop('seconds').items():
+        metrics.add_stage_time(stage, seconds, param, step)
+    for tile_format, format_stats in stats.pop('formats', {}).items():
+        metrics.add_tile_encoding(param, tile_format, format_stats)
+    metrics.add('tiles', stats['tiles'], param, step)
+    metrics.task_finished(param, step)
+    context['manifest'].job_finished(param, item_step)
+    run_stats = context['run_stats']
+    with run_stats['lock']:
+        for key, value in stats.items():
+            run_stats[key] += value
+
+
+def log_tiles_process_error(shm_name, context, param, step, item_step, error):
+    if not release_shared_array(shm_name):
+        return
+    context['metrics'].task_finished(param, step, published=False)
+    context['manifest'].job_finished(param, item_step, success=False)
+    logger.error(f'Ошибка при генерации тайлов: {error}', exc_info=error)
+
+
+def download_additional_apcp_data_file(cycle, weather_date, i, grib_file_path):
     step = "f{:03d}".format(i)
     cycle = "{:02d}".format(cycle)
-    url = create_gfs_request(step, 'WEATHER_ICON', weather_date, cycle)
-    grib_file_path = os.path.join(temp_dir, f'WEATHER_ICON.{weather_date}{cycle}.grib2')
-    download_file(url, grib_file_path)
+    request = create_gfs_request(step, 'WEATHER_ICON', weather_date, cycle)
+    download_gfs_file(request, grib_file_path)
     return grib_file_path
 
 
+def get_forecast_time(date, cycle, i):
+    forecast_time = "{:02d}".format((i + cycle) % 24)
+    forecast_date = (date + timedelta(hours=i)).strftime('%Y%m%d')
+    return forecast_date, forecast_time
+
+
+# Имена файлов зависят только от прогона, параметра и срока - по ним манифест находит уже скачанные файлы
+def get_request_files(request, cycle, date, model):
+    param = request['param']
+    prefix = os.path.join(temp_dir, f"{model}.{date.strftime('%Y%m%d')}{'{:02d}'.format(cycle)}.{param}.f{request['step']:03d}")
+    return {
+        'main': f'{prefix}.grib2',
+        'second': f'{prefix}.03acc.grib2' if request['second_request'] is not None else None,
+        'additional': f'{prefix}.weather_icon.grib2' if param == 'APCP' else None
+    }
 
-def get_rgb_data(grib_file_path, parameter, model, additional_grib_file=None, second_grib_file_path=None):
-    rgb_data = None
-    if parameter == 'WIND':
-        u_data, ni, nj = read_grib_data(grib_file_path, 2)
-        v_data, ni, nj = read_grib_data(grib_file_path, 3)
-        rgb_data = encode_wind_to_rgb(u_data, v_data, ni, nj)
-    elif parameter == 'APCP':
-        if additional_grib_file is not None:
-            total_precipitation_6_acc, ni, nj = read_grib_data(grib_file_path, 8)
-            total_precipitation_3_acc, ni, nj = read_grib_data(second_grib_file_path, 8)
-            total_precipitation = total_precipitation_6_acc - total_precipitation_3_acc
-            frozen_precipitation_data, ni, nj = read_grib_data(additional_grib_file, 39)
-            rgb_data = encode_precipitation_to_rgb(total_precipitation, frozen_precipitation_data, ni, nj)
-    else:
-        data, ni, nj = read_grib_data(grib_file_path)
-        rgb_data = encode_data_to_rgb(data, ni, nj, parameter, model)
 
-    return rgb_data
+def download_request_files(request, cycle, date, model, metrics=None):
+    start_time = time.perf_counter()
+    param = request['param']
+    i = request['step']
+    weather_date = date.strftime('%Y%m%d')
+
+    files = get_request_files(request, cycle, date, model)
+    # Повторы, докачки и обращения к кэшу GRIB считаются в метриках прогона, который скачивает файлы в этом потоке
+    counting = counting_run_events(metrics.add_counter) if metrics is not None else contextlib.nullcontext()
+    try:
+        with counting:
+            if model == 'GFS' and grib_cache_enabled:
+                # Файлы сроков берутся через кэш цикла: общий файл срока скачивается один раз на все параметры
+                for name in ('additional', 'second', 'main'):
+                    if files[name] is not None:
+                        download_gfs_source(request['sources'][name], files[name])
+            elif model == 'ECMWF' and grib_cache_enabled and ECMWF_FETCH_MODE == 'batch':
+                download_ecmwf_source(request['sources']['main'], files['main'])
+            else:
+                if files['additional'] is not None:
+                    download_additional_apcp_data_file(cycle, weather_date, i, files['additional'])
+                if files['second'] is not None:
+                    download_grib_file_by_request(request['second_request'], files['second'], model)
+
+                download_grib_file_by_request(request['request'], files['main'], model)
+    except Exception:
+        remove_request_files(files)
+        raise
+    if metrics is not None:
+        metrics.add_stage_time('download', time.perf_counter() - start_time, param, i)
+        metrics.add('download_bytes', sum(os.path.getsize(path) for path in files.values() if path is not None), param, i)
+    return files
+
+
+def remove_request_files(files):
+    for path in files.values():
+        if path is not None and os.path.exists(path):
+            os.remove(path)
+
+
+suppress_output_lock = threading.Lock()
+suppress_output_state = {'depth': 0, 'targets': None}
 
 
 @contextlib.contextmanager
 def suppress_output():
-    new_target = open(os.devnull, 'w')
-    old_targets = sys.stdout, sys.stderr
+    # Загрузки идут из нескольких потоков, поэтому stdout подменяется один раз на всех
+    with suppress_output_lock:
+        if suppress_output_state['depth'] == 0:
+            suppress_output_state['targets'] = sys.stdout, sys.stderr, open(os.devnull, 'w')
+            sys.stdout = sys.stderr = suppress_output_state['targets'][2]
+        suppress_output_state['depth'] += 1
     try:
-        sys.stdout, sys.stderr = new_target, new_target
-        yield new_target
+        yield suppress_output_state['targets'][2]
     finally:
-        sys.stdout, sys.stderr = old_targets
+        with suppress_output_lock:
+            suppress_output_state['depth'] -= 1
+            if suppress_output_state['depth'] == 0:
+                sys.stdout, sys.stderr, new_target = suppress_output_state['targets']
+                new_target.close()
+
+
+ecmwf_client = None
+ecmwf_client_lock = threading.Lock()
+
+
+# Один клиент на процесс: он не хранит состояния запроса, а создавать его на каждый retrieve незачем
+def get_ecmwf_client():
+    global ecmwf_client
+    with ecmwf_client_lock:
+        if ecmwf_client is None:
+            ecmwf_client = Client(source=ECMWF_URL)
+        return ecmwf_client
 
 
 def download_grib_file_by_request(request, grib_file_path, model):
     if model == 'GFS':
-        download_file(request, grib_file_path)
+        download_gfs_file(request, grib_file_path)
     elif model == 'ECMWF':
-        client = Client(source="ecmwf")
-        with suppress_output():
-            client.retrieve(request, grib_file_path)
+        with host_download_slot(ECMWF_URL), suppress_output():
+            get_ecmwf_client().retrieve(request, grib_file_path)
+
+
+def fetch_ecmwf_batch(source):
+    temp_path = os.path.join(temp_dir, f"ecmwf.{source['date']}{'{:02d}'.format(source['time'])}.{source['steps'][0]}."
+                                       f"{os.getpid()}.{threading.get_ident()}.grib2")
+    try:
+        download_grib_file_by_request(create_ecmwf_batch_request(source), temp_path, 'ECMWF')
+        with open(temp_path, 'rb') as f:
+            return f.read()
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+# Режим batch: один retrieve на группу сроков параметра, из результата в файл единицы вырезаются сообщения ее срока
+def download_ecmwf_source(source, grib_file_path):
+    params = [source['param']] if isinstance(source['param'], str) else source['param']
+    key = get_grib_cache_key('ECMWF', f"{source['date']}{'{:02d}'.format(source['time'])}", source['steps'][0], params)
+    data = extract_grib_messages(grib_cache.get(key, functools.partial(fetch_ecmwf_batch, source)),
+                                 [{'step': source['step']}])
+    if len(data) == 0:
+        raise Exception(f"В ответе ECMWF нет сообщений {source['param']} для срока {source['step']}")
+    return write_file_atomic(grib_file_path, data)
+
+
+# Тайлы пишутся в staging прогона модели, в дерево tiles_path они попадают при публикации (publisher.py)
+def prepare_tiles_folder(date, cycle, param, i, model):
+    forecast_date, forecast_time = get_forecast_time(date, cycle, i)
+    tiles_folder = f'{get_staging_run_dir(model, get_run_name(date, cycle))}/{forecast_date}{forecast_time}/{param.lower()}'
+    archive_path = f'{tiles_folder}.mbtiles' if tiles_output == 'mbtiles' else None
+    os.makedirs(tiles_folder if archive_path is None else os.path.dirname(tiles_folder), exist_ok=True)
+    return tiles_folder, archive_path
+
+
+def get_dedup_dir(date, cycle, model):
+    return f'{get_staging_run_dir(model, get_run_name(date, cycle))}/.blobs' if tile_dedup else None
+
+
+def submit_tiles(context, param, i, fields, ni, nj, item_step=None):
+    model = context['model']
+    weather_date = context['weather_date']
+    tiles_folder, archive_path = prepare_tiles_folder(context['date'], context['cycle'], param, i, model)
+
+    # RGB кодируется сразу в сегмент shared memory, из которого читает воркер
+    shape = (nj, ni, 3)
+    shm, shared_rgb = create_shared_array(shape, np.uint8)
+    context['shared_segments'].append(shm.name)
+    metrics = context['metrics']
+    with metrics.stage_timer('encode', param, i):
+        encode_parameter_fields(param, fields, ni, nj, model, out=shared_rgb)
+    del shared_rgb
+    item_step = i if item_step is None else item_step
+    metrics.task_submitted()
+    context['manifest'].job_submitted(param, item_step)
+    task = context['pool'].apply_async(run_generate_tiles_process,
+                                       (shm.name, shape, np.uint8, temp_dir, tiles_folder,
+                                        f'temp.{weather_date}{"{:02d}".format(i)}.{param}.{model}', model,
+                                        context['dedup_dir'], archive_path, get_tile_format(param)),
+                                       callback=functools.partial(collect_tiles_stats, shm.name, context,
+                                                                  param, i, item_step),
+                                       error_callback=functools.partial(log_tiles_process_error, shm.name, context,
+                                                                        param, i, item_step))
+    context['tasks'].append((task, shm.name, param, i, item_step))
+
+
+# Промежуточные кадры между соседними шагами прогноза: поля линейно смешиваются до кодирования,
+# ветер - по компонентам u/v, а не по закодированному направлению
+def submit_interpolated_tiles(context, param, previous, i, fields, ni, nj):
+    previous_step, previous_fields = previous
+    start_time = time.time()
+    frames = 0
+    for hours in range(interpolation_step_hours, i - previous_step, interpolation_step_hours):
+        weight = hours / (i - previous_step)
+        with context['metrics'].stage_timer('interpolate', param, previous_step + hours):
+            frame_fields = interpolate_fields(previous_fields, fields, weight)
+        submit_tiles(context, param, previous_step + hours, frame_fields, ni, nj, item_step=i)
+        frames += 1
+    context['interpolation_stats']['frames'] += frames
+    context['interpolation_stats']['seconds'] += time.time() - start_time
+
+
+# wait_for_step(step, stop) ждет публикации срока; stop выставляется, когда прогон прерван и ждать больше не нужно
+# Срок, после публикации которого можно скачивать запрос: общий retrieve ECMWF ждет последний срок своей группы
+def get_required_step(request, model):
+    if model == 'ECMWF' and grib_cache_enabled and ECMWF_FETCH_MODE == 'batch':
+        return max(request['sources']['main']['steps'])
+    return request['step']
+
+
+def download_when_available(request, cycle, date, model, context, wait_for_step, stop):
+    manifest = context['manifest']
+    files = get_request_files(request, cycle, date, model)
+    if manifest.get_state(request['param'], request['step']) == 'downloaded' and \
+            all(path is None or os.path.exists(path) for path in files.values()):
+        return files
+    if wait_for_step is not None:
+        wait_for_step(get_required_step(request, model), stop)
+    files = download_request_files(request, cycle, date, model, context['metrics'])
+    if not manifest.is_done(request['param'], request['step']):
+        manifest.set_state(request['param'], request['step'], 'downloaded')
+    return files
+
+
+# Какие запросы нужно скачать: незавершенные единицы и, при интерполяции, предыдущий срок того же параметра,
+# поля которого нужны для промежуточных кадров. Возвращает (запросы, единицы, для которых строятся тайлы).
+def select_unfinished_requests(requests, manifest):
+    to_tile = {(request['param'], request['step']) for request in requests
+               if not manifest.is_done(request['param'], request['step'])}
+    needed = set(to_tile)
+    if interpolation_step_hours:
+        steps = {}
+        for request in requests:
+            steps.setdefault(request['param'], []).append(request['step'])
+        for param, step in to_tile:
+            previous_steps = [previous_step for previous_step in steps[param] if previous_step < step]
+            if previous_steps:
+                needed.add((param, max(previous_steps)))
+    return [request for request in requests if (request['param'], request['step']) in needed], to_tile
+
+
+# Режим общей очереди: единицы прогона ставятся в очередь по мере публикации сроков и обрабатываются
+# процессами worker.py на любых узлах; здесь только ждем, пока очередь по прогону опустеет
+def enqueue_run(cycle, date, model, requests, manifest, wait_for_step=None):
+    start_time = time.time()
+    run = f'{date.strftime("%Y%m%d")}{"{:02d}".format(cycle)}'
+    queue = create_work_queue()
+    steps = {}
+    for request in requests:
+        if not manifest.is_done(request['param'], request['step']):
+            steps.setdefault(request['step'], []).append(request)
+    stop = threading.Event()
+    deadline = start_time + work_queue_run_timeout_minutes * 60
+    try:
+        for step in sorted(steps):
+            if wait_for_step is not None:
+                wait_for_step(max(get_required_step(request, model) for request in steps[step]), stop)
+            queue.enqueue([create_work_item(model, run, request) for request in steps[step]])
+
+        while True:
+            states = queue.get_run_states(model, run)
+            if states.get('failed'):
+                raise Exception(f"В очереди не удалось обработать {states['failed']} единиц прогона модели {model} {run}")
+            if not states.get('pending') and not states.get('leased'):
+                break
+            if time.time() > deadline:
+                # Воркеров нет или они не успевают: прогон не должен занимать слот планировщика бесконечно
+                failed = queue.fail_run(model, run, f'Прогон не обработан за {work_queue_run_timeout_minutes} минут')
+                raise Exception(f'Прогон модели {model} {run} не обработан воркерами за '
+                                f'{work_queue_run_timeout_minutes} минут, в failed переведено {failed} единиц')
+            stop.wait(work_queue_poll_seconds)
+    finally:
+        stop.set()
+
+    for step_requests in steps.values():
+        for request in step_requests:
+            manifest.set_state(request['param'], request['step'], 'tiled')
+    publish_run(model, run)
+    manifest.publish()
+    logger.warning(f"Прогон модели {model} {run} обработан через очередь за {time.time() - start_time:.1f} секунд, "
+                   f"единиц: {sum(len(step_requests) for step_requests in steps.values())}")
+
+
+def run_process(cycle, forecast_step, date, model, wait_for_step=None, force=False):
+    # Пока прогон идет, очистка старых прогонов (remove_old_runs) не трогает его staging
+    with staging_run_lock(model, get_run_name(date, cycle)):
+        return import_run(cycle, forecast_step, date, model, wait_for_step, force)
 
 
-def run_process(cycle, forecast_step, date, model):
+# force - выполнить прогон заново, даже если манифест работы отмечает его опубликованным
+def import_run(cycle, forecast_step, date, model, wait_for_step=None, force=False):
     start_time = time.time()
     weather_date = date.strftime('%Y%m%d')
     weather_time = "{:02d}".format(cycle)
 
-    pool = Pool(processes=num_processors)
     os.makedirs(temp_dir, exist_ok=True)
 
     if model == 'ECMWF':
@@ -129,97 +422,160 @@ def run_process(cycle, forecast_step, date, model):
         requests = create_gfs_requests(cycle, forecast_step, weather_date, date, gfs_parameters)
     else:
         requests = None
-    if requests is not None and len(requests) > 0:
-        for request in requests:
+    if requests is None or len(requests) == 0:
+        raise Exception("Не получилось сформировать urls для скачивания")
+    if wait_for_step is not None or (model == 'GFS' and grib_cache_enabled and grib_cache_combined_gfs_requests):
+        # Сроки публикуются по очереди, а общий файл срока нужен всем параметрам - обрабатываем по срокам
+        requests.sort(key=lambda request: request['step'])
+
+    manifest = WorkManifest(model, f'{weather_date}{weather_time}',
+                            [(request['param'], request['step']) for request in requests], reset=force)
+    if manifest.is_complete():
+        logger.warning(f'Прогон модели {model} {weather_date}{weather_time} уже опубликован, повторять нечего')
+        return
+    if work_queue_enabled:
+        return enqueue_run(cycle, date, model, requests, manifest, wait_for_step)
+    cube_steps = sorted({request['step'] for request in requests})
+    cube_params = sorted({request['param'] for request in requests})
+    requests, to_tile = select_unfinished_requests(requests, manifest)
+
+    context = {
+        'cycle': cycle,
+        'date': date,
+        'model': model,
+        'weather_date': weather_date,
+        'weather_time': weather_time,
+        'pool': get_tile_pool(),
+        'tasks': [],
+        'shared_segments': [],
+        'run_stats': {'lock': threading.Lock(), 'tiles': 0, 'unique': 0, 'bytes_written': 0},
+        'interpolation_stats': {'frames': 0, 'seconds': 0.0},
+        'dedup_dir': get_dedup_dir(date, cycle, model),
+        'metrics': RunMetrics(model, f'{weather_date}{weather_time}', date),
+        'manifest': manifest
+    }
+    metrics = context['metrics']
+    status = 'failed'
+    run_stats = context['run_stats']
+    cube = None
+    previous_fields = {}
+    # Поля кодируются и пишутся в куб до чтения следующего срока, поэтому буферы декодирования переиспользуются;
+    # при интерполяции поля предыдущего срока хранятся, и каждое чтение получает свои массивы
+    decode_buffers = None if interpolation_step_hours else {}
+    stop = threading.Event()
+    # Скачанные, но не обработанные файлы остаются в temp_dir: манифест отметил их downloaded для повтора
+    downloads = prefetch(requests, lambda request: download_when_available(request, cycle, date, model, context,
+                                                                           wait_for_step, stop),
+                         download_workers, download_prefetch)
+    try:
+        for request, download in downloads:
             param = request["param"]
             i = request['step']
 
-            step = "{:02d}".format(i)
-            forecast_time = "{:02d}".format((i + cycle) % 24)
-            forecast_date = (date + timedelta(hours=i)).strftime('%Y%m%d')
-
-            grib_file_path = os.path.join(temp_dir, f'{param}.{forecast_date}{forecast_time}.grib2')
-            main_request = request['request']
-            second_request = request['second_request']
-            additional_grib_file = None
-            second_grib_file_path = None
-
+            files = download.result()
             try:
-                if param == 'APCP':
-                    additional_grib_file = download_additional_apcp_data_file(cycle, weather_date, i)
-                if second_request is not None:
-                    second_grib_file_path = os.path.join(temp_dir,
-                                                         f'{param}.{forecast_date}{forecast_time}.03acc.grib2')
-                    download_grib_file_by_request(second_request, second_grib_file_path, model)
-
-                download_grib_file_by_request(main_request, grib_file_path, model)
-                rgb_data = get_rgb_data(grib_file_path, request["param"], model, additional_grib_file, second_grib_file_path)
-                if rgb_data is not None:
-                    tiles_folder = f'{tiles_path}/ecmwf/{weather_date}{weather_time}/{forecast_date}{forecast_time}/{request["param"].lower()}'
-                    os.makedirs(tiles_folder, exist_ok=True)
-
-                    temp_rgb_file = tempfile.NamedTemporaryFile(suffix=".npy", delete=False).name
-                    np.save(temp_rgb_file, rgb_data)
-                    pool.apply_async(run_generate_tiles_process,
-                                     (temp_rgb_file, temp_dir, tiles_folder,
-                                      f'temp.{weather_date}{step}.{request["param"]}.{model}', model))
-
+                with metrics.stage_timer('decode', param, i):
+                    fields, ni, nj = read_parameter_fields(files['main'], param, files['additional'], files['second'],
+                                                           decode_buffers, metrics.decode)
+                if forecast_cube_enabled and fields is not None:
+                    if cube is None:
+                        cube = create_forecast_cube(model, f'{weather_date}{weather_time}', date, cube_steps, ni, nj,
+                                                    cube_params)
+                    write_cube_fields(cube, param, i, fields)
+                if fields is not None and param in ENCODING_RULES:
+                    if (param, i) in to_tile:
+                        submit_tiles(context, param, i, fields, ni, nj)
+                        if interpolation_step_hours:
+                            previous = previous_fields.get(param)
+                            if previous is not None and previous[0] < i:
+                                submit_interpolated_tiles(context, param, previous, i, fields, ni, nj)
+                    if interpolation_step_hours:
+                        previous_fields[param] = (i, fields)
+                    del fields
                 else:
                     logger.error("Data not available for the specified parameter number.")
+                if (param, i) in to_tile:
+                    manifest.close_item(param, i)
             finally:
-                if os.path.exists(grib_file_path):
-                    os.remove(grib_file_path)
-                if additional_grib_file is not None and os.path.exists(additional_grib_file):
-                    os.remove(additional_grib_file)
-                if second_grib_file_path is not None and os.path.exists(second_grib_file_path):
-                    os.remove(second_grib_file_path)
-
-    else:
-        raise Exception("Не получилось сформировать urls для скачивания")
-    pool.close()
-    pool.join()
-    logger.debug(f"Процесс импортирования данных модели {model} занял {time.time() - start_time} секунд")
-
-
-def start(cycle, date,  model, try_count=0):
+                remove_request_files(files)
+        status = 'success'
+    finally:
+        stop.set()
+        downloads.close()
+        # Пул общий с другими прогонами - ждем только свои задачи. Задачу убитого процесса пула multiprocessing
+        # не завершит никогда: после таймаута ее сегмент возвращается в бюджет, а единица считается неуспешной
+        for task, shm_name, param, i, item_step in context['tasks']:
+            task.wait(tile_task_timeout_minutes * 60)
+            if not task.ready():
+                log_tiles_process_error(shm_name, context, param, i, item_step,
+                                        TimeoutError(f'Тайлы {param} срока {i} не готовы за '
+                                                     f'{tile_task_timeout_minutes} минут'))
+        for shm_name in context['shared_segments']:
+            release_shared_array(shm_name)
+        if cube is not None:
+            close_forecast_cube(cube)
+        grib_cache.remove_run(model, f'{weather_date}{weather_time}')
+        unfinished = manifest.count_unfinished()
+        if status == 'success' and unfinished:
+            status = 'failed'
+        if status != 'success':
+            metrics.write(status)
+    if unfinished:
+        raise Exception(f'Не завершено {unfinished} единиц прогона модели {model} {weather_date}{weather_time}, '
+                        f'они будут повторены')
+    # Отчет успешного прогона пишется после публикации: задержка считается до момента, когда тайлы видны клиентам
+    try:
+        publish_run(model, f'{weather_date}{weather_time}')
+        manifest.publish()
+    except Exception:
+        metrics.write('failed')
+        raise
+    metrics.mark_published()
+    report = metrics.write(status)
+    if context['dedup_dir'] is not None and run_stats['tiles']:
+        logger.warning(f"Дедупликация тайлов модели {model}: {run_stats['tiles']} тайлов, "
+                       f"{run_stats['unique']} уникальных (коэффициент {run_stats['tiles'] / max(run_stats['unique'], 1):.2f}), "
+                       f"записано {run_stats['bytes_written']} байт")
+    interpolation_stats = context['interpolation_stats']
+    if interpolation_stats['frames']:
+        logger.warning(f"Интерполировано {interpolation_stats['frames']} кадров модели {model}, "
+                       f"{interpolation_stats['seconds'] / interpolation_stats['frames']:.3f} секунд на кадр "
+                       f"(смешивание и кодирование)")
+    for item in report['tile_encoding']:
+        logger.warning(f"Кодирование тайлов {model} {item['param']} в {item['format']}: {item['tiles']} тайлов, "
+                       f"{item['bytes'] / max(item['tiles'], 1) / 1024:.1f} КБ и "
+                       f"{item['seconds'] / max(item['tiles'], 1) * 1000:.1f} мс на тайл")
+    stage_seconds = ', '.join(f'{stage} {seconds:.1f}' for stage, seconds in report['stage_seconds'].items() if seconds)
+    logger.warning(f"Процесс импортирования данных модели {model} занял {time.time() - start_time:.1f} секунд, "
+                   f"этапы (секунд): {stage_seconds}; самый долгий - {report['slowest_stage']}, "
+                   f"скачано {report['download_bytes']} байт, {report['tiles']} тайлов, "
+                   f"задержка публикации {report['publish_latency_seconds'] / 60:.0f} минут")
+    return report
+
+
+def start(cycle, date, model, wait_for_step=None):
     try:
         logger.debug(
-            f'Начат процесс импортирования данных модели {model} на {date.strftime("%Y-%m-%d")} для цикла = {"{:02d}".format(cycle)}:00. Попытка # {try_count + 1}')
-        run_process(cycle, 6, date, model)
+            f'Начат процесс импортирования данных модели {model} на {date.strftime("%Y-%m-%d")} для цикла = {"{:02d}".format(cycle)}:00')
+        run_process(cycle, FORECAST_STEP, date, model, wait_for_step)
         logger.warning(
             f"Импортированы данные модели {model} {date.strftime('%Y-%m-%d')} для цикла = {'{:02d}'.format(cycle)}")
+        return True
     except Exception as e:
         logger.error(
             f'Ошибка импортирования данных модели {model} на {date.strftime("%Y-%m-%d")} для цикла = {"{:02d}".format(cycle)}:00: : {e}', exc_info=True)
-        try_count += 1
-
-        if try_count <= 15:
-            threading.Timer(3 * 60, lambda: start(cycle, date, model, try_count)).start()
-        else:
-            logger.error(
-                f"Превышен лимит попыток. Не удается получить данные на {date.strftime('%Y-%m-%d')} для цикла = {'{:02d}'.format(cycle)}", exc_info=True)
-            threading.Timer(30 * 60 * 60, lambda: start(cycle, date, model, 0)).start()
-
-
-def run(cycle, date):
-    date = date.replace(hour=cycle, minute=0, second=0)
-    start(cycle, date, 'ECMWF')
-    start(cycle, date, 'GFS')
+        return False
 
 
 if __name__ == "__main__":
 
-    # ECMWF решили поставлять данные для 0 часов ночи и 12 часов дня на пол часа позже
-    time_delta_6_18 = timedelta(hours=10, minutes=25)
-    time_delta_0_12 = timedelta(hours=10, minutes=55)
-    # Данные для ecmwf становятся доступны примерно через 10 часов 20 минут после даты формирования прогноза
-    schedule.every().day.at("04:25").do(lambda: run(18, datetime.now() - time_delta_6_18))
-    schedule.every().day.at("10:55").do(lambda: run(0, datetime.now() - time_delta_0_12))
-    schedule.every().day.at("16:25").do(lambda: run(6, datetime.now() - time_delta_6_18))
-    schedule.every().day.at("22:55").do(lambda: run(12, datetime.now() - time_delta_0_12))
-
-    # schedule.every().day.at("03:00").do(lambda: remove_old_tiles(f'{tiles_path}/gfs/', 1))
-    schedule.every().day.at("03:05").do(lambda: remove_old_tiles(f'{tiles_path}/ecmwf/', 1))
+    # Циклы запускаются по готовности данных, повторы после ошибок делает тот же планировщик
+    scheduler = CycleScheduler(start)
+    schedule.every(scheduler_poll_interval_seconds).seconds.do(scheduler.poll)
+
+    # Старые прогоны снимаются с публикации по манифесту, файлы удаляются в фоне с ограничением скорости
+    schedule.every(retention_interval_minutes).minutes.do(remove_old_runs)
+    schedule.every().day.at("03:10").do(lambda: remove_old_manifests(1))
     logger.warning(f"Планировщик задач запущен")
 
 
@@ -257,9 +613,11 @@ if __name__ == "__main__":
 
                 dt = datetime.strptime(weather_date, '%Y%m%d')
                 dt = dt.replace(hour=int(weather_cycle))
-                run(int(weather_cycle), dt)
+                for model in scheduler_models:
+                    scheduler.request_cycle(model, dt, manual=True)
 
     schedule.every().day.at("00:00").do(lambda: create_new_log_file())
+    scheduler.poll()
 
     while True:
         schedule.run_pending()
@@ -0,0 +1,90 @@
+import hashlib
+import sqlite3
+from config import *
+
+"""
+    Запись всех тайлов одного параметра на один срок прогноза в единый файл MBTiles (SQLite).
+    Используется схема map + images: одинаковые тайлы хранятся в архиве один раз,
+    а view tiles дает стандартное представление MBTiles. Нумерация строк - TMS, как и в дереве PNG.
+    Архив пишется во временный файл и атомарно переименовывается после закрытия.
+"""
+
+MBTILES_SCHEMA = '''
+    PRAGMA journal_mode = OFF;
+    PRAGMA synchronous = OFF;
+    CREATE TABLE metadata (name TEXT, value TEXT);
+    CREATE TABLE images (tile_id TEXT PRIMARY KEY, tile_data BLOB);
+    CREATE TABLE map (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_id TEXT);
+    CREATE VIEW tiles AS
+        SELECT map.zoom_level AS zoom_level, map.tile_column AS tile_column, map.tile_row AS tile_row,
+               images.tile_data AS tile_data
+        FROM map JOIN images ON images.tile_id = map.tile_id;
+'''
+
+
+def open_tile_archive(path):
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    connection = sqlite3.connect(temp_path)
+    connection.executescript(MBTILES_SCHEMA)
+    return {'path': path, 'temp_path': temp_path, 'connection': connection,
+            'images': [], 'map': [], 'known': set()}
+
+
+def add_archive_tile(archive, zoom, x, y, payload):
+    tile_id = hashlib.sha1(payload).hexdigest()
+    is_new = tile_id not in archive['known']
+    if is_new:
+        archive['known'].add(tile_id)
+        archive['images'].append((tile_id, sqlite3.Binary(payload)))
+    archive['map'].append((zoom, x, y, tile_id))
+    if len(archive['map']) >= tile_archive_batch_size:
+        flush_tile_archive(archive)
+    return is_new
+
+
+def flush_tile_archive(archive):
+    connection = archive['connection']
+    with connection:
+        connection.executemany('INSERT INTO images (tile_id, tile_data) VALUES (?, ?)', archive['images'])
+        connection.executemany('INSERT INTO map (zoom_level, tile_column, tile_row, tile_id) VALUES (?, ?, ?, ?)',
+                               archive['map'])
+    archive['images'] = []
+    archive['map'] = []
+
+
+def close_tile_archive(archive, metadata):
+    flush_tile_archive(archive)
+    connection = archive['connection']
+    with connection:
+        connection.execute('CREATE UNIQUE INDEX map_index ON map (zoom_level, tile_column, tile_row)')
+        connection.executemany('INSERT INTO metadata (name, value) VALUES (?, ?)',
+                               [(name, str(value)) for name, value in metadata.items()])
+    connection.close()
+    os.replace(archive['temp_path'], archive['path'])
+
+
+def abort_tile_archive(archive):
+    archive['connection'].close()
+    if os.path.exists(archive['temp_path']):
+        os.remove(archive['temp_path'])
+
+
+def read_archive_metadata(path):
+    connection = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    try:
+        return dict(connection.execute('SELECT name, value FROM metadata').fetchall())
+    finally:
+        connection.close()
+
+
+def read_archive_tile(path, zoom, x, y):
+    connection = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    try:
+        row = connection.execute('SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?',
+                                 (zoom, x, y)).fetchone()
+    finally:
+        connection.close()
+    return None if row is None else bytes(row[0])
@@ -0,0 +1,103 @@
+import threading
+from osgeo import gdal
+import numpy as np
+from config import *
+
+"""
+    Кодирование тайла (строки, столбцы, 3) uint8 в байты файла. Формат задается tile_encoding.format,
+    для отдельных параметров - tile_encoding.parameters:
+        png         - RGB PNG со степенью сжатия png_zlevel
+        rgba_png    - RGBA PNG с непрозрачным альфа-каналом, как у gdal2tiles
+        webp        - WebP без потерь
+        palette_png - PNG с палитрой, если в тайле не больше palette_max_colors цветов (значения совпадают побитно),
+                      иначе RGB PNG
+    Кодировщик возвращает (фактический формат, байты): статистика ведется по формату, которым тайл записан на самом деле.
+"""
+
+
+def read_vsimem_file(vsi_path):
+    f = gdal.VSIFOpenL(vsi_path, 'rb')
+    try:
+        gdal.VSIFSeekL(f, 0, 2)
+        size = gdal.VSIFTellL(f)
+        gdal.VSIFSeekL(f, 0, 0)
+        return bytes(gdal.VSIFReadL(1, size, f))
+    finally:
+        gdal.VSIFCloseL(f)
+
+
+# tile - массив (строки, столбцы, каналы); bands может быть больше числа каналов, лишние каналы заполняет вызывающий
+def create_tile_dataset(tile, bands):
+    rows, cols, channels = tile.shape
+    dataset = gdal.GetDriverByName('MEM').Create('', cols, rows, bands, gdal.GDT_Byte)
+    for i in range(channels):
+        dataset.GetRasterBand(i + 1).WriteArray(tile[:, :, i])
+    return dataset
+
+
+def write_tile_dataset(driver_name, dataset, extension, options=None):
+    driver = gdal.GetDriverByName(driver_name)
+    if driver is None:
+        raise Exception(f'Драйвер GDAL {driver_name} недоступен')
+    vsi_path = f'/vsimem/tile.{os.getpid()}.{threading.get_ident()}.{extension}'
+    driver.CreateCopy(vsi_path, dataset, options=options or [])
+    try:
+        return read_vsimem_file(vsi_path)
+    finally:
+        gdal.Unlink(vsi_path)
+
+
+def encode_rgb_png(tile):
+    return 'png', write_tile_dataset('PNG', create_tile_dataset(tile, 3), 'png', [f'ZLEVEL={tile_encoding_png_zlevel}'])
+
+
+def encode_rgba_png(tile):
+    dataset = create_tile_dataset(tile, 4)
+    dataset.GetRasterBand(4).Fill(255)
+    return 'rgba_png', write_tile_dataset('PNG', dataset, 'png')
+
+
+def encode_webp(tile):
+    return 'webp', write_tile_dataset('WEBP', create_tile_dataset(tile, 3), 'webp', ['LOSSLESS=TRUE'])
+
+
+def encode_palette_png(tile):
+    pixels = tile.reshape(-1, 3).astype(np.uint32)
+    colors, indexes = np.unique((pixels[:, 0] << 16) | (pixels[:, 1] << 8) | pixels[:, 2], return_inverse=True)
+    if len(colors) > min(tile_encoding_palette_max_colors, 256):
+        return encode_rgb_png(tile)
+
+    dataset = create_tile_dataset(indexes.astype(np.uint8).reshape(tile.shape[0], tile.shape[1], 1), 1)
+    color_table = gdal.ColorTable()
+    for i, color in enumerate(colors.tolist()):
+        color_table.SetColorEntry(i, (color >> 16, (color >> 8) & 255, color & 255, 255))
+    dataset.GetRasterBand(1).SetRasterColorTable(color_table)
+    options = [f'ZLEVEL={tile_encoding_png_zlevel}']
+    # Для маленькой палитры индексы пакуются по 1, 2 или 4 бита на пиксель
+    bits = next((bits for bits in (1, 2, 4) if len(colors) <= 2 ** bits), None)
+    if bits is not None:
+        options.append(f'NBITS={bits}')
+    return 'palette_png', write_tile_dataset('PNG', dataset, 'png', options)
+
+
+TILE_ENCODERS = {
+    'png': {'encode': encode_rgb_png, 'extension': 'png', 'mime_type': 'image/png'},
+    'rgba_png': {'encode': encode_rgba_png, 'extension': 'png', 'mime_type': 'image/png'},
+    'webp': {'encode': encode_webp, 'extension': 'webp', 'mime_type': 'image/webp'},
+    'palette_png': {'encode': encode_palette_png, 'extension': 'png', 'mime_type': 'image/png'},
+}
+
+
+def get_tile_format(param=None):
+    tile_format = tile_encoding_parameters.get(param, tile_encoding_format) if param is not None else tile_encoding_format
+    if tile_format not in TILE_ENCODERS:
+        raise ValueError(f'Неизвестный формат тайлов: {tile_format}')
+    return tile_format
+
+
+def get_tile_extension(tile_format):
+    return TILE_ENCODERS[tile_format]['extension']
+
+
+def encode_tile(tile, tile_format):
+    return TILE_ENCODERS[tile_format]['encode'](tile)
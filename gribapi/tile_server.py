@@ -0,0 +1,178 @@
+import glob
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+from gdal_processes import to_byte_image
+from resample_plan import TILE_SIZE, get_resample_plan, apply_resample_plan
+from tile_archive import read_archive_tile
+from tile_encoders import TILE_ENCODERS, get_tile_format, get_tile_extension, encode_tile
+from publisher import load_tiles_manifest
+from config import *
+
+"""
+    HTTP сервер тайлов: GET /ecmwf/{run}/{valid}/{param}/{z}/{x}/{y}.png или .webp (нумерация y - TMS, как на диске).
+    Тайлы до prerendered_max_zoom берутся из дерева PNG или архива {param}.mbtiles,
+    более глубокие зумы рендерятся при первом запросе из сохраненного RGB растра {param}.source.{model}.npy
+    тем же планом перепроецирования, что и в tiler, и кодируются форматом параметра из tile_encoding
+    (или png/webp по расширению запроса, если у параметра другое). Ответы хранятся в LRU кэше уже закодированными, с ETag.
+    В ключ кэша входит время публикации параметра прогона из манифеста тайлов: после повторной публикации
+    прогона старые тайлы в кэше больше не находятся и вытесняются как давно не использованные.
+
+    Запуск: python tile_server.py
+"""
+
+TILE_URL_PATTERN = re.compile(r'^/ecmwf/(\d{10})/(\d{10})/([a-z_]+)/(\d+)/(\d+)/(\d+)\.(png|webp)$')
+
+
+class TileCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.items.get(key)
+            if item is not None:
+                self.items.move_to_end(key)
+            return item
+
+    def put(self, key, payload):
+        item = (payload, f'"{hashlib.sha1(payload).hexdigest()}"')
+        with self.lock:
+            if key in self.items:
+                self.used -= len(self.items.pop(key)[0])
+            self.items[key] = item
+            self.used += len(payload)
+            while self.used > self.max_bytes and len(self.items) > 1:
+                _, (old_payload, _) = self.items.popitem(last=False)
+                self.used -= len(old_payload)
+        return item
+
+
+tile_cache = TileCache(tile_server_cache_mb * 1024 * 1024)
+published_versions = {'mtime': None, 'versions': {}}
+published_versions_lock = threading.Lock()
+
+
+# (прогон, параметр) -> время публикации; манифест перечитывается, только когда меняется файл
+def get_published_versions():
+    try:
+        mtime = os.stat(publishing_manifest_path).st_mtime_ns
+    except FileNotFoundError:
+        return {}
+    with published_versions_lock:
+        if mtime != published_versions['mtime']:
+            versions = {}
+            for run, entry in load_tiles_manifest()['runs'].items():
+                for item in entry['models'].values():
+                    for param in item['params']:
+                        versions[(run, param)] = max(versions.get((run, param), ''), item['published'])
+            published_versions.update(mtime=mtime, versions=versions)
+        return published_versions['versions']
+
+
+# Формат тайлов параметра, если его расширение совпадает с запрошенным, иначе формат по расширению
+def get_response_format(param, extension):
+    tile_format = get_tile_format(param.upper())
+    return tile_format if get_tile_extension(tile_format) == extension else extension
+
+
+def read_prerendered_tile(param_folder, zoom, x, y, extension):
+    path = f'{param_folder}/{zoom}/{x}/{y}.{extension}'
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            return f.read()
+    # Архив пишется одним форматом - форматом параметра
+    archive_extension = get_tile_extension(get_tile_format(os.path.basename(param_folder).upper()))
+    if archive_extension == extension and os.path.exists(f'{param_folder}.mbtiles'):
+        return read_archive_tile(f'{param_folder}.mbtiles', zoom, x, y)
+    return None
+
+
+def render_tile(param_folder, zoom, x, y, tile_format):
+    sources = glob.glob(f'{glob.escape(param_folder)}.source.*.npy')
+    if not sources:
+        return None
+    model = sources[0].rsplit('.', 2)[-2]
+    rgb_image = np.load(sources[0], mmap_mode='r')
+    nj, ni = rgb_image.shape[:2]
+
+    plan = get_resample_plan(ni, nj, model, zoom, zoom)
+    row = (2 ** zoom - 1 - y) * TILE_SIZE
+    col = x * TILE_SIZE
+    tile = apply_resample_plan(rgb_image, plan, row, row + TILE_SIZE, col, col + TILE_SIZE)
+    return encode_tile(to_byte_image(tile), tile_format)[1]
+
+
+def get_tile(run, valid, param, zoom, x, y, extension='png'):
+    key = (run, valid, param, zoom, x, y, extension, get_published_versions().get((run, param)))
+    item = tile_cache.get(key)
+    if item is not None:
+        return item
+
+    if zoom > tile_server_max_zoom or not (0 <= x < 2 ** zoom and 0 <= y < 2 ** zoom):
+        return None
+    param_folder = f'{tiles_path}/ecmwf/{run}/{valid}/{param}'
+    tile_format = get_response_format(param, extension)
+    payload = None
+    if zoom <= tile_server_prerendered_max_zoom:
+        payload = read_prerendered_tile(param_folder, zoom, x, y, extension)
+    if payload is None:
+        payload = render_tile(param_folder, zoom, x, y, tile_format)
+    if payload is None:
+        return None
+    return tile_cache.put(key, payload)
+
+
+class TileRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        match = TILE_URL_PATTERN.match(self.path.split('?', 1)[0])
+        if match is None:
+            self.send_error(404)
+            return
+        run, valid, param, extension = match.group(1, 2, 3, 7)
+        zoom, x, y = (int(value) for value in match.group(4, 5, 6))
+        try:
+            item = get_tile(run, valid, param, zoom, x, y, extension)
+        except Exception as e:
+            logger.error(f'Ошибка при получении тайла {self.path}: {e}', exc_info=True)
+            self.send_error(500)
+            return
+        if item is None:
+            self.send_error(404)
+            return
+
+        payload, etag = item
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', TILE_ENCODERS[extension]['mime_type'])
+        self.send_header('Content-Length', str(len(payload)))
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', f'public, max-age={tile_server_max_age}')
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        logger.debug(f'{self.address_string()} - {format % args}')
+
+
+def serve_tiles():
+    if not store_source_rasters and tile_server_max_zoom > tile_server_prerendered_max_zoom:
+        logger.warning(f'store_source_rasters выключен, зумы глубже {tile_server_prerendered_max_zoom} '
+                       f'рендериться не будут')
+    server = ThreadingHTTPServer((tile_server_host, tile_server_port), TileRequestHandler)
+    logger.warning(f'Сервер тайлов запущен на {tile_server_host}:{tile_server_port}')
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    serve_tiles()
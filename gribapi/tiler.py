@@ -0,0 +1,198 @@
+import functools
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from gdal_processes import to_byte_image
+from tile_encoders import TILE_ENCODERS, get_tile_format, get_tile_extension, encode_tile
+from utils import get_strip_rows, write_file_atomic
+from tile_archive import open_tile_archive, add_archive_tile, close_tile_archive, abort_tile_archive
+from resample_plan import TILE_SIZE, get_resample_plan, apply_resample_plan
+from config import *
+
+MERCATOR_HALF_WORLD = 20037508.342789244
+
+"""
+    Нативная замена связки gdalwarp + gdal2tiles.py.
+    Растр в EPSG:4326 билинейно перепроецируется в Web Mercator на максимальном зуме
+    по закэшированному плану из resample_plan полосами строк,
+    каждый следующий уровень строится в памяти уменьшением полос предыдущего в 2 раза.
+    Нумерация тайлов совпадает с gdal2tiles (TMS): {z}/{x}/{y}.png, y отсчитывается снизу.
+    Тайлы ряда кодируются параллельно в tile_encoding.workers потоках (GDAL отпускает GIL при сжатии),
+    записываются по порядку в вызывающем потоке.
+"""
+
+
+def parse_zoom_levels(zoom_levels):
+    min_zoom, max_zoom = (int(z) for z in str(zoom_levels).split('-'))
+    return min_zoom, max_zoom
+
+
+def downsample(image):
+    return (image[0::2, 0::2] + image[1::2, 0::2] + image[0::2, 1::2] + image[1::2, 1::2]) * 0.25
+
+
+# Одинаковые тайлы хранятся в dedup_dir один раз (имя - sha1 содержимого), в дереве тайлов - жесткие ссылки на них
+def save_deduplicated_tile(payload, path, output):
+    digest = hashlib.sha1(payload).hexdigest()
+    blob_path = f'{output["dedup_dir"]}/{digest[:2]}/{digest}.{output["extension"]}'
+    if not os.path.exists(blob_path):
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        write_file_atomic(blob_path, payload)
+        output['stats']['unique'] += 1
+        output['stats']['bytes_written'] += len(payload)
+    try:
+        if os.path.lexists(path):
+            os.remove(path)
+        os.link(blob_path, path)
+    except OSError:
+        # Жесткие ссылки недоступны (другая ФС или лимит ссылок) - пишем копию
+        write_file_atomic(path, payload)
+        output['stats']['bytes_written'] += len(payload)
+
+
+def encode_tile_timed(tile, tile_format):
+    start_time = time.perf_counter()
+    encoded_format, payload = encode_tile(tile, tile_format)
+    return encoded_format, payload, time.perf_counter() - start_time
+
+
+# Кодирует тайлы ряда: повторяющиеся в пределах поля тайлы (океан, полюса) кодируются один раз,
+# остальные - параллельно в потоках output['executor']. Возвращает байты тайлов в исходном порядке.
+def encode_tiles(tiles, output):
+    digests = [hashlib.sha1(np.ascontiguousarray(tile)).digest() for tile in tiles]
+    pending = {}
+    for digest, tile in zip(digests, tiles):
+        if digest not in output['encoded'] and digest not in pending:
+            pending[digest] = tile
+    encode = functools.partial(encode_tile_timed, tile_format=output['format'])
+    executor = output['executor']
+    results = executor.map(encode, pending.values()) if executor is not None else map(encode, pending.values())
+    formats = output['stats']['formats']
+    for digest, (encoded_format, payload, seconds) in zip(pending, results):
+        output['encoded'][digest] = payload
+        stats = formats.setdefault(encoded_format, {'tiles': 0, 'bytes': 0, 'seconds': 0.0})
+        stats['tiles'] += 1
+        stats['bytes'] += len(payload)
+        stats['seconds'] += seconds
+    return [output['encoded'][digest] for digest in digests]
+
+
+def save_tile(payload, zoom, x, y, output):
+    stats = output['stats']
+    stats['tiles'] += 1
+    if output['archive'] is not None:
+        if add_archive_tile(output['archive'], zoom, x, y, payload):
+            stats['unique'] += 1
+            stats['bytes_written'] += len(payload)
+        return
+
+    path = f'{output["folder"]}/{zoom}/{x}/{y}.{output["extension"]}'
+    if output['dedup_dir'] is None:
+        with open(path, 'wb') as f:
+            f.write(payload)
+        stats['unique'] += 1
+        stats['bytes_written'] += len(payload)
+        return
+
+    save_deduplicated_tile(payload, path, output)
+
+
+def write_tile_rows(image, zoom, first_tile_row, output):
+    tiles_count = 2 ** zoom
+    byte_image = to_byte_image(image)
+    positions = []
+    tiles = []
+    for x in range(tiles_count):
+        if output['archive'] is None:
+            os.makedirs(f'{output["folder"]}/{zoom}/{x}', exist_ok=True)
+        for row in range(len(byte_image) // TILE_SIZE):
+            positions.append((x, tiles_count - 1 - (first_tile_row + row)))
+            tiles.append(byte_image[row * TILE_SIZE:(row + 1) * TILE_SIZE, x * TILE_SIZE:(x + 1) * TILE_SIZE])
+    for (x, y), payload in zip(positions, encode_tiles(tiles, output)):
+        save_tile(payload, zoom, x, y, output)
+    return len(tiles)
+
+
+# Полоса строк уровня zoom: целые ряды тайлов сразу записываются, остаток ждет следующей полосы,
+# а уменьшенная в 2 раза полоса передается на уровень ниже
+def push_strip(levels, zoom, strip, min_zoom, output):
+    level = levels[zoom]
+    rows = strip if level['buffer'] is None else np.concatenate([level['buffer'], strip])
+    full_rows = len(rows) // TILE_SIZE * TILE_SIZE
+    written = 0
+    if full_rows:
+        written += write_tile_rows(rows[:full_rows], zoom, level['tile_row'], output)
+        level['tile_row'] += full_rows // TILE_SIZE
+    level['buffer'] = rows[full_rows:] if full_rows < len(rows) else None
+    if zoom > min_zoom:
+        written += push_strip(levels, zoom - 1, downsample(strip), min_zoom, output)
+    return written
+
+
+def write_tilemap_resource(output_folder, min_zoom, max_zoom, tile_format):
+    tile_sets = ''.join(
+        f'      <TileSet href="{z}" units-per-pixel="{2 * MERCATOR_HALF_WORLD / (TILE_SIZE * 2 ** z):.14f}" order="{z}"/>\n'
+        for z in range(min_zoom, max_zoom + 1))
+    with open(f'{output_folder}/tilemapresource.xml', 'w') as f:
+        f.write(f'''<?xml version="1.0" encoding="utf-8"?>
+<TileMap version="1.0.0" tilemapservice="http://tms.osgeo.org/1.0.0">
+  <Title>{os.path.basename(output_folder)}</Title>
+  <Abstract></Abstract>
+  <SRS>EPSG:3857</SRS>
+  <BoundingBox minx="{-MERCATOR_HALF_WORLD:.14f}" miny="{-MERCATOR_HALF_WORLD:.14f}" maxx="{MERCATOR_HALF_WORLD:.14f}" maxy="{MERCATOR_HALF_WORLD:.14f}"/>
+  <Origin x="{-MERCATOR_HALF_WORLD:.14f}" y="{-MERCATOR_HALF_WORLD:.14f}"/>
+  <TileFormat width="{TILE_SIZE}" height="{TILE_SIZE}" mime-type="{TILE_ENCODERS[tile_format]['mime_type']}" extension="{get_tile_extension(tile_format)}"/>
+  <TileSets profile="mercator">
+{tile_sets}  </TileSets>
+</TileMap>
+''')
+
+
+def create_tiles_from_rgb(rgb_image, output_folder, model, zoom_levels="0-3", dedup_dir=None, archive_path=None,
+                          tile_format=None):
+    # formats - {фактический формат: {'tiles', 'bytes', 'seconds'}} по закодированным (уникальным) тайлам
+    stats = {'tiles': 0, 'unique': 0, 'bytes_written': 0, 'formats': {}}
+    if rgb_image is None:
+        logger.warning("Data not available for the specified parameter number.")
+        return stats
+
+    min_zoom, max_zoom = parse_zoom_levels(zoom_levels)
+    nj, ni = rgb_image.shape[:2]
+    plan = get_resample_plan(ni, nj, model, min_zoom, max_zoom)
+    source = to_byte_image(rgb_image)
+
+    # Максимальный зум строится полосами по целым рядам тайлов, пик памяти ограничен max_worker_memory
+    size = TILE_SIZE * 2 ** max_zoom
+    strip_rows = min(size, get_strip_rows((2 * ni + 2 * size) * 3 * 4, TILE_SIZE))
+    levels = {zoom: {'buffer': None, 'tile_row': 0} for zoom in range(min_zoom, max_zoom + 1)}
+    tile_format = tile_format or get_tile_format()
+    archive = open_tile_archive(archive_path) if archive_path is not None else None
+    executor = ThreadPoolExecutor(max_workers=tile_encoding_workers) if tile_encoding_workers > 1 else None
+    output = {'folder': output_folder, 'dedup_dir': dedup_dir, 'archive': archive, 'stats': stats, 'encoded': {},
+              'format': tile_format, 'extension': get_tile_extension(tile_format), 'executor': executor}
+    try:
+        for row_start in range(0, size, strip_rows):
+            strip = apply_resample_plan(source, plan, row_start, row_start + strip_rows)
+            push_strip(levels, max_zoom, strip, min_zoom, output)
+    except Exception:
+        if archive is not None:
+            abort_tile_archive(archive)
+        raise
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    if archive is not None:
+        close_tile_archive(archive, {
+            'name': os.path.basename(output_folder),
+            'format': get_tile_extension(tile_format),
+            'type': 'overlay',
+            'bounds': '-180.0,-85.0511,180.0,85.0511',
+            'minzoom': min_zoom,
+            'maxzoom': max_zoom
+        })
+        logger.debug(f"Тайлы сохранены в архив {archive_path}")
+    else:
+        write_tilemap_resource(output_folder, min_zoom, max_zoom, tile_format)
+        logger.debug(f"Тайлы сохранены по пути {output_folder}")
+    return stats
@@ -1,26 +1,281 @@
+import contextlib
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
 import requests
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
+from config import *
+
+_session = None
+_session_lock = threading.Lock()
+_host_semaphores = {}
+# Предел загрузок на сервер, заданный set_download_limit_per_host; None - лимиты из config
+_host_limit_override = None
+
+# Счетчики загрузок процесса: повторы запросов urllib3 и докачки через Range
+download_stats = {'retries': 0, 'resumes': 0}
+download_stats_lock = threading.Lock()
+# Счетчик прогона, для которого работает текущий поток (RunMetrics.add_counter): прогоны идут параллельно,
+# поэтому повторы, докачки и обращения к кэшу GRIB относятся к прогону по потоку, а не по общим счетчикам
+run_counter = threading.local()
+
+
+def get_session():
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            retry = Retry(total=5, backoff_factor=0.1, status_forcelist=[500, 502, 503, 504])
+            adapter = HTTPAdapter(max_retries=retry, pool_connections=len(download_host_limits) + 1,
+                                  pool_maxsize=max(get_host_limit(host) for host in [None, *download_host_limits]))
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _session = session
+    return _session
+
+
+@contextlib.contextmanager
+def counting_run_events(add_counter):
+    previous = getattr(run_counter, 'add', None)
+    run_counter.add = add_counter
+    try:
+        yield
+    finally:
+        run_counter.add = previous
+
+
+def add_run_counter(name, value):
+    add_counter = getattr(run_counter, 'add', None)
+    if add_counter is not None:
+        add_counter(name, value)
+
+
+def add_download_stat(name, value):
+    with download_stats_lock:
+        download_stats[name] += value
+    add_run_counter(name, value)
+
+
+def count_download_retries(response):
+    retries = getattr(response.raw, 'retries', None)
+    if retries is not None and retries.history:
+        add_download_stat('retries', len(retries.history))
+
+
+def get_host_limit(host):
+    if _host_limit_override is not None:
+        return _host_limit_override
+    return download_host_limits.get(host, download_max_per_host)
+
+
+def host_download_slot(url):
+    host = urlsplit(url).hostname
+    with _session_lock:
+        if host not in _host_semaphores:
+            _host_semaphores[host] = threading.BoundedSemaphore(get_host_limit(host))
+        return _host_semaphores[host]
+
+
+# Один предел загрузок на каждый сервер, в том числе на перечисленные в download_host_limits (backfill.py).
+# Вызывается до начала загрузок: семафоры и сессия создаются заново, пул соединений сессии - под новый предел
+def set_download_limit_per_host(limit):
+    global _host_limit_override, _session
+    with _session_lock:
+        _host_limit_override = limit
+        _host_semaphores.clear()
+        _session = None
 
 
 def download_file(url, output_path=None, header=None, timeout=5):
-    session = requests.Session()
-    retry = Retry(total=5, backoff_factor=0.1, status_forcelist=[500, 502, 503, 504])
-    adapter = HTTPAdapter(max_retries=retry)
-    session.mount('http://', adapter)
-    session.mount('https://', adapter)
-
-    if header:
-        response = session.get(url, headers=header, timeout=timeout)
-    else:
-        response = session.get(url, timeout=timeout)
+    session = get_session()
+
+    if output_path is None:
+        with host_download_slot(url):
+            response = session.get(url, headers=header, timeout=timeout)
+        count_download_retries(response)
+        if response.status_code != 200 and response.status_code != 206:
+            raise Exception(f"Ошибка при загрузке файла по url = {url}. Код: {response.status_code}")
+        return response.content
+
+    temp_path = f'{output_path}.part'
+    try:
+        with host_download_slot(url), open(temp_path, 'wb') as f:
+            stream_to_file(session, url, f, header, timeout)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, output_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return output_path
+
+
+def stream_to_file(session, url, file, header=None, timeout=5):
+    # Если запрос уже содержит свой Range, докачка невозможна - диапазон задает вызывающий
+    can_resume = not (header and 'Range' in header)
+    received = 0
+    expected = None
+    for attempt in range(download_max_resumes + 1):
+        headers = dict(header or {})
+        if received and can_resume:
+            headers['Range'] = f'bytes={received}-'
+            add_download_stat('resumes', 1)
+        try:
+            with session.get(url, headers=headers, timeout=timeout, stream=True) as response:
+                count_download_retries(response)
+                if response.status_code != 200 and response.status_code != 206:
+                    raise Exception(f"Ошибка при загрузке файла по url = {url}. Код: {response.status_code}")
+                if received and response.status_code != 206:
+                    # Сервер проигнорировал Range и отдает файл целиком
+                    file.seek(0)
+                    file.truncate()
+                    received = 0
+                content_length = response.headers.get('Content-Length')
+                if content_length is not None and 'Content-Encoding' not in response.headers:
+                    expected = received + int(content_length)
 
-    if response.status_code != 200 and response.status_code != 206:
+                for chunk in response.iter_content(chunk_size=download_chunk_size):
+                    file.write(chunk)
+                    received += len(chunk)
+        except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError,
+                requests.exceptions.Timeout) as e:
+            if not can_resume or attempt == download_max_resumes:
+                raise
+            logger.warning(f'Обрыв загрузки {url} на {received} байтах, докачиваем: {e}')
+            continue
+
+        if expected is None or received >= expected or not can_resume:
+            break
+        logger.warning(f'Получено {received} из {expected} байт по url = {url}, докачиваем')
+
+    if expected is not None and received != expected:
+        raise Exception(f"Размер файла по url = {url} не совпадает с Content-Length: {received} из {expected}")
+    return received
+
+
+def format_byte_ranges(ranges):
+    return 'bytes=' + ','.join(f'{start}-{"" if end is None else end}' for start, end in ranges)
+
+
+def parse_content_range(value):
+    # Content-Range: bytes 100-199/1000
+    start, end = value.split(' ', 1)[1].split('/', 1)[0].split('-')
+    return int(start), int(end)
+
+
+def split_multipart_byteranges(body, content_type):
+    boundary = content_type.split('boundary=', 1)[1].strip().strip('"').encode()
+    parts = []
+    for part in body.split(b'--' + boundary):
+        head, separator, data = part.partition(b'\r\n\r\n')
+        if not separator:
+            continue
+        for line in head.decode('latin-1').split('\r\n'):
+            if line.lower().startswith('content-range:'):
+                start, end = parse_content_range(line.split(':', 1)[1].strip())
+                parts.append((start, end, data[:end - start + 1]))
+    return parts
+
+
+def slice_ranges(parts, ranges):
+    chunks = []
+    for start, end in ranges:
+        for part_start, _, data in parts:
+            part_end = part_start + len(data) - 1
+            if part_start <= start <= part_end and (end is None or end <= part_end):
+                chunks.append(data[start - part_start:None if end is None else end - part_start + 1])
+                break
+        else:
+            raise Exception(f"Сервер не вернул диапазон байт {start}-{end}")
+    return chunks
+
+
+# Временное имя уникально для процесса и потока: суффикс .part занят докачкой download_file
+def write_file_atomic(path, data):
+    temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    os.replace(temp_path, path)
+    return path
+
+
+# Скачивает несколько диапазонов байт одним multi-range запросом и склеивает их в один файл
+def download_byte_ranges(url, ranges, output_path, timeout=5):
+    session = get_session()
+    with host_download_slot(url):
+        response = session.get(url, headers={'Range': format_byte_ranges(ranges)}, timeout=timeout)
+    count_download_retries(response)
+
+    if response.status_code == 206:
+        content_type = response.headers.get('Content-Type', '')
+        if content_type.startswith('multipart/byteranges'):
+            parts = split_multipart_byteranges(response.content, content_type)
+        else:
+            start, end = parse_content_range(response.headers['Content-Range'])
+            parts = [(start, end, response.content)]
+    elif response.status_code == 200:
+        # Сервер проигнорировал Range и отдал файл целиком
+        parts = [(0, len(response.content) - 1, response.content)]
+    else:
         raise Exception(f"Ошибка при загрузке файла по url = {url}. Код: {response.status_code}")
-    if output_path is not None:
-        with open(output_path, 'wb') as f:
-            f.write(response.content)
-            f.close()
-    return response.content
+
+    temp_path = f'{output_path}.part'
+    try:
+        with open(temp_path, 'wb') as f:
+            for chunk in slice_ranges(parts, ranges):
+                f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, output_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return output_path
+
+
+# Запускает fetch для элементов в пуле потоков, держа не больше depth загрузок впереди потребителя.
+# Отдает пары (item, future) в исходном порядке. Если потребитель прервал обход,
+# незапущенные загрузки отменяются, а для уже выполненных вызывается cleanup.
+def prefetch(items, fetch, max_workers, depth, cleanup=None):
+    pending = deque()
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        for item in items:
+            pending.append((item, executor.submit(fetch, item)))
+            if len(pending) >= depth:
+                yield pending.popleft()
+        while pending:
+            yield pending.popleft()
+    finally:
+        for _, future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+        for _, future in pending:
+            if cleanup is not None and not future.cancelled() and future.exception() is None:
+                cleanup(future.result())
+
+
+def get_memory_limit():
+    # Лимит памяти контейнера (cgroup v2 и v1), иначе весь объем физической памяти
+    for path in ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes'):
+        try:
+            with open(path) as f:
+                value = f.read().strip()
+            if value.isdigit() and int(value) < 1 << 60:
+                return int(value)
+        except OSError:
+            pass
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def get_worker_count():
+    memory_workers = get_memory_limit() // (max_worker_memory * 1024 * 1024)
+    return max(1, min(os.cpu_count(), memory_workers))
 
 
+# Сколько строк растра обрабатывать за раз, чтобы полоса занимала не больше половины max_worker_memory
+def get_strip_rows(row_bytes, multiple=1):
+    rows = max_worker_memory * 1024 * 1024 // 2 // max(row_bytes, 1)
+    return max(multiple, rows // multiple * multiple)
@@ -0,0 +1,113 @@
+import threading
+from config import *
+
+"""
+    Манифест прогона: состояние каждой единицы работы (параметр, срок) в {work_manifest_dir}/{model}.{run}.json.
+    pending -> downloaded (GRIB файлы лежат в temp_dir) -> tiled (все тайлы срока записаны) -> published (прогон завершен).
+    Повтор прогона или перезапуск процесса переделывают только незавершенные единицы, завершенный прогон ничего не делает.
+    С reset=True (backfill.py --force) сохраненные состояния отбрасываются, и прогон выполняется заново целиком.
+    Единица становится tiled, когда закрыта отправка ее задач и все задачи генерации тайлов (срок и интерполированные
+    кадры перед ним) завершились без ошибок; при ошибке она возвращается в pending.
+"""
+
+WORK_ITEM_STATES = ['pending', 'downloaded', 'tiled', 'published']
+
+
+def get_work_item_key(param, step):
+    return f'{param}.{step}'
+
+
+class WorkManifest:
+    def __init__(self, model, run, items, reset=False):
+        self.model = model
+        self.run = run
+        self.path = os.path.join(work_manifest_dir, f'{model}.{run}.json')
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.jobs = {}
+        self.items = {}
+        if not reset and os.path.exists(self.path):
+            try:
+                with open(self.path) as f:
+                    self.items = json.load(f)['items']
+            except (OSError, ValueError, KeyError) as e:
+                logger.error(f'Манифест {self.path} поврежден, прогон будет выполнен заново: {e}')
+        for param, step in items:
+            self.items.setdefault(get_work_item_key(param, step), 'pending')
+        self.save()
+
+    def save(self):
+        # Снимок и запись под одной блокировкой, чтобы более старый снимок не перезаписал новый
+        with self.save_lock:
+            with self.lock:
+                payload = json.dumps({'model': self.model, 'run': self.run, 'items': self.items}, indent=2)
+            os.makedirs(work_manifest_dir, exist_ok=True)
+            temp_path = f'{self.path}.{os.getpid()}.tmp'
+            with open(temp_path, 'w') as f:
+                f.write(payload)
+            os.replace(temp_path, self.path)
+
+    def get_state(self, param, step):
+        with self.lock:
+            return self.items[get_work_item_key(param, step)]
+
+    def set_state(self, param, step, state):
+        with self.lock:
+            self.items[get_work_item_key(param, step)] = state
+        self.save()
+
+    def is_done(self, param, step):
+        return self.get_state(param, step) in ('tiled', 'published')
+
+    def is_complete(self):
+        with self.lock:
+            return all(state == 'published' for state in self.items.values())
+
+    def count_unfinished(self):
+        with self.lock:
+            return sum(state not in ('tiled', 'published') for state in self.items.values())
+
+    def job_submitted(self, param, step):
+        with self.lock:
+            jobs = self.jobs.setdefault(get_work_item_key(param, step), {'jobs': 0, 'failed': False, 'closed': False})
+            jobs['jobs'] += 1
+
+    def job_finished(self, param, step, success=True):
+        with self.lock:
+            jobs = self.jobs[get_work_item_key(param, step)]
+            jobs['jobs'] -= 1
+            jobs['failed'] = jobs['failed'] or not success
+        self.update_tiled(param, step)
+
+    # Все задачи единицы отправлены в пул: дальше она станет tiled по завершении последней из них
+    def close_item(self, param, step):
+        with self.lock:
+            self.jobs.setdefault(get_work_item_key(param, step), {'jobs': 0, 'failed': False, 'closed': False})['closed'] = True
+        self.update_tiled(param, step)
+
+    def update_tiled(self, param, step):
+        key = get_work_item_key(param, step)
+        with self.lock:
+            jobs = self.jobs[key]
+            if not jobs['closed'] or jobs['jobs'] > 0:
+                return
+            del self.jobs[key]
+            self.items[key] = 'pending' if jobs['failed'] else 'tiled'
+        self.save()
+
+    def publish(self):
+        with self.lock:
+            for key, state in self.items.items():
+                if state == 'tiled':
+                    self.items[key] = 'published'
+        self.save()
+
+
+def remove_old_manifests(days_threshold):
+    if not os.path.isdir(work_manifest_dir):
+        return
+    current_time = time.time()
+    for name in os.listdir(work_manifest_dir):
+        path = os.path.join(work_manifest_dir, name)
+        if (current_time - os.path.getmtime(path)) / (60 * 60 * 24) > days_threshold:
+            os.remove(path)
@@ -0,0 +1,291 @@
+import socket
+import sqlite3
+import threading
+import uuid
+from urllib.parse import urlsplit
+from config import *
+
+"""
+    Общая очередь единиц работы (модель, прогон, параметр, срок) для нескольких узлов.
+    Узел-планировщик кладет в очередь запросы из create_gfs_requests/create_ecmwf_requests, процессы worker.py
+    на любых узлах забирают их с арендой (lease), обрабатывают и пишут тайлы в общий tiles_path.
+    Аренда продлевается, пока единица обрабатывается; если воркер упал, по истечении аренды единицу забирает другой.
+    Истекшая аренда считается попыткой: единица, которая max_attempts раз роняла воркер, переходит в failed.
+
+    Бэкенд задается адресом в work_queue.url:
+        sqlite:///./public/work_queue.sqlite - одна база SQLite (один узел или общий диск с рабочими блокировками)
+        file:///./public/work_queue - папка с файлами аренды, для локальной проверки без базы
+    Новый бэкенд (например, сетевой брокер) добавляется в WORK_QUEUE_BACKENDS.
+"""
+
+WORK_ITEM_FIELDS = ['id', 'model', 'run', 'param', 'step', 'request', 'state', 'owner', 'lease_expires', 'attempts',
+                    'error']
+
+
+def get_work_item_id(model, run, param, step):
+    return f'{model}.{run}.{param}.{step}'
+
+
+def get_worker_id():
+    return f'{socket.gethostname()}.{os.getpid()}.{uuid.uuid4().hex[:8]}'
+
+
+def create_work_item(model, run, request):
+    return {
+        'id': get_work_item_id(model, run, request['param'], request['step']),
+        'model': model,
+        'run': run,
+        'param': request['param'],
+        'step': request['step'],
+        'request': request,
+        'state': 'pending',
+        'owner': None,
+        'lease_expires': 0,
+        'attempts': 0,
+        'error': None
+    }
+
+
+class SQLiteWorkQueue:
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.local = threading.local()
+        with self.connect() as connection:
+            connection.execute('''
+                CREATE TABLE IF NOT EXISTS work_items (
+                    id TEXT PRIMARY KEY, model TEXT, run TEXT, param TEXT, step INTEGER, request TEXT,
+                    state TEXT, owner TEXT, lease_expires REAL, attempts INTEGER, error TEXT)''')
+            connection.execute('CREATE INDEX IF NOT EXISTS work_items_state ON work_items (state, lease_expires)')
+
+    def connect(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute('PRAGMA journal_mode = WAL')
+            connection.execute('PRAGMA busy_timeout = 30000')
+            self.local.connection = connection
+        return TransactionContext(connection)
+
+    def enqueue(self, items):
+        with self.connect() as connection:
+            for item in items:
+                # Повторная постановка не трогает выполненные и взятые единицы, но возвращает в работу failed
+                connection.execute('''
+                    INSERT INTO work_items VALUES (?, ?, ?, ?, ?, ?, 'pending', NULL, 0, 0, NULL)
+                    ON CONFLICT (id) DO UPDATE SET state = 'pending', attempts = 0, error = NULL
+                    WHERE work_items.state = 'failed' ''',
+                                   (item['id'], item['model'], item['run'], item['param'], item['step'],
+                                    json.dumps(item['request'])))
+
+    def claim(self, owner, lease_seconds, max_attempts=work_queue_max_attempts):
+        now = time.time()
+        with self.connect() as connection:
+            connection.execute('''UPDATE work_items SET state = 'failed', owner = NULL, lease_expires = 0,
+                                  error = 'Аренда истекла, исчерпаны попытки'
+                                  WHERE state = 'leased' AND lease_expires < ? AND attempts >= ?''', (now, max_attempts))
+            row = connection.execute('''
+                SELECT * FROM work_items WHERE state = 'pending' OR (state = 'leased' AND lease_expires < ?)
+                ORDER BY run, step, param LIMIT 1''', (now,)).fetchone()
+            if row is None:
+                return None
+            item = self.row_to_item(row)
+            connection.execute('''UPDATE work_items SET state = 'leased', owner = ?, lease_expires = ?,
+                                  attempts = attempts + 1 WHERE id = ?''', (owner, now + lease_seconds, item['id']))
+        item.update(state='leased', owner=owner, lease_expires=now + lease_seconds, attempts=item['attempts'] + 1)
+        return item
+
+    def renew(self, item, owner, lease_seconds):
+        with self.connect() as connection:
+            cursor = connection.execute('''UPDATE work_items SET lease_expires = ?
+                                           WHERE id = ? AND owner = ? AND state = 'leased' ''',
+                                        (time.time() + lease_seconds, item['id'], owner))
+            return cursor.rowcount == 1
+
+    def complete(self, item, owner):
+        with self.connect() as connection:
+            connection.execute('''UPDATE work_items SET state = 'done', error = NULL
+                                  WHERE id = ? AND owner = ?''', (item['id'], owner))
+
+    def fail(self, item, owner, error, max_attempts):
+        with self.connect() as connection:
+            connection.execute('''UPDATE work_items SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END,
+                                  owner = NULL, lease_expires = 0, error = ? WHERE id = ? AND owner = ?''',
+                               (max_attempts, str(error), item['id'], owner))
+
+    def fail_run(self, model, run, error):
+        with self.connect() as connection:
+            cursor = connection.execute('''UPDATE work_items SET state = 'failed', owner = NULL, lease_expires = 0,
+                                           error = ? WHERE model = ? AND run = ? AND state IN ('pending', 'leased')''',
+                                        (str(error), model, run))
+            return cursor.rowcount
+
+    def get_run_states(self, model, run):
+        with self.connect() as connection:
+            rows = connection.execute('SELECT state, COUNT(*) FROM work_items WHERE model = ? AND run = ? GROUP BY state',
+                                      (model, run)).fetchall()
+        return dict(rows)
+
+    def row_to_item(self, row):
+        item = dict(zip(WORK_ITEM_FIELDS, row))
+        item['request'] = json.loads(item['request'])
+        return item
+
+
+class TransactionContext:
+    # BEGIN IMMEDIATE сразу берет блокировку записи: два воркера не заберут одну единицу
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        self.connection.execute('BEGIN IMMEDIATE')
+        return self.connection
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.connection.execute('COMMIT' if exc_type is None else 'ROLLBACK')
+
+
+class FileLeaseWorkQueue:
+    # Состояние единицы - папка, в которой лежит ее файл: pending/, leased/, done/, failed/.
+    # Переходы делаются через os.rename, который атомарен в пределах одной файловой системы,
+    # поэтому единицу забирает только тот, чей rename прошел первым. Срок аренды - mtime файла в leased/.
+    def __init__(self, directory):
+        self.directory = directory
+        for state in ('pending', 'leased', 'done', 'failed'):
+            os.makedirs(os.path.join(directory, state), exist_ok=True)
+
+    def get_path(self, state, item_id):
+        return os.path.join(self.directory, state, f'{item_id}.json')
+
+    def write_item(self, path, item, lease_expires=None):
+        temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(item, f)
+        if lease_expires is not None:
+            # mtime выставляется до переименования, иначе файл успеет показаться просроченным
+            os.utime(temp_path, (lease_expires, lease_expires))
+        os.replace(temp_path, path)
+
+    def read_item(self, path):
+        with open(path) as f:
+            return json.load(f)
+
+    def enqueue(self, items):
+        for item in items:
+            if os.path.exists(self.get_path('failed', item['id'])):
+                item = dict(item, attempts=0)
+                self.write_item(self.get_path('pending', item['id']), item)
+                os.remove(self.get_path('failed', item['id']))
+                continue
+            if any(os.path.exists(self.get_path(state, item['id'])) for state in ('pending', 'leased', 'done')):
+                continue
+            self.write_item(self.get_path('pending', item['id']), item)
+
+    def claim(self, owner, lease_seconds, max_attempts=work_queue_max_attempts):
+        self.requeue_expired(max_attempts)
+        for name in sorted(os.listdir(os.path.join(self.directory, 'pending'))):
+            if not name.endswith('.json'):
+                continue
+            item_id = name[:-len('.json')]
+            pending_path = self.get_path('pending', item_id)
+            leased_path = self.get_path('leased', item_id)
+            lease_expires = time.time() + lease_seconds
+            try:
+                os.utime(pending_path, (lease_expires, lease_expires))
+                os.rename(pending_path, leased_path)
+            except FileNotFoundError:
+                # Единицу уже забрал другой воркер
+                continue
+            item = self.read_item(leased_path)
+            item.update(state='leased', owner=owner, lease_expires=lease_expires, attempts=item['attempts'] + 1)
+            self.write_item(leased_path, item, lease_expires)
+            return item
+        return None
+
+    def requeue_expired(self, max_attempts):
+        now = time.time()
+        leased_dir = os.path.join(self.directory, 'leased')
+        for name in os.listdir(leased_dir):
+            path = os.path.join(leased_dir, name)
+            try:
+                if not name.endswith('.json') or os.path.getmtime(path) >= now:
+                    continue
+                item = self.read_item(path)
+                if item['attempts'] < max_attempts:
+                    os.rename(path, os.path.join(self.directory, 'pending', name))
+                    continue
+                item.update(state='failed', owner=None, lease_expires=0, error='Аренда истекла, исчерпаны попытки')
+                self.write_item(path, item)
+                os.replace(path, os.path.join(self.directory, 'failed', name))
+            except (FileNotFoundError, ValueError):
+                continue
+
+    def is_owner(self, item, owner):
+        try:
+            return self.read_item(self.get_path('leased', item['id']))['owner'] == owner
+        except (FileNotFoundError, ValueError):
+            return False
+
+    def renew(self, item, owner, lease_seconds):
+        if not self.is_owner(item, owner):
+            return False
+        expires = time.time() + lease_seconds
+        os.utime(self.get_path('leased', item['id']), (expires, expires))
+        return True
+
+    def complete(self, item, owner):
+        if self.is_owner(item, owner):
+            os.replace(self.get_path('leased', item['id']), self.get_path('done', item['id']))
+
+    def fail(self, item, owner, error, max_attempts):
+        if not self.is_owner(item, owner):
+            return
+        leased_path = self.get_path('leased', item['id'])
+        item = dict(self.read_item(leased_path), owner=None, lease_expires=0, error=str(error))
+        state = 'failed' if item['attempts'] >= max_attempts else 'pending'
+        item['state'] = state
+        self.write_item(leased_path, item)
+        os.replace(leased_path, self.get_path(state, item['id']))
+
+    def fail_run(self, model, run, error):
+        prefix = f'{model}.{run}.'
+        failed = 0
+        for state in ('pending', 'leased'):
+            for name in os.listdir(os.path.join(self.directory, state)):
+                if not (name.startswith(prefix) and name.endswith('.json')):
+                    continue
+                path = os.path.join(self.directory, state, name)
+                try:
+                    item = dict(self.read_item(path), state='failed', owner=None, lease_expires=0, error=str(error))
+                    self.write_item(path, item)
+                    os.replace(path, os.path.join(self.directory, 'failed', name))
+                    failed += 1
+                except (FileNotFoundError, ValueError):
+                    continue
+        return failed
+
+    def get_run_states(self, model, run):
+        prefix = f'{model}.{run}.'
+        states = {}
+        for state in ('pending', 'leased', 'done', 'failed'):
+            count = sum(name.startswith(prefix) and name.endswith('.json')
+                        for name in os.listdir(os.path.join(self.directory, state)))
+            if count:
+                states[state] = count
+        return states
+
+
+WORK_QUEUE_BACKENDS = {
+    'sqlite': SQLiteWorkQueue,
+    'file': FileLeaseWorkQueue,
+}
+
+
+def create_work_queue(url=None):
+    url = url or work_queue_url
+    parts = urlsplit(url)
+    backend = WORK_QUEUE_BACKENDS.get(parts.scheme)
+    if backend is None:
+        raise ValueError(f'Неизвестный бэкенд очереди: {parts.scheme}')
+    # sqlite:///./path и file:///./path - относительный путь, sqlite:////abs/path - абсолютный
+    return backend(parts.path[1:] if parts.path.startswith('/') else parts.path)
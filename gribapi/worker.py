@@ -0,0 +1,89 @@
+import sys
+import threading
+from multiprocessing import Process
+from start import (download_request_files, remove_request_files, prepare_tiles_folder, get_dedup_dir,
+                   generate_tiles)
+from tile_encoders import get_tile_format
+from grib_to_rgb import read_parameter_fields, encode_parameter_fields, ENCODING_RULES
+from work_queue import create_work_queue, get_worker_id
+from utils import get_worker_count
+from config import *
+
+"""
+    Воркер общей очереди: забирает единицы (модель, прогон, параметр, срок) с арендой, скачивает GRIB,
+    кодирует RGB и пишет тайлы в staging прогона в общем tiles_path (публикует прогон узел-планировщик). Пока единица обрабатывается, аренда продлевается
+    в отдельном потоке; если процесс упадет, аренда истечет и единицу заберет другой воркер.
+    Интерполяция между сроками и куб прогноза в этом режиме не строятся: для них нужны соседние сроки.
+
+    Запуск на каждом узле: python worker.py [число процессов]
+"""
+
+
+# Буферы декодирования процесса воркера: единицы обрабатываются по одной, поля не живут дольше единицы
+decode_buffers = {}
+
+
+def process_work_item(item):
+    model = item['model']
+    param = item['param']
+    step = item['step']
+    date = datetime.strptime(item['run'], '%Y%m%d%H')
+    cycle = date.hour
+
+    files = download_request_files(item['request'], cycle, date, model)
+    try:
+        fields, ni, nj = read_parameter_fields(files['main'], param, files['additional'], files['second'],
+                                               decode_buffers)
+        if fields is None or param not in ENCODING_RULES:
+            logger.error(f"Data not available for the specified parameter number. Единица {item['id']}")
+            return
+        rgb_image = encode_parameter_fields(param, fields, ni, nj, model)
+        del fields
+        tiles_folder, archive_path = prepare_tiles_folder(date, cycle, param, step, model)
+        generate_tiles(rgb_image, temp_dir, tiles_folder, f'temp.{item["id"]}.tif', model,
+                       get_dedup_dir(date, cycle, model), archive_path, get_tile_format(param))
+    finally:
+        remove_request_files(files)
+
+
+def keep_lease(queue, item, worker_id, stop):
+    while not stop.wait(work_queue_lease_seconds / 3):
+        if not queue.renew(item, worker_id, work_queue_lease_seconds):
+            logger.warning(f"Аренда единицы {item['id']} потеряна, ее может обработать другой воркер")
+            return
+
+
+def run_worker():
+    queue = create_work_queue()
+    worker_id = get_worker_id()
+    os.makedirs(temp_dir, exist_ok=True)
+    logger.warning(f'Воркер {worker_id} запущен, очередь {work_queue_url}')
+    while True:
+        item = queue.claim(worker_id, work_queue_lease_seconds)
+        if item is None:
+            time.sleep(work_queue_poll_seconds)
+            continue
+
+        stop = threading.Event()
+        lease_thread = threading.Thread(target=keep_lease, args=(queue, item, worker_id, stop), daemon=True)
+        lease_thread.start()
+        start_time = time.time()
+        try:
+            process_work_item(item)
+            queue.complete(item, worker_id)
+            logger.debug(f"Единица {item['id']} обработана за {time.time() - start_time:.1f} секунд")
+        except Exception as e:
+            logger.error(f"Ошибка обработки единицы {item['id']} (попытка {item['attempts']}): {e}", exc_info=True)
+            queue.fail(item, worker_id, e, work_queue_max_attempts)
+        finally:
+            stop.set()
+            lease_thread.join()
+
+
+if __name__ == "__main__":
+    processes_count = int(sys.argv[1]) if len(sys.argv) > 1 else work_queue_worker_processes or get_worker_count()
+    processes = [Process(target=run_worker) for _ in range(processes_count)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()